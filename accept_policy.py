@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import re
+from typing import List, Tuple
+
+from chatarena.message import MessagePool
+from chatarena.agent import SIGNAL_END_OF_CONVERSATION
+
+
+class AcceptPolicy:
+    """
+    Decides whether a finished dialog is saved to the output or written to the rejected dialogs file.
+    """
+    type_name = None
+    interactive = False
+
+    def __call__(self, message_pool: MessagePool, player_names: List[str]) -> Tuple[bool, str]:
+        """
+        Returns:
+            (accepted, reason) where reason explains a rejection
+        """
+        raise NotImplementedError
+
+
+class InteractivePolicy(AcceptPolicy):
+    """Ask on the console after every dialog (the original behavior)."""
+    type_name = "interactive"
+    interactive = True
+
+    def __call__(self, message_pool: MessagePool, player_names: List[str]) -> Tuple[bool, str]:
+        print("Save? (y/n)")
+        if input() == "n":
+            return False, "rejected by the user"
+        return True, ""
+
+
+class AcceptAllPolicy(AcceptPolicy):
+    type_name = "accept_all"
+
+    def __call__(self, message_pool: MessagePool, player_names: List[str]) -> Tuple[bool, str]:
+        return True, ""
+
+
+class RuleBasedPolicy(AcceptPolicy):
+    """
+    Reject dialogs that are too short, that a player failed in (empty responses, the end-of-conversation
+    signal sent after a failed API call) or that contain a message matching one of the reject patterns.
+    """
+    type_name = "rules"
+
+    DEFAULT_REJECT_PATTERNS = (
+        r"\bas an ai\b",
+        r"\blanguage model\b",
+        r"\bi(?: a|')m sorry, but i can(?:no|')t\b",
+    )
+
+    def __init__(self, min_messages: int = 4, max_words_per_message: int = 80, reject_patterns=DEFAULT_REJECT_PATTERNS):
+        self.min_messages = min_messages
+        self.max_words_per_message = max_words_per_message
+        self.reject_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in reject_patterns]
+
+    def __call__(self, message_pool: MessagePool, player_names: List[str]) -> Tuple[bool, str]:
+        messages = message_pool.get_all_messages()
+        if len(messages) < self.min_messages:
+            return False, f"only {len(messages)} messages"
+
+        speakers = {message.agent_name for message in messages}
+        for player_name in player_names:
+            if player_name not in speakers:
+                return False, f"{player_name} never spoke"
+
+        for message in messages:
+            if message.content == SIGNAL_END_OF_CONVERSATION:
+                return False, f"{message.agent_name} failed to generate a response"
+            if not message.content.strip():
+                return False, f"empty message from {message.agent_name}"
+            if self.max_words_per_message is not None and len(message.content.split()) > self.max_words_per_message:
+                return False, f"message from {message.agent_name} is longer than {self.max_words_per_message} words"
+            for pattern in self.reject_patterns:
+                if pattern.search(message.content):
+                    return False, f"message from {message.agent_name} matches {pattern.pattern!r}"
+
+        return True, ""
+
+
+ALL_POLICIES = [
+    InteractivePolicy,
+    AcceptAllPolicy,
+    RuleBasedPolicy,
+]
+
+POLICY_REGISTRY = {policy.type_name: policy for policy in ALL_POLICIES}
+
+
+def load_policy(type_name: str, **kwargs) -> AcceptPolicy:
+    try:
+        policy_cls = POLICY_REGISTRY[type_name]
+    except KeyError:
+        raise ValueError(f"Unknown accept policy: {type_name}")
+    return policy_cls(**kwargs)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Per-call latency of a fresh OpenAI client per call (the old behavior of OpenAIChat._get_response)
+against the pooled clients of chatarena.backends.openai_clients, measured against the local stand-in server.
+
+    python benchmarks/bench_client_pool.py --num_calls 200
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from openai import OpenAI, AsyncOpenAI
+from chatarena.backends.openai_clients import configure_openai_clients, get_openai_client, get_async_openai_client
+from fake_openai_server import start_server
+
+MESSAGES = [{"role": "system", "content": "You are a salesperson."}, {"role": "user", "content": "Hi!"}]
+
+
+def create(client):
+    return client.chat.completions.create(model="gpt-4o-mini", messages=MESSAGES, max_tokens=20)
+
+
+def bench_sync(name, get_client, num_calls):
+    latencies = []
+    for _ in range(num_calls):
+        start = time.perf_counter()
+        create(get_client())
+        latencies.append(time.perf_counter() - start)
+    report(name, latencies)
+
+
+async def bench_async(name, get_client, num_calls, concurrency, fresh):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_call():
+        async with semaphore:
+            start = time.perf_counter()
+            if fresh:
+                async with get_client() as client:
+                    await create(client)
+            else:
+                await create(get_client())
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one_call() for _ in range(num_calls)])
+    report(name, latencies, wall=time.perf_counter() - start)
+
+
+def report(name, latencies, wall=None):
+    latencies = sorted(latencies)
+    p95 = latencies[int(0.95 * (len(latencies) - 1))]
+    line = f"{name:<28} mean {statistics.mean(latencies) * 1000:7.2f} ms   p50 {statistics.median(latencies) * 1000:7.2f} ms   p95 {p95 * 1000:7.2f} ms"
+    if wall is not None:
+        line += f"   wall {wall:6.2f} s"
+    print(line, flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.01, help="The latency of the stand-in server in seconds.")
+    args = parser.parse_args()
+
+    server, base_url = start_server(latency=args.latency)
+    configure_openai_clients(base_url=base_url)
+    api_key = os.environ["OPENAI_API_KEY"]
+
+    bench_sync("sync, client per call", lambda: OpenAI(api_key=api_key, base_url=base_url), args.num_calls)
+    bench_sync("sync, pooled client", get_openai_client, args.num_calls)
+    asyncio.run(bench_async("async, client per call", lambda: AsyncOpenAI(api_key=api_key, base_url=base_url), args.num_calls, args.concurrency, fresh=True))
+    asyncio.run(bench_async("async, pooled client", get_async_openai_client, args.num_calls, args.concurrency, fresh=False))
+    server.shutdown()
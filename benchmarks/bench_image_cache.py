@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Profile the image encoding done per turn by OpenAIChat: the old behavior (three uncached encodes per turn)
+against the cached encoding of only the image the current turn needs.
+
+    python benchmarks/bench_image_cache.py --num_dialogs 50 --num_turns 20
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from chatarena.backends.image_cache import EncodedImageCache, read_and_encode_image
+
+
+def make_scene_images(image_dir, num_scenes):
+    paths = []
+    for i in range(num_scenes):
+        path = os.path.join(image_dir, f"scene_{i}_small.jpg")
+        Image.effect_noise((640, 360), 40 + i).convert("RGB").save(path, format="JPEG", quality=85)
+        paths.append(path)
+    return paths
+
+
+def simulate(dialog_scenes, num_turns, transition_turn, encode_turn):
+    encoded_bytes = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    for first, second in dialog_scenes:
+        for turn in range(num_turns):
+            encoded_bytes += encode_turn(first, second, turn < transition_turn)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, encoded_bytes, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_dialogs", type=int, default=50)
+    parser.add_argument("--num_turns", type=int, default=20)
+    parser.add_argument("--num_scenes", type=int, default=10)
+    parser.add_argument("--transition_turn", type=int, default=8)
+    args = parser.parse_args()
+
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as image_dir:
+        scene_paths = make_scene_images(image_dir, args.num_scenes)
+        dialog_scenes = [tuple(random.sample(scene_paths, 2)) for _ in range(args.num_dialogs)]
+
+        def encode_turn_uncached(first, second, before_transition):
+            # the old OpenAIChat.query encoded all three variants at every turn
+            return sum(len(read_and_encode_image(path)) for path in (first, second, second))
+
+        cache = EncodedImageCache()
+
+        def encode_turn_cached(first, second, before_transition):
+            cache.get(first if before_transition else second)
+            return 0
+
+        for name, encode_turn in (("uncached, 3 encodes / turn", encode_turn_uncached), ("cached, 1 lookup / turn", encode_turn_cached)):
+            elapsed, encoded_bytes, peak = simulate(dialog_scenes, args.num_turns, args.transition_turn, encode_turn)
+            stats = cache.stats()
+            if encode_turn is encode_turn_cached:
+                encoded_bytes = stats["bytes"]
+            turns = args.num_dialogs * args.num_turns
+            print(f"{name:<28} {elapsed * 1000 / turns:8.3f} ms/turn   base64 encoded {encoded_bytes / 2 ** 20:8.1f} MB "
+                  f"({encoded_bytes / 1024 / turns:7.1f} KB/turn)   peak traced memory {peak / 2 ** 20:6.2f} MB", flush=True)
+        print(f"cache stats: {cache.stats()}")
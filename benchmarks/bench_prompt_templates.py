@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Profile the prompt construction of a dialog (everything create_instruct does after drawing the preferences):
+the old string concatenation against the precompiled templates of prompt_templates.py, with the products
+described for every dialog as before and once per scene as create_instruct does now. The rendering of the
+prompts alone, with the products described beforehand, is timed too: it is a small part of the total.
+
+    python benchmarks/bench_prompt_templates.py --num_dialogs 2000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_utils import reformat_objects_info, describe_scene_products, simulate_user_preference
+from prompt_templates import render_instructions
+
+
+def legacy_render_instructions(domain, user_profile, assistant_profile, user_personality, conversation_end_or_continue_sample,
+                               max_interaction_step, different_type_name, simulate_preference, second_simulate_preference,
+                               products_desc, second_products_desc, with_image=True):
+    # the prompt building of create_instruct before the templates
+    env_desc = f"You are now participating in a conversation happening in a {domain} store."
+    if with_image:
+        env_desc += f"The image provided is the snapshot of this store."
+    user_desc = "You are {}, ".format(user_profile["Name"])
+    if user_profile["Occupation"] == "Student":
+        if user_profile["Gender"] == "Male":
+            profile_desc = "a male student in the age range of {}, living in {}".format(user_profile["Age Range"].lower(), user_profile["Residence"])
+        else:
+            profile_desc = "a female student in the age range of {}, living in {}".format(user_profile["Age Range"].lower(), user_profile["Residence"])
+    elif user_profile["Occupation"] == "Employed":
+        if user_profile["Gender"] == "Male":
+            profile_desc = "a man in the age range of {}, working in a company and living in {}".format(user_profile["Age Range"].lower(), user_profile["Residence"])
+        else:
+            profile_desc = "a woman in the age range of {}, working in a company and living in {}".format(user_profile["Age Range"].lower(), user_profile["Residence"])
+    else:
+        if user_profile["Gender"] == "Male":
+            profile_desc = "a retired man in the age range of {}, living in {}".format(user_profile["Age Range"].lower(), user_profile["Residence"])
+        else:
+            profile_desc = "a retired woman in the age range of {}, living in {}".format(user_profile["Age Range"].lower(), user_profile["Residence"])
+    user_desc += profile_desc + ".\n\n"
+    user_desc += "Based on your past experiences, you have the following preferences:\n"
+    user_desc_original = user_desc + simulate_preference + "\n"
+    user_desc_transition = user_desc + second_simulate_preference + "\n"
+    user_desc_original += "Based on the Big-5 personality traits, your personality is measured as:\n"
+    user_desc_transition += "Based on the Big-5 personality traits, your personality is measured as:\n"
+    for k, v in user_personality.items():
+        user_desc_original += "For {}, you are {}.\n".format(k, v)
+        user_desc_transition += "For {}, you are {}.\n".format(k, v)
+    user_desc_original += "\n"
+    user_desc_transition += "\n"
+    user_desc_original += "Your response should match your profile and personality, and be concise (no longer than 30 words).\n"
+    user_desc_original += "You don't need to recommend anything, but feel free to express your personal interests."
+    user_desc_transition += "Your response should match your profile and personality, and be concise (no longer than 30 words).\n"
+    user_desc_transition += "You don't need to recommend anything, but feel free to express your personal interests."
+    user_desc_at_transition_turn = user_desc_transition + " In this round, you must seek recommendations of type {0}, and you should shift the topic of the conversation to the content of type {0}.".format(different_type_name)
+    user_desc_at_transition_turn += "For example: 'That sounds good, but I would like to buy a type {0} instead.'".format(different_type_name)
+    user_dict = {"name": user_profile["Name"], "role_desc": user_desc_original, "role_desc_in_transition_turn": user_desc_at_transition_turn, "role_desc_after_transition_turn": user_desc_transition}
+
+    assistant_name = assistant_profile["Name"]
+    assistant_desc = f"You are {assistant_name}, a saleperson in a {domain} store.\n"
+    assistant_desc += "You are here to converse and assist {} with {} shopping.\n".format(user_profile["Name"], domain)
+    assistant_desc += "Your goal is to capture user preferences and make recommendations based on the products in the store."
+    assistant_desc += "Below are the products available in the store:\n\n"
+    assistant_desc_original = assistant_desc + products_desc + "\n"
+    assistant_desc_transition = assistant_desc + second_products_desc + "\n"
+    assistant_desc_original += "Be informative and engaging while providing insights to arouse {}'s interest.\n".format(user_profile["Name"])
+    assistant_desc_original += "Your words at each turn should be concise (no longer than 30 words).\n\n"
+    assistant_desc_transition += "Be informative and engaging while providing insights to arouse {}'s interest.\n".format(user_profile["Name"])
+    assistant_desc_transition += "Your words at each turn should be concise (no longer than 30 words).\n\n"
+    assistant_dict = {"name": assistant_name, "role_desc": assistant_desc_original, "role_desc_in_transition_turn": assistant_desc_original, "role_desc_after_transition_turn": assistant_desc_transition}
+
+    moderator_desc = "You are the moderator of a conversation. You need to determine whether the discussion between Role-S and Role-U should come to an immediate end.\n"
+    moderator_desc += "The conversation should conclude under the following two conditions:\n"
+    moderator_desc += "(1) If Role-S completes the recommendation, the user accepts the recommendation\n"
+    moderator_desc += "(2) If Role-U explicitly rejects Role-S's recommendation when Role-S has tried to recommend it for the second time.\n"
+    moderator_desc += f"(3) The conversation between the user and the system reaches the maximum number of rounds limit ({max_interaction_step} rounds)"
+    moderator_desc += "In either of these cases, the conversation should be brought to an immediate end.\n\n"
+    moderator_desc += "For example, here is a conversation:\n## {}".format(conversation_end_or_continue_sample["seed_continue"])
+    moderator_desc += "Should the conversation end? The answer is no.\n\n"
+    moderator_desc += "Here is another conversation:\n## {}".format(conversation_end_or_continue_sample["seed_end"])
+    moderator_desc += "Should the conversation end? The answer is yes."
+    terminal_condition = "Now, for the above discussion between {} (Role-S) and {} (Role-U), should the conversation end? Answer yes or no.".format(user_profile["Name"], assistant_name)
+    moderator_dict = {"role_desc": moderator_desc, "terminal_condition": terminal_condition}
+    return env_desc, user_dict, assistant_dict, moderator_dict
+
+
+def make_dialog_specs(metadata, profile_slots, num_dialogs, num_scenes, objects_per_scene):
+    names = list(metadata)
+    scenes = [{name: metadata[name] for name in random.sample(names, objects_per_scene)} for _ in range(num_scenes)]
+    specs = []
+    for _ in range(num_dialogs):
+        first, second = random.sample(scenes, 2)
+        different_type_name = random.choice([v["type"] for v in second.values()])
+        specs.append(dict(
+            domain="fashion",
+            user_profile={k: random.choice(v) for k, v in profile_slots.items()},
+            assistant_profile={k: random.choice(v) for k, v in profile_slots.items()},
+            user_personality={trait: random.choice(["outgoing", "efficient", "sensitive"]) for trait in ("agreeableness", "conscientiousness", "extraversion", "neuroticism", "openness")},
+            conversation_end_or_continue_sample={"seed_continue": "User: Hi\nAssistant: Hello\n" * 4, "seed_end": "User: Thanks, bye\n" * 4},
+            max_interaction_step=30,
+            different_type_name=different_type_name,
+            simulate_preference=simulate_user_preference(first, "fashion"),
+            second_simulate_preference=simulate_user_preference(second, "fashion", strict_preference=different_type_name),
+            objects_info=first,
+            second_objects_info=second,
+        ))
+    return specs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_dialogs", type=int, default=2000)
+    parser.add_argument("--num_scenes", type=int, default=50)
+    parser.add_argument("--objects_per_scene", type=int, default=12)
+    parser.add_argument("--fashion_metadata_path", type=str, default="./scene_info_pool/original_data/fashion_prefab_metadata_all.json")
+    parser.add_argument("--user_profiles_path", type=str, default="./seed_dataset/caches/db_slot/slot_profiles_filtered.json")
+    args = parser.parse_args()
+
+    random.seed(0)
+    with open(args.fashion_metadata_path, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    with open(args.user_profiles_path, "r", encoding="utf-8") as f:
+        profile_slots = json.load(f)
+    specs = make_dialog_specs(metadata, profile_slots, args.num_dialogs, args.num_scenes, args.objects_per_scene)
+
+    def build(render, describe_products):
+        results = []
+        for spec in specs:
+            spec = dict(spec)
+            objects_info, second_objects_info = spec.pop("objects_info"), spec.pop("second_objects_info")
+            results.append(render(products_desc=describe_products(objects_info, "fashion"),
+                                  second_products_desc=describe_products(second_objects_info, "fashion"), **spec))
+        return results
+
+    def timed(name, build):
+        start = time.perf_counter()
+        output = build()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<40} {elapsed * 1e6 / len(specs):8.1f} us/dialog", flush=True)
+        return output
+
+    outputs = [
+        timed("concatenation", lambda: build(legacy_render_instructions, reformat_objects_info)),
+        timed("templates", lambda: build(render_instructions, reformat_objects_info)),
+        timed("templates, products once per scene", lambda: build(render_instructions, describe_scene_products)),
+    ]
+    # the rendering alone, all the product descriptions are cached by now
+    outputs.append(timed("rendering only, concatenation", lambda: build(legacy_render_instructions, describe_scene_products)))
+    outputs.append(timed("rendering only, templates", lambda: build(render_instructions, describe_scene_products)))
+    print(f"identical prompts: {all(output == outputs[0] for output in outputs)}")
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Tail latency of the OpenAIChat requests without and with the resilience policy (per-call timeout and hedging),
+measured against the local stand-in server with a slow tail, and the circuit breaker failing fast when the
+server answers only errors.
+
+    python benchmarks/bench_resilience.py --num_calls 400 --slow_prob 0.05 --slow_latency 3
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from chatarena.backends.openai import OpenAIChat
+from chatarena.backends.openai_clients import configure_openai_clients
+from chatarena.backends.concurrency import percentile
+from chatarena.backends.resilience import ResiliencePolicy, CircuitBreaker, CircuitOpenError, set_resilience_policy
+from fake_openai_server import start_server
+
+MESSAGES = [{"role": "system", "content": "You are a salesperson."}, {"role": "user", "content": "Hi!"}]
+
+
+async def bench(name, server, num_calls, concurrency, policy=None):
+    set_resilience_policy(policy)
+    backend = OpenAIChat(model="gpt-4o-mini", max_tokens=20)
+    latencies = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    num_requests = server.num_requests
+
+    async def one_call():
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                # one attempt, as the tenacity retries would stretch the tail with their backoff
+                await backend._async_get_response.retry_with(stop=lambda retry_state: True)(backend, MESSAGES)
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one_call() for _ in range(num_calls)])
+    wall = time.perf_counter() - start
+    set_resilience_policy(None)
+    print(f"{name:<32} p50 {percentile(latencies, 50) * 1000:8.1f} ms   p95 {percentile(latencies, 95) * 1000:8.1f} ms   "
+          f"p99 {percentile(latencies, 99) * 1000:8.1f} ms   wall {wall:6.2f} s   requests {server.num_requests - num_requests:5d}   failed {failures}", flush=True)
+
+
+def bench_circuit_breaker(server, num_calls, failure_threshold):
+    server.options["error_rate"] = 1.0
+    breaker = CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=60.0)
+    set_resilience_policy(ResiliencePolicy(timeout=5.0, circuit_breaker=breaker))
+    backend = OpenAIChat(model="gpt-4o-mini", max_tokens=20)
+    num_requests = server.num_requests
+    rejected = 0
+    start = time.perf_counter()
+    for _ in range(num_calls):
+        try:
+            backend._get_response.retry_with(stop=lambda retry_state: True)(backend, MESSAGES)
+        except CircuitOpenError:
+            rejected += 1
+        except Exception:
+            pass
+    set_resilience_policy(None)
+    server.options["error_rate"] = 0.0
+    print(f"{'failing endpoint, circuit breaker':<32} {num_calls} calls in {time.perf_counter() - start:.2f} s, "
+          f"{server.num_requests - num_requests} requests sent, {rejected} rejected at once", flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_calls", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05, help="The base latency of the stand-in server in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--slow_prob", type=float, default=0.05, help="The probability of a slow response.")
+    parser.add_argument("--slow_latency", type=float, default=3.0, help="The extra latency of a slow response.")
+    parser.add_argument("--timeout", type=float, default=1.0, help="The per-call timeout of the policy in seconds.")
+    parser.add_argument("--hedge_percentile", type=float, default=90.0)
+    args = parser.parse_args()
+
+    server, base_url = start_server(latency=args.latency, jitter=args.jitter, slow_prob=args.slow_prob, slow_latency=args.slow_latency)
+    configure_openai_clients(base_url=base_url)
+
+    asyncio.run(bench("no policy", server, args.num_calls, args.concurrency))
+    asyncio.run(bench(f"timeout {args.timeout}s", server, args.num_calls, args.concurrency, ResiliencePolicy(timeout=args.timeout)))
+    asyncio.run(bench(f"hedge at p{args.hedge_percentile:g}", server, args.num_calls, args.concurrency, ResiliencePolicy(hedge_percentile=args.hedge_percentile)))
+    asyncio.run(bench(f"hedge at p{args.hedge_percentile:g}, timeout {args.timeout}s", server, args.num_calls, args.concurrency,
+                      ResiliencePolicy(timeout=args.timeout, hedge_percentile=args.hedge_percentile)))
+    bench_circuit_breaker(server, 50, failure_threshold=5)
+    server.shutdown()
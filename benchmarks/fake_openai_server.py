@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for the OpenAI chat completions endpoint, used by the benchmarks.
+It answers every POST .../chat/completions with a canned completion after a configurable delay,
+and can simulate a slow tail and rate limit errors.
+
+    python benchmarks/fake_openai_server.py --port 8765 --latency 0.05
+    export OPENAI_BASE_URL=http://127.0.0.1:8765/v1
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep the connections alive like the real API
+    # send the headers and the body in one segment, otherwise delayed ACKs stall the kept-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        options = self.server.options
+        with self.server.stats_lock:
+            self.server.num_requests += 1
+
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        if random.random() < options["error_rate"]:
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}})
+            return
+
+        latency = options["latency"] + random.uniform(0, options["jitter"])
+        if random.random() < options["slow_prob"]:
+            latency += options["slow_latency"]
+        time.sleep(latency)
+
+        content = options["reply"] or f"This is a reply to {len(request.get('messages', []))} messages."
+        self._send_json(200, {
+            "id": f"chatcmpl-{random.getrandbits(64):x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+        })
+
+
+def start_server(host="127.0.0.1", port=0, latency=0.0, jitter=0.0, slow_prob=0.0, slow_latency=0.0, error_rate=0.0, reply=None):
+    """Start the server in a daemon thread, and return (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.options = {"latency": latency, "jitter": jitter, "slow_prob": slow_prob, "slow_latency": slow_latency,
+                      "error_rate": error_rate, "reply": reply}
+    server.num_requests = 0
+    server.stats_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="The base latency of a response in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="A uniform random latency added to the base latency.")
+    parser.add_argument("--slow_prob", type=float, default=0.0, help="The probability of a slow response.")
+    parser.add_argument("--slow_latency", type=float, default=0.0, help="The extra latency of a slow response.")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="The probability of answering with a 429 error.")
+    args = parser.parse_args()
+    server, base_url = start_server(args.host, args.port, args.latency, args.jitter, args.slow_prob, args.slow_latency, args.error_rate)
+    print(f"Serving fake chat completions at {base_url}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
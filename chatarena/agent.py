@@ -63,12 +63,18 @@ class Player(Agent):
             second_visual_path=self.second_visual_path,
         )
 
+    def query_kwargs(self, observation: List[Message]) -> dict:
+        """
+        The arguments of the backend query that generates the response to the observation
+        """
+        return dict(agent_name=self.name, role_desc=self.role_desc, role_desc_in_transition_turn=self.role_desc_in_transition_turn, role_desc_after_transition_turn=self.role_desc_after_transition_turn, transition_turn=self.transition_turn, history_messages=observation, global_prompt=self.global_prompt, visual_path=self.visual_path, second_visual_path=self.second_visual_path, request_msg=None)
+
     def act(self, observation: List[Message]) -> str:
         """
         Call the agents to generate a response (equivalent to taking an action).
         """
         try:
-            response = self.backend.query(agent_name=self.name, role_desc=self.role_desc, role_desc_in_transition_turn=self.role_desc_in_transition_turn, role_desc_after_transition_turn=self.role_desc_after_transition_turn, transition_turn=self.transition_turn, history_messages=observation, global_prompt=self.global_prompt, visual_path=self.visual_path, second_visual_path=self.second_visual_path, request_msg=None)
+            response = self.backend.query(**self.query_kwargs(observation))
         except RetryError as e:
             logging.warning(f"Agent {self.name} failed to generate a response. "
                             f"Error: {e.last_attempt.exception()}. "
@@ -85,7 +91,7 @@ class Player(Agent):
         Async call the agents to generate a response (equivalent to taking an action).
         """
         try:
-            response = self.backend.async_query(agent_name=self.name, role_desc=self.role_desc, role_desc_in_transition_turn=self.role_desc_in_transition_turn, role_desc_after_transition_turn=self.role_desc_after_transition_turn, transition_turn=self.transition_turn, history_messages=observation, global_prompt=self.global_prompt, visual_path=self.visual_path, second_visual_path=self.second_visual_path, request_msg=None)
+            response = await self.backend.async_query(**self.query_kwargs(observation))
         except RetryError as e:
             logging.warning(f"Agent {self.name} failed to generate a response. "
                             f"Error: {e.last_attempt.exception()}. "
@@ -121,6 +127,13 @@ class Moderator(Player):
             global_prompt=self.global_prompt,
         )
 
+    def terminal_query_kwargs(self, history: List[Message]) -> dict:
+        """
+        The arguments of the backend query that asks whether the conversation is over
+        """
+        request_msg = Message(agent_name=self.name, content=self.terminal_condition, turn=-1)
+        return dict(agent_name=self.name, role_desc=self.role_desc, role_desc_in_transition_turn=self.role_desc_in_transition_turn, role_desc_after_transition_turn=self.role_desc_after_transition_turn, transition_turn=self.transition_turn, history_messages=history, global_prompt=self.global_prompt, request_msg=request_msg)
+
     def is_terminal(self, history: List[Message], *args, **kwargs) -> bool:
         """
         check whether the conversation is over
@@ -130,13 +143,33 @@ class Moderator(Player):
             return True
 
         try:
-            request_msg = Message(agent_name=self.name, content=self.terminal_condition, turn=-1)
-            response = self.backend.query(agent_name=self.name, role_desc=self.role_desc, role_desc_in_transition_turn=self.role_desc_in_transition_turn, role_desc_after_transition_turn=self.role_desc_after_transition_turn, transition_turn=self.transition_turn, history_messages=history, global_prompt=self.global_prompt, request_msg=request_msg, *args, **kwargs)
+            response = self.backend.query(*args, **self.terminal_query_kwargs(history), **kwargs)
+        except RetryError as e:
+            logging.warning(f"Agent {self.name} failed to generate a response. "
+                            f"Error: {e.last_attempt.exception()}.")
+            return True
+
+        return self._parse_decision(response)
+
+    async def async_is_terminal(self, history: List[Message], *args, **kwargs) -> bool:
+        """
+        async version of `is_terminal`
+        """
+        # If the last message is the signal, then the conversation is over
+        if history[-1].content == SIGNAL_END_OF_CONVERSATION:
+            return True
+
+        try:
+            response = await self.backend.async_query(*args, **self.terminal_query_kwargs(history), **kwargs)
         except RetryError as e:
             logging.warning(f"Agent {self.name} failed to generate a response. "
                             f"Error: {e.last_attempt.exception()}.")
             return True
 
+        return self._parse_decision(response)
+
+    @staticmethod
+    def _parse_decision(response: str) -> bool:
         if re.match(r"yes|y|yea|yeah|yep|yup|sure|ok|okay|alright", response, re.IGNORECASE):
             # print(f"Decision: {response}. Conversation is ended by moderator.")
             return True
@@ -2,6 +2,8 @@ from typing import List, Dict, Union
 import uuid
 import json
 import csv
+import time
+import asyncio
 import logging
 
 from .agent import Player
@@ -14,12 +16,66 @@ class TooManyInvalidActions(Exception):
     pass
 
 
+def estimate_tokens(text: str) -> int:
+    # about 4 characters per token for English text
+    return len(text) // 4
+
+
+class SpeculativeTurn:
+    """The next player's turn, started while the moderator checks whether the conversation is over."""
+
+    def __init__(self, player_name: str, task: asyncio.Task, prompt_tokens: int):
+        self.player_name = player_name
+        self.task = task  # resolves to (action, time it finished)
+        self.prompt_tokens = prompt_tokens
+        self.started_at = time.perf_counter()
+        self.check_finished_at = None
+
+
+class SpeculationStats:
+    """
+    What the speculative turns of an arena cost and saved. The tokens are estimated from the text of the prompts
+    and responses (the images are left out); a turn cancelled in flight wastes its prompt tokens.
+    """
+
+    def __init__(self):
+        self.checks = 0  # moderator checks overlapped with a speculative turn
+        self.used = 0
+        self.discarded = 0  # finished, but the conversation was over
+        self.cancelled = 0  # still in flight when the conversation was over
+        self.saved_seconds = 0.0
+        self.speculative_tokens = 0
+        self.wasted_tokens = 0
+
+    def update(self, other: "SpeculationStats"):
+        for key, value in vars(other).items():
+            setattr(self, key, getattr(self, key) + value)
+
+    def stats(self) -> dict:
+        return {
+            "checks": self.checks,
+            "used": self.used,
+            "discarded": self.discarded,
+            "cancelled": self.cancelled,
+            "saved_seconds": self.saved_seconds,
+            "saved_seconds_per_round": self.saved_seconds / self.checks if self.checks else 0.0,
+            "speculative_tokens": self.speculative_tokens,
+            "wasted_tokens": self.wasted_tokens,
+            "wasted_token_rate": self.wasted_tokens / self.speculative_tokens if self.speculative_tokens else 0.0,
+        }
+
+
 class Arena:
     """
     Utility class that manages the game environment and players
     """
 
-    def __init__(self, players: List[Player], environment: Environment, global_prompt: str = None):
+    def __init__(self, players: List[Player], environment: Environment, global_prompt: str = None, speculative: bool = False):
+        """
+        args:
+            speculative: in `async_run`, start the next player's turn while the moderator checks whether the
+                conversation is over, and drop it if it is
+        """
         # Create a container for the players and environment and reset the game
         self.players = players
         self.environment = environment
@@ -29,6 +85,10 @@ class Arena:
         self.uuid = uuid.uuid4()  # Generate a unique id for the game
         self.invalid_actions_retry = 5
 
+        self.speculative = speculative
+        self.speculation_stats = SpeculationStats()
+        self._speculative_turn = None
+
     @property
     def num_players(self):
         return self.environment.num_players
@@ -38,6 +98,7 @@ class Arena:
         return {player.name: player for player in self.players}
 
     def reset(self) -> TimeStep:
+        self._discard_speculative_turn()
         # Reset the environment
         self.current_timestep = self.environment.reset()
         # Reset the players
@@ -72,6 +133,86 @@ class Arena:
 
         return timestep
 
+    async def _timed_act(self, player: Player, observation):
+        action = await player.async_act(observation)
+        return action, time.perf_counter()
+
+    def _start_speculative_turn(self):
+        # The environment is already in the state of the next turn, only its terminal flag is pending
+        player_name = self.environment.get_next_player()
+        player = self.name_to_player[player_name]
+        observation = self.environment.get_observation(player_name)
+        prompt = "".join([player.global_prompt or "", player.role_desc] + [message.content for message in observation])
+        task = asyncio.ensure_future(self._timed_act(player, observation))
+        self._speculative_turn = SpeculativeTurn(player_name, task, estimate_tokens(prompt))
+
+    async def _use_speculative_turn(self, turn: SpeculativeTurn) -> str:
+        action, finished_at = await turn.task
+        self.speculation_stats.used += 1
+        self.speculation_stats.speculative_tokens += turn.prompt_tokens + estimate_tokens(action)
+        # the turn would have started when the check finished, the overlap is the time saved
+        self.speculation_stats.saved_seconds += min(finished_at, turn.check_finished_at) - turn.started_at
+        return action
+
+    def _discard_speculative_turn(self):
+        turn, self._speculative_turn = self._speculative_turn, None
+        if turn is None:
+            return
+        wasted_tokens = turn.prompt_tokens
+        if turn.task.done() and not turn.task.cancelled() and turn.task.exception() is None:
+            self.speculation_stats.discarded += 1
+            wasted_tokens += estimate_tokens(turn.task.result()[0])
+        else:
+            turn.task.cancel()
+            self.speculation_stats.cancelled += 1
+        self.speculation_stats.speculative_tokens += wasted_tokens
+        self.speculation_stats.wasted_tokens += wasted_tokens
+
+    async def async_step(self, speculate: bool = False) -> TimeStep:
+        """
+        Async version of `step`: the player's action and the environment update are awaited,
+        so that many arenas can be stepped concurrently in one event loop
+        Args:
+            speculate: start the next player's turn while the environment checks whether the conversation is over,
+                the next `async_step` then awaits it instead of querying the player; it is dropped if the
+                conversation is over
+        """
+        player_name = self.environment.get_next_player()
+        player = self.name_to_player[player_name]  # get the player object
+        observation = self.environment.get_observation(player_name)  # get the observation for the player
+
+        speculative_turn, self._speculative_turn = self._speculative_turn, None
+        if speculative_turn is not None and speculative_turn.player_name != player_name:
+            self._speculative_turn = speculative_turn
+            self._discard_speculative_turn()
+            speculative_turn = None
+
+        timestep = None
+        for i in range(self.invalid_actions_retry):  # try to take an action for a few times
+            if speculative_turn is not None:
+                action = await self._use_speculative_turn(speculative_turn)  # taken on the same observation
+                speculative_turn = None
+            else:
+                action = await player.async_act(observation)  # take an action
+            if self.environment.check_action(action, player_name):  # action is valid
+                timestep = await self.environment.async_step(player_name, action, speculate=self._start_speculative_turn if speculate else None)  # update the environment
+                if self._speculative_turn is not None:
+                    self.speculation_stats.checks += 1
+                    self._speculative_turn.check_finished_at = time.perf_counter()
+                    if timestep.terminal:
+                        self._discard_speculative_turn()
+                break
+            else:  # action is invalid
+                logging.warning(f"{player_name} made an invalid action {action}")
+                continue
+
+        if timestep is None:  # if the player made invalid actions for too many times, terminate the game
+            warning_msg = f"{player_name} has made invalid actions for {self.invalid_actions_retry} times. Terminating the game."
+            logging.warning(warning_msg)
+            raise TooManyInvalidActions(warning_msg)
+
+        return timestep
+
     def next_is_human(self):
         """
         check if the next player is human
@@ -89,6 +230,18 @@ class Arena:
             if timestep.terminal:
                 break
 
+    async def async_run(self, num_steps: int = 1):
+        """
+        async version of `run`, with the speculative turns of the arena if enabled
+        """
+        try:
+            for i in range(num_steps):
+                timestep = await self.async_step(speculate=self.speculative and i < num_steps - 1)
+                if timestep.terminal:
+                    break
+        finally:
+            self._discard_speculative_turn()
+
     @classmethod
     def from_config(cls, config: Union[str, ArenaConfig]):
         """
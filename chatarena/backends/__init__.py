@@ -6,6 +6,8 @@ from .cohere import CohereAIChat
 from .human import Human
 from .hf_transformers import TransformersConversational
 from .anthropic import Claude
+from .local_moderator import LocalModerator
+from .moderator_batcher import BatchedModerator
 
 ALL_BACKENDS = [
     Human,
@@ -13,6 +15,8 @@ ALL_BACKENDS = [
     CohereAIChat,
     TransformersConversational,
     Claude,
+    LocalModerator,
+    BatchedModerator,
 ]
 
 BACKEND_REGISTRY = {backend.type_name: backend for backend in ALL_BACKENDS}
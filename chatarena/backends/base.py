@@ -1,5 +1,6 @@
-from typing import List
+from typing import List, Tuple, Union
 from abc import abstractmethod
+import asyncio
 
 from ..config import BackendConfig, Configurable
 from ..message import Message
@@ -30,11 +31,29 @@ class IntelligenceBackend(Configurable):
               request_msg: Message = None, *args, **kwargs) -> str:
         raise NotImplementedError
 
-    @abstractmethod
     async def async_query(self, agent_name: str, role_desc: str, history_messages: List[Message],
                           global_prompt: str = None, request_msg: Message = None, *args, **kwargs) -> str:
-        """Async querying"""
-        raise NotImplementedError
+        """
+        Async querying. Backends without a native async client run the blocking query in a worker thread.
+        """
+        return await asyncio.to_thread(self.query, agent_name=agent_name, role_desc=role_desc,
+                                       history_messages=history_messages, global_prompt=global_prompt,
+                                       request_msg=request_msg, **kwargs)
+
+    @classmethod
+    def batch_query(cls, queries: List[Tuple["IntelligenceBackend", dict]]) -> List[Union[str, Exception]]:
+        """
+        Answer many queries at once, e.g. the pending turns of the dialogs of a `VectorArena`. Every query is a
+        backend of this class with the keyword arguments of its `query`, and the result of a query that failed is
+        its exception. Backends that can serve a batch faster than one query after another override it.
+        """
+        results = []
+        for backend, kwargs in queries:
+            try:
+                results.append(backend.query(**kwargs))
+            except Exception as e:
+                results.append(e)
+        return results
 
     # reset the state of the backend
     def reset(self):
@@ -42,3 +61,16 @@ class IntelligenceBackend(Configurable):
             raise NotImplementedError
         else:
             pass
+
+
+def grouped_batch_query(queries: List[Tuple[IntelligenceBackend, dict]]) -> List[Union[str, Exception]]:
+    """Answer queries to backends of different classes, with one `batch_query` per class."""
+    results = [None] * len(queries)
+    groups = {}  # backend class -> (query index, query)
+    for idx, query in enumerate(queries):
+        groups.setdefault(type(query[0]), []).append((idx, query))
+    for backend_cls, indexed_queries in groups.items():
+        answers = backend_cls.batch_query([query for _, query in indexed_queries])
+        for (idx, _), answer in zip(indexed_queries, answers):
+            results[idx] = answer
+    return results
@@ -0,0 +1,160 @@
+from typing import List, Optional
+import time
+import asyncio
+import collections
+
+DEFAULT_INITIAL_LIMIT = 8
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 256
+DEFAULT_DECREASE_FACTOR = 0.5
+# The p95 latency is checked every this many requests
+DEFAULT_LATENCY_WINDOW = 50
+# The p95 latency of a window above this multiple of the best one seen counts as an overload
+DEFAULT_LATENCY_TOLERANCE = 2.0
+# The statuses that mean the provider is overloaded, the other errors do not change the limit
+OVERLOAD_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def is_overload_error(error: Exception) -> bool:
+    """A rate limit error, a server error or a timeout of the OpenAI client."""
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code in OVERLOAD_STATUS_CODES
+    return isinstance(error, (asyncio.TimeoutError, TimeoutError)) or "Timeout" in type(error).__name__
+
+
+def percentile(values: List[float], q: float) -> float:
+    """The `q`-th percentile (0-100) of the values, by the nearest rank."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100.0 * len(ordered))) - 1))]
+
+
+class ConcurrencyDecision:
+    def __init__(self, at: float, old_limit: int, new_limit: int, reason: str):
+        self.at = at
+        self.old_limit = old_limit
+        self.new_limit = new_limit
+        self.reason = reason  # "increase", "overload" or "latency"
+
+    def to_dict(self) -> dict:
+        return {"at": self.at, "old_limit": self.old_limit, "new_limit": self.new_limit, "reason": self.reason}
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    An AIMD limit on the requests in flight in an event loop. The limit grows by one after `limit` successful
+    requests while it is in use, and is multiplied by `decrease_factor` on a 429, a 5xx or a timeout, or when the
+    p95 latency of the last `latency_window` requests exceeds `latency_tolerance` times the best p95 seen so
+    far. The requests started before a decrease do not decrease it again, so a burst of errors counts once.
+    `limit` is the current limit and `history` the decisions, oldest first.
+    """
+
+    def __init__(self, initial_limit: int = DEFAULT_INITIAL_LIMIT, min_limit: int = DEFAULT_MIN_LIMIT,
+                 max_limit: int = DEFAULT_MAX_LIMIT, decrease_factor: float = DEFAULT_DECREASE_FACTOR,
+                 latency_window: int = DEFAULT_LATENCY_WINDOW, latency_tolerance: float = DEFAULT_LATENCY_TOLERANCE):
+        self.limit = max(min_limit, min(initial_limit, max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_window = latency_window
+        self.latency_tolerance = latency_tolerance
+        self.history: List[ConcurrencyDecision] = []
+
+        self.in_flight = 0
+        self.requests = 0
+        self.overloads = 0
+        self.best_p95 = None
+        self._latencies = []  # of the current window
+        self._successes = 0  # since the last increase
+        self._last_decrease_at = 0.0
+        self._waiters = collections.deque()
+
+    def _set_limit(self, limit: int, reason: str):
+        limit = max(self.min_limit, min(limit, self.max_limit))
+        if limit != self.limit:
+            self.history.append(ConcurrencyDecision(time.time(), self.limit, limit, reason))
+            self.limit = limit
+            self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    async def acquire(self) -> float:
+        """Wait for a free slot, and return the time the request starts."""
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.in_flight -= 1  # the slot was handed over as the request was cancelled
+                    self._wake()
+                raise
+        return time.time()
+
+    def release(self, started_at: float, error: Optional[Exception] = None):
+        """Free the slot of a request that started at `started_at`, and update the limit with its outcome."""
+        saturated = self.in_flight >= self.limit
+        self.in_flight -= 1
+        self.requests += 1
+        if error is not None and is_overload_error(error):
+            self.overloads += 1
+            if started_at >= self._last_decrease_at:
+                self._decrease("overload")
+        elif error is None:
+            self._record_latency(time.time() - started_at)
+            if saturated:
+                self._successes += 1
+                if self._successes >= self.limit:
+                    self._successes = 0
+                    self._set_limit(self.limit + 1, "increase")
+        self._wake()
+
+    def _decrease(self, reason: str):
+        self._successes = 0
+        self._last_decrease_at = time.time()
+        self._set_limit(int(self.limit * self.decrease_factor), reason)
+
+    def _record_latency(self, latency: float):
+        self._latencies.append(latency)
+        if len(self._latencies) < self.latency_window:
+            return
+        p95 = percentile(self._latencies, 95)
+        self._latencies = []
+        if self.best_p95 is not None and p95 > self.latency_tolerance * self.best_p95:
+            self._decrease("latency")
+        else:
+            self.best_p95 = p95 if self.best_p95 is None else min(self.best_p95, p95)
+
+    def stats(self) -> dict:
+        limits = [self.limit] + [decision.old_limit for decision in self.history]
+        return {
+            "limit": self.limit,
+            "min_limit_reached": min(limits),
+            "max_limit_reached": max(limits),
+            "requests": self.requests,
+            "overloads": self.overloads,
+            "increases": sum(decision.reason == "increase" for decision in self.history),
+            "decreases": sum(decision.reason != "increase" for decision in self.history),
+            "best_p95": self.best_p95,
+        }
+
+
+# The limiter of the async runner, shared by the OpenAI backends of its event loop
+_concurrency_limiter: Optional[AdaptiveConcurrencyLimiter] = None
+
+
+def set_concurrency_limiter(limiter: Optional[AdaptiveConcurrencyLimiter]):
+    global _concurrency_limiter
+    _concurrency_limiter = limiter
+
+
+def get_concurrency_limiter() -> Optional[AdaptiveConcurrencyLimiter]:
+    return _concurrency_limiter
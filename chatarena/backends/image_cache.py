@@ -0,0 +1,77 @@
+from collections import OrderedDict
+import os
+import base64
+import threading
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def read_and_encode_image(image_path: str) -> str:
+    with open(image_path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode('utf-8')
+
+
+class EncodedImageCache:
+    """
+    A bounded LRU cache of base64-encoded images, keyed by path, modification time and size,
+    so that a file rewritten in place (e.g. a recompressed image) is encoded again.
+    The same scene images are sent with every turn of a dialog and across the dialogs sharing a scene.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0  # bytes read from disk on misses
+        self.bytes_saved = 0  # bytes of encoded images served from the cache instead of re-encoding them
+
+    def get(self, image_path: str) -> str:
+        stat = os.stat(image_path)
+        key = (os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.bytes_saved += len(encoded)
+                return encoded
+
+        encoded = read_and_encode_image(image_path)
+        with self._lock:
+            self.misses += 1
+            self.bytes_read += stat.st_size
+            if key not in self._entries and len(encoded) <= self.max_bytes:
+                self._entries[key] = encoded
+                self._total_bytes += len(encoded)
+                while self._total_bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._total_bytes -= len(evicted)
+        return encoded
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "bytes_read": self.bytes_read,
+                "bytes_saved": self.bytes_saved,
+            }
+
+
+# Shared by all the backends of the process
+_image_cache = EncodedImageCache()
+
+
+def get_image_cache() -> EncodedImageCache:
+    return _image_cache
@@ -0,0 +1,248 @@
+from typing import List, Union, Optional, Tuple
+import re
+import math
+import json
+import threading
+from collections import Counter
+
+from .base import IntelligenceBackend, grouped_batch_query
+from ..config import BackendConfig
+from ..message import Message
+
+# The answers of the backend, parsed by `Moderator._parse_decision` as for an LLM moderator
+ANSWER_YES = "yes"
+ANSWER_NO = "no"
+
+# The user (the last speaker of a round) accepts a recommendation or takes leave
+DEFAULT_END_PATTERNS = (
+    r"\bi(?:'ll| will)\s+(?:take|buy|get|go with|purchase)\s+(?:it|them|this|that|those|these|one|the\b)",
+    r"\b(?:sounds|looks) (?:perfect|great)[,.!]?\s+(?:thanks|thank you)\b",
+    r"\b(?:goodbye|bye)\b",
+    r"\bthat(?:'s| is) all (?:i need|for (?:now|today))\b",
+    r"\bhave a (?:nice|great|good) day\b",
+)
+# The user is still asking for something
+DEFAULT_CONTINUE_PATTERNS = (
+    r"\?\s*$",
+    r"\b(?:could|can) you (?:show|tell|recommend|suggest)\b",
+    r"\b(?:do you have|what about|how about|anything else)\b",
+)
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9']+|[?!]")
+# The rounds are bucketed, a dialog rarely ends later than this
+_MAX_ROUND_FEATURE = 10
+
+
+def _tokenize(text: str) -> List[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def round_features(previous: str, last: str, num_rounds: int) -> List[str]:
+    """
+    The features of the latest round of a dialog: the words of its two messages (`previous` then `last`), the
+    word pairs of the last one and the number of rounds so far.
+    """
+    previous_tokens, last_tokens = _tokenize(previous), _tokenize(last)
+    features = {f"p:{token}" for token in previous_tokens}
+    features.update(f"l:{token}" for token in last_tokens)
+    features.update(f"l:{a}_{b}" for a, b in zip(last_tokens, last_tokens[1:]))
+    features.add(f"round:{min(num_rounds, _MAX_ROUND_FEATURE)}")
+    return sorted(features)
+
+
+class TerminalClassifier:
+    """
+    A naive Bayes classifier over the features of the latest round of a dialog (see `round_features`), trained on
+    the generated dialogs to predict whether the moderator ends the dialog after this round.
+    """
+
+    def __init__(self, alpha: float = 1.0, class_counts=None, feature_counts=None):
+        self.alpha = alpha
+        self.class_counts = list(class_counts or [0, 0])  # [continue, end]
+        self.feature_counts = [Counter(counts) for counts in (feature_counts or [{}, {}])]
+        self._update_log_probs()
+
+    def _update_log_probs(self):
+        num_examples = sum(self.class_counts)
+        vocab_size = len(set(self.feature_counts[0]) | set(self.feature_counts[1]))
+        self._log_priors = [math.log((count + self.alpha) / (num_examples + 2 * self.alpha)) for count in self.class_counts]
+        self._log_denominators = [math.log(sum(counts.values()) + self.alpha * (vocab_size + 1)) for counts in self.feature_counts]
+
+    def fit(self, examples: List[List[str]], labels: List[bool]):
+        for features, label in zip(examples, labels):
+            self.class_counts[int(label)] += 1
+            self.feature_counts[int(label)].update(features)
+        self._update_log_probs()
+        return self
+
+    def predict_proba(self, features: List[str]) -> float:
+        """The probability that the dialog ends after the round."""
+        scores = []
+        for label in (0, 1):
+            counts = self.feature_counts[label]
+            score = self._log_priors[label]
+            for feature in features:
+                score += math.log(counts.get(feature, 0) + self.alpha) - self._log_denominators[label]
+            scores.append(score)
+        return 1.0 / (1.0 + math.exp(max(min(scores[0] - scores[1], 700.0), -700.0)))
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"alpha": self.alpha, "class_counts": self.class_counts,
+                       "feature_counts": [dict(counts) for counts in self.feature_counts]}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(alpha=data["alpha"], class_counts=data["class_counts"], feature_counts=data["feature_counts"])
+
+
+# The classifiers are loaded once per process, every dialog has its own moderator backend
+_classifiers = {}
+_classifiers_lock = threading.Lock()
+
+
+def get_terminal_classifier(path: str) -> TerminalClassifier:
+    with _classifiers_lock:
+        if path not in _classifiers:
+            _classifiers[path] = TerminalClassifier.load(path)
+        return _classifiers[path]
+
+
+class LocalModeratorStats:
+    """How the moderator checks of the process were decided: by the rules, by the classifier or by the LLM fallback."""
+
+    def __init__(self):
+        self.rules = 0
+        self.classifier = 0
+        self.fallback = 0
+        self.undecided = 0  # uncertain without a fallback, answered "no"
+        self._lock = threading.Lock()
+
+    def record(self, source: str):
+        with self._lock:
+            setattr(self, source, getattr(self, source) + 1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            checks = self.rules + self.classifier + self.fallback + self.undecided
+            avoided = checks - self.fallback
+            return {
+                "checks": checks,
+                "rules": self.rules,
+                "classifier": self.classifier,
+                "fallback": self.fallback,
+                "undecided": self.undecided,
+                "avoided_calls": avoided,
+                "avoided_rate": avoided / checks if checks else 0.0,
+            }
+
+
+_local_moderator_stats = LocalModeratorStats()
+
+
+def get_local_moderator_stats() -> LocalModeratorStats:
+    return _local_moderator_stats
+
+
+class LocalModerator(IntelligenceBackend):
+    """
+    A moderator backend that decides whether a dialog should end without an API call when it can: first with the
+    end and continue patterns matched against the last message, then with a `TerminalClassifier` when its
+    probability is at least `threshold` (or at most 1 - `threshold`). The uncertain checks are sent to the
+    `fallback` backend, usually the LLM moderator, or answered "no" when there is none.
+    The patterns only see the last message, the user's answer that closes the round: an end the user agrees to
+    without saying so (e.g. "Thanks!" after the salesperson's goodbye) is left to the classifier, which sees both
+    messages of the round, and to the fallback.
+    """
+    stateful = False
+    type_name = "local-moderator"
+
+    def __init__(self, fallback: Union[BackendConfig, IntelligenceBackend] = None, classifier_path: str = None,
+                 threshold: float = 0.95, min_rounds: int = 0, end_patterns=DEFAULT_END_PATTERNS,
+                 continue_patterns=DEFAULT_CONTINUE_PATTERNS, **kwargs):
+        """
+        args:
+            fallback: the backend (or its config) that answers the uncertain checks
+            classifier_path: a classifier saved by `TerminalClassifier.save`, the rules alone decide without one
+            threshold: the probability the classifier needs to decide on its own
+            min_rounds: the dialogs shorter than this number of rounds always continue, without a check (0: every round is checked)
+            end_patterns, continue_patterns: the regular expressions matched against the last message
+        """
+        if isinstance(fallback, BackendConfig):
+            from . import load_backend
+            fallback = load_backend(fallback)
+        super().__init__(fallback=fallback.to_config() if fallback is not None else None, classifier_path=classifier_path,
+                         threshold=threshold, min_rounds=min_rounds, end_patterns=list(end_patterns),
+                         continue_patterns=list(continue_patterns), **kwargs)
+        self.fallback = fallback
+        self.classifier = get_terminal_classifier(classifier_path) if classifier_path else None
+        self.threshold = threshold
+        self.min_rounds = min_rounds
+        self.end_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in end_patterns]
+        self.continue_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in continue_patterns]
+
+    def decide(self, history_messages: List[Message]) -> Tuple[Optional[str], str]:
+        """
+        Returns:
+            (answer, source) where answer is "yes", "no" or None when the check is uncertain, and source is "rules"
+            or "classifier"
+        """
+        num_rounds = len(history_messages) // 2
+        if num_rounds < self.min_rounds or len(history_messages) == 0:
+            return ANSWER_NO, "rules"
+        last = history_messages[-1].content
+        ends = any(pattern.search(last) for pattern in self.end_patterns)
+        continues = any(pattern.search(last) for pattern in self.continue_patterns)
+        if ends != continues:
+            return (ANSWER_YES if ends else ANSWER_NO), "rules"
+
+        if self.classifier is not None:
+            previous = history_messages[-2].content if len(history_messages) > 1 else ""
+            probability = self.classifier.predict_proba(round_features(previous, last, num_rounds))
+            if probability >= self.threshold:
+                return ANSWER_YES, "classifier"
+            if probability <= 1 - self.threshold:
+                return ANSWER_NO, "classifier"
+        return None, "fallback"
+
+    def query(self, agent_name: str, role_desc: str, history_messages: List[Message], global_prompt: str = None,
+              request_msg: Message = None, *args, **kwargs) -> str:
+        answer, source = self.decide(history_messages)
+        if answer is None and self.fallback is None:
+            answer, source = ANSWER_NO, "undecided"
+        get_local_moderator_stats().record(source)
+        if answer is not None:
+            return answer
+        return self.fallback.query(agent_name=agent_name, role_desc=role_desc, history_messages=history_messages,
+                                   global_prompt=global_prompt, request_msg=request_msg, *args, **kwargs)
+
+    @classmethod
+    def batch_query(cls, queries: List[Tuple["LocalModerator", dict]]) -> List[Union[str, Exception]]:
+        """The checks decided locally are answered at once, the uncertain ones go to `batch_query` of their fallbacks."""
+        results = [None] * len(queries)
+        fallback_queries = []  # (query index, (fallback, kwargs))
+        for idx, (backend, kwargs) in enumerate(queries):
+            answer, source = backend.decide(kwargs["history_messages"])
+            if answer is None and backend.fallback is None:
+                answer, source = ANSWER_NO, "undecided"
+            get_local_moderator_stats().record(source)
+            if answer is not None:
+                results[idx] = answer
+            else:
+                fallback_queries.append((idx, (backend.fallback, kwargs)))
+        for (idx, _), answer in zip(fallback_queries, grouped_batch_query([query for _, query in fallback_queries])):
+            results[idx] = answer
+        return results
+
+    async def async_query(self, agent_name: str, role_desc: str, history_messages: List[Message],
+                          global_prompt: str = None, request_msg: Message = None, *args, **kwargs) -> str:
+        answer, source = self.decide(history_messages)
+        if answer is None and self.fallback is None:
+            answer, source = ANSWER_NO, "undecided"
+        get_local_moderator_stats().record(source)
+        if answer is not None:
+            return answer
+        return await self.fallback.async_query(agent_name=agent_name, role_desc=role_desc, history_messages=history_messages,
+                                               global_prompt=global_prompt, request_msg=request_msg, *args, **kwargs)
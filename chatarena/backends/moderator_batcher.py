@@ -0,0 +1,300 @@
+from typing import List, Optional, Tuple, Union
+import re
+import json
+import asyncio
+import logging
+import threading
+import weakref
+
+from .base import IntelligenceBackend, grouped_batch_query
+from .openai import OpenAIChat
+from ..config import BackendConfig
+from ..message import Message
+
+DEFAULT_MAX_BATCH_SIZE = 16
+DEFAULT_MAX_WAIT = 0.05  # seconds
+# The answer of a batch is a JSON object of about this many tokens per dialog
+MAX_TOKENS_PER_CHECK = 8
+
+BATCH_INSTRUCTION = (
+    "You will now be given several independent conversations, each with an id, and a question about each of them. "
+    "Apply the rules above to every conversation separately."
+)
+# The dialogs of a batch have their own moderator instructions (few-shot examples, round limit), each conversation
+# then refers to its instructions, which are given once for all the conversations that share them
+BATCH_INSTRUCTION_PER_CONVERSATION = (
+    "You will now be given several sets of moderator instructions, several independent conversations, each with an id "
+    "and the set of instructions it follows, and a question about each of them. Apply to every conversation its own "
+    "instructions only, separately from the others."
+)
+BATCH_ANSWER_FORMAT = 'Answer with a JSON object that maps every conversation id to "yes" or "no", e.g. {"1": "no", "2": "yes"}.'
+
+_JSON_OBJECT_PATTERN = re.compile(r"\{.*\}", re.DOTALL)
+
+
+def moderator_instructions(query_kwargs: dict) -> str:
+    """The system prompt of a check without the batch: the global prompt and the moderator role."""
+    global_prompt = query_kwargs.get("global_prompt")
+    return f"{global_prompt.strip()}\n\n{query_kwargs['role_desc']}" if global_prompt else query_kwargs["role_desc"]
+
+
+def format_batch_messages(checks: List["PendingCheck"]) -> List[dict]:
+    """
+    One chat request with the conversations of all the checks, numbered from 1. The moderator instructions are sent
+    once in the system prompt when all the checks share them, otherwise every distinct set is numbered and each
+    conversation refers to its own.
+    """
+    instructions = {}  # moderator instructions -> their number
+    for check in checks:
+        instructions.setdefault(moderator_instructions(check.query_kwargs), len(instructions) + 1)
+    parts = []
+    if len(instructions) > 1:
+        parts += [f"Instructions {number}:\n{text}" for text, number in instructions.items()]
+    for check_id, check in enumerate(checks, start=1):
+        conversation = "\n".join(f"[{message.agent_name}]: {message.content}" for message in check.history_messages)
+        header = f"Conversation {check_id}"
+        if len(instructions) > 1:
+            header += f" (follows Instructions {instructions[moderator_instructions(check.query_kwargs)]})"
+        parts.append(f"{header}:\n{conversation}\nQuestion {check_id}: {check.terminal_condition}")
+    system_prompt = f"{next(iter(instructions))}\n\n{BATCH_INSTRUCTION}" if len(instructions) == 1 else BATCH_INSTRUCTION_PER_CONVERSATION
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": "\n\n".join(parts) + f"\n\n{BATCH_ANSWER_FORMAT}"},
+    ]
+
+
+def parse_batch_answers(response: str) -> dict:
+    """conversation id -> "yes" or "no", the ids with another answer (or none) are left out"""
+    match = _JSON_OBJECT_PATTERN.search(response)
+    if match is None:
+        return {}
+    try:
+        answers = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(answers, dict):
+        return {}
+    return {str(check_id): answer.strip().lower() for check_id, answer in answers.items()
+            if isinstance(answer, str) and answer.strip().lower() in ("yes", "no")}
+
+
+class PendingCheck:
+    def __init__(self, backend: IntelligenceBackend, terminal_condition: str, history_messages: List[Message],
+                 query_kwargs: dict, future: asyncio.Future = None):
+        self.backend = backend
+        self.terminal_condition = terminal_condition
+        self.history_messages = list(history_messages)  # the pool keeps growing while the check waits
+        self.query_kwargs = dict(query_kwargs, history_messages=self.history_messages)
+        self.future = future
+
+
+class ModeratorBatcherStats:
+    """How the moderator checks of the process were sent: in batch requests, or one by one after a failed batch."""
+
+    def __init__(self):
+        self.checks = 0
+        self.requests = 0  # the batch requests and the single checks
+        self.batched_checks = 0  # the checks answered by a batch request
+        self.fallbacks = 0  # the checks sent again on their own
+        self._lock = threading.Lock()
+
+    def record(self, **counts):
+        with self._lock:
+            for key, count in counts.items():
+                setattr(self, key, getattr(self, key) + count)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "checks": self.checks,
+                "requests": self.requests,
+                "batched_checks": self.batched_checks,
+                "fallbacks": self.fallbacks,
+                "checks_per_request": self.checks / self.requests if self.requests else 0.0,
+            }
+
+
+class ModeratorBatcher:
+    """
+    Collects the end-of-round checks of the dialogs running in an event loop, and sends the checks of the same
+    model in one request once `max_batch_size` of them are pending or `max_wait` seconds after the first one.
+    The moderator instructions are sent once per distinct set in the batch, followed by every conversation with
+    the set it follows and its question, and the LLM answers yes or no per conversation id in a JSON object.
+    A check the answer leaves out, or the checks of a failed batch, are sent again on their own with the
+    original moderator prompt.
+    """
+
+    def __init__(self, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE, max_wait: float = DEFAULT_MAX_WAIT):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = {}  # (model, temperature) -> checks
+        self._timers = {}
+        self._tasks = set()
+
+    async def check(self, backend: IntelligenceBackend, role_desc: str, terminal_condition: str,
+                    history_messages: List[Message], query_kwargs: dict) -> str:
+        loop = asyncio.get_running_loop()
+        key = (backend.model, backend.temperature)
+        check = PendingCheck(backend, terminal_condition, history_messages, dict(query_kwargs, role_desc=role_desc), loop.create_future())
+        pending = self._pending.setdefault(key, [])
+        pending.append(check)
+        get_moderator_batcher_stats().record(checks=1)
+        if len(pending) >= self.max_batch_size:
+            self._flush(key)
+        elif len(pending) == 1:
+            self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+        return await check.future
+
+    def _flush(self, key):
+        checks = self._pending.pop(key, [])
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        checks = [check for check in checks if not check.future.done()]  # a cancelled dialog drops its check
+        if checks:
+            task = asyncio.ensure_future(self._send(checks))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send_one(self, check: PendingCheck):
+        try:
+            response = await check.backend.async_query(**check.query_kwargs)
+        except Exception as e:  # e.g. the RetryError that ends the dialog
+            if not check.future.done():
+                check.future.set_exception(e)
+        else:
+            if not check.future.done():
+                check.future.set_result(response)
+
+    async def _send(self, checks: List[PendingCheck]):
+        if len(checks) == 1:
+            get_moderator_batcher_stats().record(requests=1)
+            await self._send_one(checks[0])
+            return
+
+        backend = checks[0].backend
+        messages = format_batch_messages(checks)
+        try:
+            response = await backend._async_cached_get_response(messages, max_tokens=MAX_TOKENS_PER_CHECK * (len(checks) + 2))
+            answers = parse_batch_answers(response)
+        except Exception as e:
+            logging.warning(f"The batch of {len(checks)} moderator checks failed, sending them one by one. Error: {e!r}")
+            answers = {}
+        get_moderator_batcher_stats().record(requests=1)
+
+        retries = []
+        for check_id, check in enumerate(checks, start=1):
+            answer = answers.get(str(check_id))
+            if answer is None:
+                retries.append(check)
+            elif not check.future.done():
+                check.future.set_result(answer)
+        get_moderator_batcher_stats().record(batched_checks=len(checks) - len(retries), fallbacks=len(retries), requests=len(retries))
+        await asyncio.gather(*[self._send_one(check) for check in retries])
+
+
+def _batch_answers(checks: List[PendingCheck], response: Union[str, Exception]) -> List[Optional[str]]:
+    """The answers of the checks of a batch request, None for the checks it left out."""
+    if isinstance(response, Exception):
+        logging.warning(f"The batch of {len(checks)} moderator checks failed, sending them one by one. Error: {response!r}")
+        answers = {}
+    else:
+        answers = parse_batch_answers(response)
+    answers = [answers.get(str(check_id)) for check_id in range(1, len(checks) + 1)]
+    num_missing = answers.count(None)
+    get_moderator_batcher_stats().record(requests=1 + num_missing, batched_checks=len(checks) - num_missing, fallbacks=num_missing)
+    return answers
+
+
+# Each event loop has its own batchers since the futures belong to a loop
+_batchers = weakref.WeakKeyDictionary()
+_batcher_stats = ModeratorBatcherStats()
+
+
+def get_moderator_batcher(max_batch_size: int = DEFAULT_MAX_BATCH_SIZE, max_wait: float = DEFAULT_MAX_WAIT) -> ModeratorBatcher:
+    """The batcher with these options shared by the moderators of the dialogs running in the current event loop."""
+    loop = asyncio.get_running_loop()
+    batchers = _batchers.setdefault(loop, {})
+    key = (max_batch_size, max_wait)
+    if key not in batchers:
+        batchers[key] = ModeratorBatcher(max_batch_size=max_batch_size, max_wait=max_wait)
+    return batchers[key]
+
+
+def get_moderator_batcher_stats() -> ModeratorBatcherStats:
+    return _batcher_stats
+
+
+class BatchedModerator(IntelligenceBackend):
+    """
+    A moderator backend that sends its async checks through the `ModeratorBatcher` of the event loop, to be
+    answered together with the checks of the other dialogs. `backend` (an `OpenAIChat`) answers the batches and
+    the checks sent on their own; the sync queries go to it directly.
+    """
+    stateful = False
+    type_name = "batched-moderator"
+
+    def __init__(self, backend: Union[BackendConfig, IntelligenceBackend], max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_wait: float = DEFAULT_MAX_WAIT, **kwargs):
+        """
+        args:
+            backend: the backend (or its config) that answers the checks
+            max_batch_size: the max number of checks in one request
+            max_wait: how long (in seconds) the first check of a batch waits for the others
+        """
+        if isinstance(backend, BackendConfig):
+            from . import load_backend
+            backend = load_backend(backend)
+        super().__init__(backend=backend.to_config(), max_batch_size=max_batch_size, max_wait=max_wait, **kwargs)
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+    def query(self, *args, **kwargs) -> str:
+        return self.backend.query(*args, **kwargs)
+
+    @classmethod
+    def batch_query(cls, queries: List[Tuple["BatchedModerator", dict]]) -> List[Union[str, Exception]]:
+        """
+        The checks are already gathered: the checks of the same model are sent `max_batch_size` at a time in batch
+        requests, as by the `ModeratorBatcher`, and the checks a batch leaves out are sent again on their own.
+        """
+        results = [None] * len(queries)
+        groups = {}  # (model, temperature, max_batch_size) -> (query index, check)
+        direct = []  # the queries that are not end-of-round checks
+        for idx, (backend, kwargs) in enumerate(queries):
+            if kwargs.get("request_msg") is None:
+                direct.append((idx, (backend.backend, kwargs)))
+                continue
+            check = PendingCheck(backend.backend, kwargs["request_msg"].content, kwargs["history_messages"], kwargs)
+            groups.setdefault((backend.backend.model, backend.backend.temperature, backend.max_batch_size), []).append((idx, check))
+        get_moderator_batcher_stats().record(checks=sum(len(checks) for checks in groups.values()))
+
+        batches = []
+        for (_, _, max_batch_size), checks in groups.items():
+            batches += [checks[start:start + max_batch_size] for start in range(0, len(checks), max_batch_size)]
+        retries = [batch[0] for batch in batches if len(batch) == 1]
+        batches = [batch for batch in batches if len(batch) > 1]
+        get_moderator_batcher_stats().record(requests=len(retries))
+        if batches:
+            requests = [(batch[0][1].backend, format_batch_messages([check for _, check in batch]),
+                         MAX_TOKENS_PER_CHECK * (len(batch) + 2)) for batch in batches]
+            for batch, response in zip(batches, OpenAIChat.batch_get_responses(requests)):
+                answers = _batch_answers([check for _, check in batch], response)
+                for (idx, check), answer in zip(batch, answers):
+                    if answer is None:
+                        retries.append((idx, check))
+                    else:
+                        results[idx] = answer
+        singles = [(idx, (check.backend, check.query_kwargs)) for idx, check in retries] + direct
+        for (idx, _), answer in zip(singles, grouped_batch_query([query for _, query in singles])):
+            results[idx] = answer
+        return results
+
+    async def async_query(self, agent_name: str, role_desc: str, history_messages: List[Message],
+                          global_prompt: str = None, request_msg: Message = None, *args, **kwargs) -> str:
+        if request_msg is None:
+            return await self.backend.async_query(agent_name=agent_name, role_desc=role_desc, history_messages=history_messages,
+                                                  global_prompt=global_prompt, request_msg=request_msg, *args, **kwargs)
+        query_kwargs = dict(kwargs, agent_name=agent_name, global_prompt=global_prompt, request_msg=request_msg)
+        return await get_moderator_batcher(self.max_batch_size, self.max_wait).check(self.backend, role_desc, request_msg.content, history_messages, query_kwargs)
@@ -1,15 +1,22 @@
-from typing import List
+from typing import List, Optional, Tuple, Union
 import os
 import re
 import logging
-from tenacity import retry, stop_after_attempt, wait_random, wait_random_exponential
-import base64
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random, wait_random_exponential
 from .base import IntelligenceBackend
+from .image_cache import get_image_cache
+from .response_cache import get_response_cache
+from .openai_clients import get_openai_client, get_async_openai_client
+from .openai_batch import get_batch_job_runner
+from .rate_limit import get_rate_limiter, estimate_request_tokens
+from .concurrency import get_concurrency_limiter
+from .resilience import get_resilience_policy, CircuitOpenError
 from ..message import Message, SYSTEM_NAME, MODERATOR_NAME
 from colorama import Fore, Style
 try:
     import openai
-    from openai import OpenAI
 except ImportError:
     is_openai_available = False
     logging.warning("openai package is not installed")
@@ -29,10 +36,87 @@ DEFAULT_MODEL = "gpt-3.5-turbo"
 END_OF_MESSAGE = "<EOS>"  # End of message token specified by us not OpenAI
 STOP = ("<|endoftext|>", END_OF_MESSAGE)  # End of sentence token
 BASE_PROMPT = f"The messages always end with the token {END_OF_MESSAGE}."
+# The max number of requests of a `batch_query` in flight at once
+BATCH_QUERY_THREADS = 32
+
+def _is_retryable(error: BaseException) -> bool:
+    # A cancellation or an interrupt ends the call, and an open circuit rejects the retries as well
+    return isinstance(error, Exception) and not isinstance(error, CircuitOpenError)
 
 def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    # The encoded images are cached, the same scene images are sent at every turn
+    return get_image_cache().get(image_path)
+
+class MessageBuilder:
+    """
+    Builds the chat completion messages of one agent turn after turn. The messages of the history are formatted
+    and merged once, each turn only appends the new ones; everything is rebuilt when the system prompt or the
+    image changes (a new phase of the dialog) or when the history is not the continuation of the previous one.
+    """
+
+    def __init__(self, agent_name: str, merge_other_agent_as_user: bool = True):
+        self.agent_name = agent_name
+        self.merge_other_agent_as_user = merge_other_agent_as_user
+        self.system_prompt = None
+        self.base64_image = None
+        self.messages = []
+        self._history = []  # the history messages already in `messages`
+
+    def _append(self, messages: List[dict], name: str, content: str):
+        # The merged messages are replaced rather than modified, the lists returned by `build` share them
+        if name == self.agent_name:
+            messages.append({"role": "assistant", "content": content})
+            return
+        last = messages[-1]
+        if last["role"] == "user":  # last message is from user
+            if self.merge_other_agent_as_user:
+                text = f"{last['content']}\n\n[{name}]: {content}"
+                if self.base64_image is not None:
+                    messages[-1] = {"role": "user", "content": [{"type": "text", "text": text}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{self.base64_image}"}}]}
+                else:
+                    messages[-1] = {"role": "user", "content": text}
+            else:
+                if self.base64_image is not None:
+                    messages.append({"role": "user", "content": [{"type": "text", "text": f"[{name}]: {content}"}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{self.base64_image}"}}]})
+                else:
+                    messages.append({"role": "user", "content": f"[{name}]: {content}"})
+        elif last["role"] == "assistant":  # consecutive assistant messages
+            # Merge the assistant messages
+            messages[-1] = {"role": "assistant", "content": f"{last['content']}\n{content}"}
+        elif last["role"] == "system":
+            messages.append({"role": "user", "content": f"[{name}]: {content}"})
+        else:
+            raise ValueError(f"Invalid role: {last['role']}")
+
+    def _is_continuation(self, history_messages: List[Message]) -> bool:
+        if len(history_messages) < len(self._history):
+            return False
+        for (msg, agent_name, content), new_msg in zip(self._history, history_messages):
+            if msg is not new_msg or new_msg.agent_name != agent_name or new_msg.content != content:
+                return False
+        return True
+
+    def update(self, system_prompt: str, base64_image: str, history_messages: List[Message], merge_other_agent_as_user: bool = True):
+        if (system_prompt != self.system_prompt or base64_image != self.base64_image
+                or merge_other_agent_as_user != self.merge_other_agent_as_user or not self._is_continuation(history_messages)):
+            self.merge_other_agent_as_user = merge_other_agent_as_user
+            self.system_prompt = system_prompt
+            self.base64_image = base64_image
+            self.messages = [{"role": "system", "content": system_prompt}]
+            self._history = []
+        for msg in history_messages[len(self._history):]:
+            if msg.agent_name == SYSTEM_NAME:
+                self._append(self.messages, SYSTEM_NAME, msg.content)
+            else:  # non-system messages are suffixed with the end of message token
+                self._append(self.messages, msg.agent_name, f"{msg.content}{END_OF_MESSAGE}")
+            self._history.append((msg, msg.agent_name, msg.content))
+
+    def build(self, request) -> List[dict]:
+        """The messages of the history followed by the request (name, content), in a new list."""
+        messages = list(self.messages)
+        self._append(messages, *request)
+        return messages
+
 
 class OpenAIChat(IntelligenceBackend):
     """
@@ -59,27 +143,125 @@ class OpenAIChat(IntelligenceBackend):
         self.max_tokens = max_tokens
         self.model = model
         self.merge_other_agent_as_user = merge_other_agents_as_one_user
+        self._message_builders = {}  # agent name -> MessageBuilder
 
-    @retry(stop=stop_after_attempt(5), wait=wait_random_exponential(min=1, max=60))  # Modified retry strategy
-    def _get_response(self, messages):
-        client = OpenAI(
-            api_key=os.environ.get("OPENAI_API_KEY"),
-            base_url="https://api.openai.com/v1/chat/completions",
-        )
-        chat_completion = client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            temperature=self.temperature,
-            max_tokens=self.max_tokens,
-            stop=STOP,  
-        )
-        response = chat_completion.choices[0].message.content
+    @staticmethod
+    def _request_client(client, retries: bool = True):
+        # the client with the per-call timeout of the resilience policy; without its own retries when they are left to tenacity
+        policy = get_resilience_policy()
+        options = {}
+        if policy is not None and policy.timeout is not None:
+            options.update(timeout=policy.timeout, max_retries=0)
+        if not retries:
+            options.update(max_retries=0)
+        return client.with_options(**options) if options else client
+
+    @retry(stop=stop_after_attempt(5), wait=wait_random_exponential(min=1, max=60), retry=retry_if_exception(_is_retryable))  # Modified retry strategy
+    def _get_response(self, messages, max_tokens: int = None):
+        # max_tokens overrides the one of the backend for this request
+        max_tokens = self.max_tokens if max_tokens is None else max_tokens
+        limiter = get_rate_limiter()
+        tokens = estimate_request_tokens(messages, max_tokens) if limiter is not None else 0
+        if limiter is not None:
+            # every attempt waits for the budget, a retry after a 429 too
+            limiter.acquire(tokens)
+        client = self._request_client(get_openai_client())
+        requests_sent = itertools.count()
+
+        def create():
+            if limiter is not None and next(requests_sent) > 0:
+                # a hedge of the resilience policy is a request of its own, it waits for its budget as well
+                limiter.acquire(tokens)
+            chat_completion = client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=self.temperature,
+                max_tokens=max_tokens,
+                stop=STOP,
+            )
+            return chat_completion.choices[0].message.content
+
+        policy = get_resilience_policy()
+        response = policy.call(create) if policy is not None else create()
         response = response.strip()
         return response
 
-    def query(self, agent_name: str, role_desc: str, role_desc_in_transition_turn: str, role_desc_after_transition_turn: str, transition_turn: int, history_messages: List[Message], global_prompt: str = None, request_msg: Message = None, visual_path: str = None, second_visual_path: str = None, *args, **kwargs) -> str:
+    @retry(stop=stop_after_attempt(5), wait=wait_random_exponential(min=1, max=60), retry=retry_if_exception(_is_retryable))
+    async def _async_get_response(self, messages, max_tokens: int = None):
+        max_tokens = self.max_tokens if max_tokens is None else max_tokens
+        limiter = get_rate_limiter()
+        tokens = estimate_request_tokens(messages, max_tokens) if limiter is not None else 0
+        if limiter is not None:
+            await limiter.async_acquire(tokens)
+        concurrency_limiter = get_concurrency_limiter()
+        # with a concurrency limiter the retries are left to tenacity, so that the limiter sees every 429
+        client = self._request_client(get_async_openai_client(), retries=concurrency_limiter is None)
+        requests_sent = itertools.count()
+
+        async def request():
+            chat_completion = await client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=self.temperature,
+                max_tokens=max_tokens,
+                stop=STOP,
+            )
+            return chat_completion.choices[0].message.content
+
+        async def create():
+            if next(requests_sent) == 0:
+                return await request()  # the budget and the slot were taken before the call, out of its deadline
+            # a hedge of the resilience policy is a request of its own, it waits for its budget and holds a slot as well
+            if limiter is not None:
+                await limiter.async_acquire(tokens)
+            return await limited(request)
+
+        async def limited(send):
+            started_at = await concurrency_limiter.acquire() if concurrency_limiter is not None else None
+            try:
+                response = await send()
+            except BaseException as e:  # a cancelled request frees its slot too
+                if concurrency_limiter is not None:
+                    concurrency_limiter.release(started_at, e)
+                raise
+            if concurrency_limiter is not None:
+                concurrency_limiter.release(started_at)
+            return response
+
+        policy = get_resilience_policy()
+        response = await limited(lambda: policy.async_call(create) if policy is not None else create())
+        response = response.strip()
+        return response
+
+    def _cache_key(self, messages, max_tokens: int = None):
+        return get_response_cache().make_key(self.model, messages, self.temperature, self.max_tokens if max_tokens is None else max_tokens, STOP)
+
+    def _cached_get_response(self, messages, *args, **kwargs):
+        # A cache hit skips the network (and the retries) entirely
+        cache = get_response_cache()
+        if cache is None:
+            return self._get_response(messages, *args, **kwargs)
+        key = self._cache_key(messages, kwargs.get("max_tokens"))
+        response = cache.get(key)
+        if response is None:
+            response = self._get_response(messages, *args, **kwargs)
+            cache.put(key, response)
+        return response
+
+    async def _async_cached_get_response(self, messages, *args, **kwargs):
+        cache = get_response_cache()
+        if cache is None:
+            return await self._async_get_response(messages, *args, **kwargs)
+        key = self._cache_key(messages, kwargs.get("max_tokens"))
+        response = cache.get(key)
+        if response is None:
+            response = await self._async_get_response(messages, *args, **kwargs)
+            cache.put(key, response)
+        return response
+
+    def _build_messages(self, agent_name: str, role_desc: str, role_desc_in_transition_turn: str, role_desc_after_transition_turn: str, transition_turn: int, history_messages: List[Message], global_prompt: str = None, request_msg: Message = None, visual_path: str = None, second_visual_path: str = None) -> List[dict]:
         """
-        format the input and call the ChatGPT/GPT-4 API
+        format the input into the chat completion messages
         args:
             agent_name: the name of the agent
             role_desc: the description of the role of the agent
@@ -92,105 +274,126 @@ class OpenAIChat(IntelligenceBackend):
             second_visual_path: the path of the second visual information for the agent
             request_msg: the request from the system to guide the agent's next response
         """
+        # The system prompt and the image depend on the phase of the dialog: the first scene is shown before the
+        # transition turn, the second scene from the transition turn on. The messages are the system prompt,
+        # the history and the request.
+        num_messages = len(history_messages) + 2
+        if num_messages <= transition_turn*2-1:
+            phase_role_desc = role_desc
+            final_visual_path = visual_path
+        elif num_messages == transition_turn*2 or num_messages == transition_turn*2+1:
+            phase_role_desc = role_desc_in_transition_turn
+            final_visual_path = second_visual_path
+        elif num_messages > transition_turn*2+1:
+            phase_role_desc = role_desc_after_transition_turn
+            final_visual_path = second_visual_path
+        else:
+            raise ValueError(f"Invalid length of all messages: {num_messages}")
 
         # Merge the role description and the global prompt as the system prompt for the agent
         if global_prompt:  # Prepend the global prompt if it exists
-            system_prompt = f"{global_prompt.strip()}\n\nYour name: {agent_name}\n\nYour role: {role_desc}"
-            system_prompt_in_transition_turn = f"{global_prompt.strip()}\n\nYour name: {agent_name}\n\nYour role: {role_desc_in_transition_turn}"
-            system_prompt_after_transition_turn = f"{global_prompt.strip()}\n\nYour name: {agent_name}\n\nYour role: {role_desc_after_transition_turn}"
+            system_prompt = f"{global_prompt.strip()}\n\nYour name: {agent_name}\n\nYour role: {phase_role_desc}"
         else:
-            system_prompt = f"You are {agent_name}.\n\nYour role: {role_desc}"
-            system_prompt_in_transition_turn = f"You are {agent_name}.\n\nYour role: {role_desc_in_transition_turn}"
-            system_prompt_after_transition_turn = f"You are {agent_name}.\n\nYour role: {role_desc_after_transition_turn}"
-
-        all_messages = [(SYSTEM_NAME, system_prompt)]
-        all_messages_in_transition_turn = [(SYSTEM_NAME, system_prompt_in_transition_turn)]
-        all_messages_after_transition_turn = [(SYSTEM_NAME, system_prompt_after_transition_turn)]
-        for msg in history_messages:
-            if msg.agent_name == SYSTEM_NAME:
-                all_messages.append((SYSTEM_NAME, msg.content))
-                all_messages_in_transition_turn.append((SYSTEM_NAME, msg.content))
-                all_messages_after_transition_turn.append((SYSTEM_NAME, msg.content))
-            else:  # non-system messages are suffixed with the end of message token
-                all_messages.append((msg.agent_name, f"{msg.content}{END_OF_MESSAGE}"))
-                all_messages_in_transition_turn.append((msg.agent_name, f"{msg.content}{END_OF_MESSAGE}"))
-                all_messages_after_transition_turn.append((msg.agent_name, f"{msg.content}{END_OF_MESSAGE}"))
+            system_prompt = f"You are {agent_name}.\n\nYour role: {phase_role_desc}"
 
-        if request_msg is not None:
-            all_messages.append((SYSTEM_NAME, request_msg.content))
-            all_messages_in_transition_turn.append((SYSTEM_NAME, request_msg.content))
-            all_messages_after_transition_turn.append((SYSTEM_NAME, request_msg.content))
-        else:  # The default request message that reminds the agent its role and instruct it to speak
-            all_messages.append((SYSTEM_NAME, f"Now you speak, {agent_name}.{END_OF_MESSAGE}"))
-            all_messages_in_transition_turn.append((SYSTEM_NAME, f"Now you speak, {agent_name}.{END_OF_MESSAGE}"))
-            all_messages_after_transition_turn.append((SYSTEM_NAME, f"Now you speak, {agent_name}.{END_OF_MESSAGE}"))
-
-        # Add the visual information if it exists
+        # Add the visual information if it exists, only the image of the current turn is encoded
         if visual_path is not None and os.path.exists(visual_path):
-            base64_image = encode_image(visual_path)
-            base64_image_in_transition_turn = encode_image(second_visual_path)
-            base64_image_after_transition_turn = encode_image(second_visual_path)
-        else:
-            base64_image = None
-            base64_image_in_transition_turn = None
-            base64_image_after_transition_turn = None
-            
-        messages = []
-        
-        # print (Fore.GREEN + f"All Messages: \n{all_messages}" + Style.RESET_ALL + "\n")
-        # print (Fore.GREEN + f"All Messages In Transition Turn: \n{all_messages_in_transition_turn}" + Style.RESET_ALL + "\n")
-        # print (Fore.GREEN + f"All Messages After Transition Turn: \n{all_messages_after_transition_turn}" + Style.RESET_ALL + "\n")
-
-        if len(all_messages) <= transition_turn*2-1:
-            final_use_messages = all_messages
-            final_base64_image = base64_image
-        elif len(all_messages) == transition_turn*2 or len(all_messages) == transition_turn*2+1:
-            final_use_messages = all_messages_in_transition_turn
-            final_base64_image = base64_image_in_transition_turn
-        elif len(all_messages) > transition_turn*2+1:
-            final_use_messages = all_messages_after_transition_turn
-            final_base64_image = base64_image_after_transition_turn
+            final_base64_image = encode_image(final_visual_path)
         else:
-            raise ValueError(f"Invalid length of all messages: {len(all_messages)}")
-        
-        for i, msg in enumerate(final_use_messages):
-            if i == 0:
-                assert msg[0] == SYSTEM_NAME  # The first message should be from the system
-                messages.append({"role": "system", "content": msg[1]})
-            else:
-                if msg[0] == agent_name:
-                    messages.append({"role": "assistant", "content": msg[1]})
-                else:
-                    if messages[-1]["role"] == "user":  # last message is from user
-                        if self.merge_other_agent_as_user:
-                            if final_base64_image is not None:
-                                messages[-1]["content"] = [{"type": "text", "text": f"{messages[-1]['content']}\n\n[{msg[0]}]: {msg[1]}"}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{final_base64_image}"}}]
-                            else:
-                                messages[-1]["content"] = f"{messages[-1]['content']}\n\n[{msg[0]}]: {msg[1]}"
-                        else:
-                            if final_base64_image is not None:
-                                messages.append({"role": "user", "content": [{"type": "text", "text": f"[{msg[0]}]: {msg[1]}"}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{final_base64_image}"}}]})
-                            else:
-                                messages.append({"role": "user", "content": f"[{msg[0]}]: {msg[1]}"})
-                    elif messages[-1]["role"] == "assistant":  # consecutive assistant messages
-                        # Merge the assistant messages
-                        messages[-1]["content"] = f"{messages[-1]['content']}\n{msg[1]}"
-                    elif messages[-1]["role"] == "system":
-                        messages.append({"role": "user", "content": f"[{msg[0]}]: {msg[1]}"})
-                    else:
-                        raise ValueError(f"Invalid role: {messages[-1]['role']}")
-
-        # print (Fore.GREEN + f"Now the agent is {agent_name}" + Style.RESET_ALL)
-        # print (Fore.GREEN + f"Messages: \n{messages}" + Style.RESET_ALL)
-        # input("Press Enter to continue...")
-        
-
-        response = self._get_response(messages, *args, **kwargs)
+            final_base64_image = None
+
+        builder = self._message_builders.get(agent_name)
+        if builder is None:
+            builder = self._message_builders[agent_name] = MessageBuilder(agent_name, self.merge_other_agent_as_user)
+        builder.update(system_prompt, final_base64_image, history_messages, merge_other_agent_as_user=self.merge_other_agent_as_user)
+
+        if request_msg is not None:
+            request = (SYSTEM_NAME, request_msg.content)
+        else:  # The default request message that reminds the agent its role and instruct it to speak
+            request = (SYSTEM_NAME, f"Now you speak, {agent_name}.{END_OF_MESSAGE}")
+        return builder.build(request)
 
+    @staticmethod
+    def _clean_response(response: str, agent_name: str) -> str:
         # Remove the agent name if the response starts with it
         response = re.sub(rf"^\s*\[.*]:", "", response).strip()
         response = re.sub(rf"^\s*{re.escape(agent_name)}\s*:", "", response).strip()
         # Remove the tailing end of message token
         response = re.sub(rf"{END_OF_MESSAGE}$", "", response).strip()
-        
+
         return response
+
+    def query(self, agent_name: str, role_desc: str, role_desc_in_transition_turn: str, role_desc_after_transition_turn: str, transition_turn: int, history_messages: List[Message], global_prompt: str = None, request_msg: Message = None, visual_path: str = None, second_visual_path: str = None, *args, **kwargs) -> str:
+        """
+        format the input and call the ChatGPT/GPT-4 API
+        args: see `_build_messages`
+        """
+        messages = self._build_messages(agent_name, role_desc, role_desc_in_transition_turn, role_desc_after_transition_turn, transition_turn, history_messages, global_prompt=global_prompt, request_msg=request_msg, visual_path=visual_path, second_visual_path=second_visual_path)
+        response = self._cached_get_response(messages, *args, **kwargs)
+        return self._clean_response(response, agent_name)
+
+    def _request_body(self, messages, max_tokens: int = None) -> dict:
+        # the body of the chat completion request of `_get_response`, as a line of a batch file
+        return {"model": self.model, "messages": messages, "temperature": self.temperature,
+                "max_tokens": self.max_tokens if max_tokens is None else max_tokens, "stop": list(STOP)}
+
+    @classmethod
+    def batch_get_responses(cls, requests: List[Tuple["OpenAIChat", List[dict], Optional[int]]]) -> List[Union[str, Exception]]:
+        """
+        The responses of many (backend, messages, max_tokens) requests. The requests missing from the response cache
+        are sent as one batch job when a `BatchJobRunner` is set, otherwise concurrently with the shared client,
+        `BATCH_QUERY_THREADS` at a time. The requests a batch job fails are sent again as regular requests.
+        """
+        def send(request):
+            backend, messages, max_tokens = request
+            try:
+                return backend._cached_get_response(messages, max_tokens=max_tokens)
+            except Exception as e:
+                return e
+
+        results = [None] * len(requests)
+        remaining = list(range(len(requests)))
+        runner = get_batch_job_runner()
+        if runner is not None and requests:
+            cache = get_response_cache()
+            keys = [backend._cache_key(messages, max_tokens) if cache is not None else None for backend, messages, max_tokens in requests]
+            remaining = []
+            for idx, key in enumerate(keys):
+                results[idx] = cache.get(key) if cache is not None else None
+                if results[idx] is None:
+                    remaining.append(idx)
+            responses = runner.run([requests[idx][0]._request_body(requests[idx][1], requests[idx][2]) for idx in remaining])
+            for idx, response in zip(remaining, responses):
+                if not isinstance(response, Exception):
+                    results[idx] = response
+                    if cache is not None:
+                        cache.put(keys[idx], response)
+            remaining = [idx for idx in remaining if results[idx] is None]
+            if remaining:
+                logging.warning(f"{len(remaining)} requests of the batch job failed, sending them again.")
+
+        if remaining:
+            with ThreadPoolExecutor(max_workers=min(BATCH_QUERY_THREADS, len(remaining))) as executor:
+                for idx, response in zip(remaining, executor.map(send, [requests[idx] for idx in remaining])):
+                    results[idx] = response
+        return results
+
+    @classmethod
+    def batch_query(cls, queries: List[Tuple["OpenAIChat", dict]]) -> List[Union[str, Exception]]:
+        """
+        Every backend builds the messages of its queries (so it keeps its message builders), then the requests
+        are sent together by `batch_get_responses`.
+        args: see `IntelligenceBackend.batch_query`, the keyword arguments are those of `_build_messages`
+        """
+        responses = cls.batch_get_responses([(backend, backend._build_messages(**kwargs), None) for backend, kwargs in queries])
+        return [response if isinstance(response, Exception) else backend._clean_response(response, kwargs["agent_name"])
+                for (backend, kwargs), response in zip(queries, responses)]
+
+    async def async_query(self, agent_name: str, role_desc: str, role_desc_in_transition_turn: str, role_desc_after_transition_turn: str, transition_turn: int, history_messages: List[Message], global_prompt: str = None, request_msg: Message = None, visual_path: str = None, second_visual_path: str = None, *args, **kwargs) -> str:
+        """
+        async version of `query`, the request is sent with the async OpenAI client
+        args: see `_build_messages`
+        """
+        messages = self._build_messages(agent_name, role_desc, role_desc_in_transition_turn, role_desc_after_transition_turn, transition_turn, history_messages, global_prompt=global_prompt, request_msg=request_msg, visual_path=visual_path, second_visual_path=second_visual_path)
+        response = await self._async_cached_get_response(messages, *args, **kwargs)
+        return self._clean_response(response, agent_name)
@@ -0,0 +1,226 @@
+from typing import Callable, List, Optional, Union
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+
+from .openai_clients import get_openai_client
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+DEFAULT_POLL_INTERVAL = 30.0  # seconds
+# The Batch API accepts up to 50,000 requests per batch file
+MAX_REQUESTS_PER_BATCH = 50000
+# The statuses after which a batch does not change anymore
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchRequestError(Exception):
+    """A request of a batch job that did not get a completion."""
+
+
+def _write_json(path: str, data: dict):
+    # The state files are replaced at once, a crash leaves the previous version
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class OpenAIBatchTransport:
+    """Uploads the batch files and submits the batches to the OpenAI Batch API with the shared client."""
+
+    def upload(self, path: str) -> str:
+        with open(path, "rb") as f:
+            return get_openai_client().files.create(file=f, purpose="batch").id
+
+    def submit(self, input_file_id: str) -> str:
+        return get_openai_client().batches.create(input_file_id=input_file_id, endpoint=BATCH_ENDPOINT,
+                                                  completion_window=BATCH_COMPLETION_WINDOW).id
+
+    def status(self, batch_id: str) -> dict:
+        batch = get_openai_client().batches.retrieve(batch_id)
+        return {"status": batch.status, "output_file_id": batch.output_file_id, "error_file_id": batch.error_file_id}
+
+    def download(self, file_id: str) -> str:
+        return get_openai_client().files.content(file_id).text
+
+
+class LocalBatchTransport:
+    """
+    A file-based stand-in for the Batch API, e.g. for the tests. The files and the batches are kept in `root_dir`,
+    and a batch is run when it is first polled: every request body is answered by `respond(body)`, by default a
+    regular chat completion request, and the output and error files are written in the format of the Batch API.
+    """
+
+    def __init__(self, root_dir: str, respond: Callable[[dict], str] = None):
+        self.root_dir = root_dir
+        self.respond = respond or self._chat_completion
+        os.makedirs(root_dir, exist_ok=True)
+
+    @staticmethod
+    def _chat_completion(body: dict) -> str:
+        return get_openai_client().chat.completions.create(**body).choices[0].message.content
+
+    def _path(self, object_id: str) -> str:
+        return os.path.join(self.root_dir, f"{object_id}.jsonl" if object_id.startswith("file-") else f"{object_id}.json")
+
+    def _write_file(self, lines: List[dict]) -> Optional[str]:
+        if not lines:
+            return None
+        file_id = f"file-{uuid.uuid4().hex}"
+        with open(self._path(file_id), "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(line, ensure_ascii=False) + "\n" for line in lines)
+        return file_id
+
+    def upload(self, path: str) -> str:
+        with open(path, "r", encoding="utf-8") as f:
+            return self._write_file([json.loads(line) for line in f if line.strip()])
+
+    def submit(self, input_file_id: str) -> str:
+        batch_id = f"batch-{uuid.uuid4().hex}"
+        _write_json(self._path(batch_id), {"status": "validating", "input_file_id": input_file_id,
+                                           "output_file_id": None, "error_file_id": None})
+        return batch_id
+
+    def status(self, batch_id: str) -> dict:
+        with open(self._path(batch_id), "r", encoding="utf-8") as f:
+            batch = json.load(f)
+        if batch["status"] in FINAL_STATUSES:
+            return batch
+
+        outputs, errors = [], []
+        for request in (json.loads(line) for line in self.download(batch["input_file_id"]).splitlines() if line.strip()):
+            try:
+                content = self.respond(request["body"])
+            except Exception as e:
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "response": None,
+                               "error": {"code": type(e).__name__, "message": str(e)}})
+                continue
+            outputs.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "error": None,
+                            "response": {"status_code": 200, "body": {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]}}})
+        batch.update(status="completed", output_file_id=self._write_file(outputs), error_file_id=self._write_file(errors))
+        _write_json(self._path(batch_id), batch)
+        return batch
+
+    def download(self, file_id: str) -> str:
+        with open(self._path(file_id), "r", encoding="utf-8") as f:
+            return f.read()
+
+
+class BatchJobStats:
+    def __init__(self):
+        self.jobs = 0  # the batch_query calls sent as batch jobs, i.e. the turns
+        self.batches = 0
+        self.requests = 0
+        self.failed_requests = 0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, **counts):
+        with self._lock:
+            for key, count in counts.items():
+                setattr(self, key, getattr(self, key) + count)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "jobs": self.jobs,
+                "batches": self.batches,
+                "requests": self.requests,
+                "failed_requests": self.failed_requests,
+                "wait_seconds": self.wait_seconds,
+            }
+
+
+class BatchJobRunner:
+    """
+    Runs chat completion requests as batch jobs: the request bodies are written to a JSONL batch file in
+    `batch_dir`, uploaded and submitted through `transport`, and polled every `poll_interval` seconds until the
+    batch is over. The id of a submitted batch is saved next to its file, so a run restarted with the same
+    requests waits for the batch it submitted instead of submitting it again.
+    """
+
+    def __init__(self, transport, batch_dir: str, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 max_requests_per_batch: int = MAX_REQUESTS_PER_BATCH):
+        self.transport = transport
+        self.batch_dir = batch_dir
+        self.poll_interval = poll_interval
+        self.max_requests_per_batch = max_requests_per_batch
+        self.stats = BatchJobStats()
+        os.makedirs(batch_dir, exist_ok=True)
+
+    def _submit(self, bodies: List[dict]) -> str:
+        lines = [json.dumps({"custom_id": f"request-{idx}", "method": "POST", "url": BATCH_ENDPOINT, "body": body},
+                            ensure_ascii=False, sort_keys=True) for idx, body in enumerate(bodies)]
+        digest = hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()[:16]
+        input_path = os.path.join(self.batch_dir, f"batch_{digest}.jsonl")
+        state_path = os.path.join(self.batch_dir, f"batch_{digest}.json")
+        if os.path.exists(state_path):
+            with open(state_path, "r", encoding="utf-8") as f:
+                return json.load(f)["batch_id"]
+
+        with open(input_path, "w", encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in lines)
+        batch_id = self.transport.submit(self.transport.upload(input_path))
+        _write_json(state_path, {"batch_id": batch_id, "num_requests": len(bodies), "submitted_at": time.time()})
+        return batch_id
+
+    def _results(self, batch: dict, num_requests: int) -> List[Union[str, Exception]]:
+        results = [BatchRequestError(f"The batch ended with the status {batch['status']} without this request.")] * num_requests
+        for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+            if not file_id:
+                continue
+            for line in self.transport.download(file_id).splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                idx = int(item["custom_id"].rsplit("-", 1)[1])
+                response = item.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[idx] = response["body"]["choices"][0]["message"]["content"].strip()
+                else:
+                    error = item.get("error") or response.get("body", {}).get("error") or {}
+                    results[idx] = BatchRequestError(f"{response.get('status_code')}: {error.get('message')}")
+        return results
+
+    def run(self, bodies: List[dict]) -> List[Union[str, Exception]]:
+        """The responses of the chat completion request bodies, or the errors of the requests that failed."""
+        if not bodies:
+            return []
+        started = time.time()
+        chunks = [bodies[start:start + self.max_requests_per_batch] for start in range(0, len(bodies), self.max_requests_per_batch)]
+        pending = {self._submit(chunk): idx for idx, chunk in enumerate(chunks)}
+        chunk_results = [None] * len(chunks)
+        while True:
+            for batch_id, idx in list(pending.items()):
+                batch = self.transport.status(batch_id)
+                if batch["status"] in FINAL_STATUSES:
+                    if batch["status"] != "completed":
+                        logging.warning(f"Batch {batch_id} ended with the status {batch['status']}.")
+                    chunk_results[idx] = self._results(batch, len(chunks[idx]))
+                    del pending[batch_id]
+            if not pending:
+                break
+            time.sleep(self.poll_interval)
+
+        results = [result for chunk in chunk_results for result in chunk]
+        self.stats.record(jobs=1, batches=len(chunks), requests=len(results), wait_seconds=time.time() - started,
+                          failed_requests=sum(isinstance(result, Exception) for result in results))
+        return results
+
+
+# The runner is shared by all the OpenAI backends of the process, the turns are sent as requests unless it is set
+_batch_job_runner: Optional[BatchJobRunner] = None
+
+
+def set_batch_job_runner(runner: Optional[BatchJobRunner]):
+    global _batch_job_runner
+    _batch_job_runner = runner
+
+
+def get_batch_job_runner() -> Optional[BatchJobRunner]:
+    return _batch_job_runner
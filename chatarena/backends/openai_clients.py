@@ -0,0 +1,82 @@
+import os
+import asyncio
+import threading
+import weakref
+
+try:
+    import httpx
+    from openai import OpenAI, AsyncOpenAI
+except ImportError:
+    pass  # openai.py reports the missing package
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1/chat/completions"
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 20
+DEFAULT_TIMEOUT = 600.0
+
+# Options of the clients shared by all the OpenAI backends of the process
+_client_options = {
+    "base_url": None,  # falls back to the OPENAI_BASE_URL environment variable, then DEFAULT_BASE_URL
+    "max_connections": DEFAULT_MAX_CONNECTIONS,
+    "max_keepalive_connections": DEFAULT_MAX_KEEPALIVE_CONNECTIONS,
+    "timeout": DEFAULT_TIMEOUT,
+}
+_client = None
+# httpx async connections belong to the event loop that opened them, so there is one async client per loop
+_async_clients = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def configure_openai_clients(base_url: str = None, max_connections: int = None, max_keepalive_connections: int = None,
+                             timeout: float = None):
+    """
+    Set the options of the shared clients. The clients created before are dropped and recreated lazily.
+    """
+    global _client
+    with _lock:
+        for key, value in (("base_url", base_url), ("max_connections", max_connections),
+                           ("max_keepalive_connections", max_keepalive_connections), ("timeout", timeout)):
+            if value is not None:
+                _client_options[key] = value
+        if _client is not None:
+            _client.close()
+        _client = None
+        _async_clients.clear()
+
+
+def _client_kwargs():
+    return {
+        "api_key": os.environ.get("OPENAI_API_KEY"),
+        "base_url": _client_options["base_url"] or os.environ.get("OPENAI_BASE_URL") or DEFAULT_BASE_URL,
+        "timeout": _client_options["timeout"],
+    }
+
+
+def _limits():
+    return httpx.Limits(max_connections=_client_options["max_connections"],
+                        max_keepalive_connections=_client_options["max_keepalive_connections"])
+
+
+def get_openai_client() -> "OpenAI":
+    """The OpenAI client shared by all the backends, its connection pool keeps the connections alive between calls."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                kwargs = _client_kwargs()
+                _client = OpenAI(http_client=httpx.Client(limits=_limits(), timeout=kwargs["timeout"]), **kwargs)
+    return _client
+
+
+def get_async_openai_client() -> "AsyncOpenAI":
+    """The async OpenAI client shared by all the backends running in the current event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        with _lock:
+            client = _async_clients.get(loop)
+            if client is None:
+                kwargs = _client_kwargs()
+                client = AsyncOpenAI(http_client=httpx.AsyncClient(limits=_limits(), timeout=kwargs["timeout"]), **kwargs)
+                _async_clients[loop] = client
+    return client
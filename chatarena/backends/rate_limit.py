@@ -0,0 +1,175 @@
+from typing import List, Optional
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:  # e.g. on Windows, the limiter is then per process
+    fcntl = None
+
+# A bucket holds the budget of this many seconds, the requests can burst up to it after an idle period
+DEFAULT_BURST_SECONDS = 10.0
+# The inline images are small JPEGs (see SMALL_IMAGE_TARGET_SIZE_KB), about one 512px tile at auto detail
+IMAGE_TOKENS = 255
+# The formatting tokens of every message of a chat request
+TOKENS_PER_MESSAGE = 4
+
+
+def estimate_request_tokens(messages: List[dict], max_tokens: int) -> int:
+    """
+    The tokens a chat request counts against the TPM budget: about 4 characters per token of the prompt, the
+    images, and `max_tokens` for the completion since the API counts it when the request comes in.
+    """
+    tokens = max_tokens or 0
+    for message in messages:
+        tokens += TOKENS_PER_MESSAGE
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content:
+            tokens += len(part["text"]) // 4 if part["type"] == "text" else IMAGE_TOKENS
+    return tokens
+
+
+class RateLimiterStats:
+    def __init__(self):
+        self.requests = 0
+        self.tokens = 0
+        self.waits = 0  # the requests that had to wait for the budget
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, tokens: int, wait: float):
+        with self._lock:
+            self.requests += 1
+            self.tokens += tokens
+            if wait > 0:
+                self.waits += 1
+                self.wait_seconds += wait
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "tokens": self.tokens,
+                "waits": self.waits,
+                "wait_seconds": self.wait_seconds,
+            }
+
+
+class RateLimiter:
+    """
+    Token buckets for the requests per minute (`rpm`) and the estimated tokens per minute (`tpm`) of the OpenAI
+    backends, a limit left to None is not enforced. A request reserves its budget in both buckets at once, the
+    balance may go negative, and the request waits until the reservation is covered, so the requests start in
+    the order they came and the rate stays just under the limits.
+    With a `state_path`, the buckets are kept in that JSON file and locked with fcntl, so all the processes using
+    the same file share the budget, e.g. the workers of a run.
+    """
+
+    def __init__(self, rpm: float = None, tpm: float = None, state_path: str = None, burst_seconds: float = DEFAULT_BURST_SECONDS):
+        self.limits = {"requests": rpm, "tokens": tpm}
+        self.burst_seconds = burst_seconds
+        if state_path is not None and fcntl is None:
+            logging.warning("fcntl is not available, the rate limits are not shared with the other processes.")
+            state_path = None
+        self.state_path = state_path
+        self.stats = RateLimiterStats()
+        self._state = {}  # bucket name -> {"balance", "updated_at"}, the buckets of this process without a state path
+        self._lock = threading.Lock()
+        self._refunds = set()
+
+    def _capacity(self, limit: float) -> float:
+        return limit * self.burst_seconds / 60.0
+
+    def _reserve_in(self, state: dict, amounts: dict, now: float) -> float:
+        """
+        Reserve the amounts in the buckets of `state`, a negative amount gives budget back, and return how long to
+        wait until they are covered.
+        """
+        wait = 0.0
+        for name, amount in amounts.items():
+            limit = self.limits[name]
+            if not limit:
+                continue
+            rate = limit / 60.0
+            capacity = self._capacity(limit)
+            bucket = state.get(name) or {"balance": capacity, "updated_at": now}
+            balance = min(capacity, min(capacity, bucket["balance"] + (now - bucket["updated_at"]) * rate) - amount)
+            state[name] = {"balance": balance, "updated_at": now}
+            wait = max(wait, -balance / rate)
+        return wait
+
+    def _update(self, amounts: dict) -> float:
+        with self._lock:
+            if self.state_path is None:
+                return self._reserve_in(self._state, amounts, time.time())
+            with open(self.state_path + ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    state = {}
+                    if os.path.exists(self.state_path):
+                        with open(self.state_path, "r", encoding="utf-8") as f:
+                            try:
+                                state = json.load(f)
+                            except json.JSONDecodeError:  # cut off by a crash, start with full buckets
+                                state = {}
+                    wait = self._reserve_in(state, amounts, time.time())
+                    tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+                    with open(tmp_path, "w", encoding="utf-8") as f:
+                        json.dump(state, f)
+                    os.replace(tmp_path, self.state_path)
+                    return wait
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _reserve(self, tokens: int) -> float:
+        return self._update({"requests": 1, "tokens": tokens})
+
+    def _refund(self, tokens: int):
+        self._update({"requests": -1, "tokens": -tokens})
+
+    def acquire(self, tokens: int):
+        """Wait until a request of about `tokens` tokens fits in the budget."""
+        wait = self._reserve(tokens)
+        self.stats.record(tokens, wait)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def async_acquire(self, tokens: int):
+        """
+        async version of `acquire`, the state file is locked in a thread. A request cancelled before its budget is
+        covered gives its reservation back, the requests that reserved after it still wait their turn.
+        """
+        reservation = asyncio.ensure_future(asyncio.to_thread(self._reserve, tokens))
+        try:
+            wait = await asyncio.shield(reservation)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            refund = asyncio.ensure_future(self._async_refund(reservation, tokens))
+            self._refunds.add(refund)  # the loop keeps only weak references to the tasks
+            refund.add_done_callback(self._refunds.discard)
+            raise
+        self.stats.record(tokens, wait)
+
+    async def _async_refund(self, reservation: "asyncio.Future", tokens: int):
+        await reservation  # the reservation runs on in its thread when the waiter is cancelled
+        await asyncio.to_thread(self._refund, tokens)
+
+# The limiter is shared by all the OpenAI backends of the process, the requests are not limited unless it is set
+_rate_limiter: Optional[RateLimiter] = None
+
+
+def set_rate_limiter(limiter: Optional[RateLimiter]):
+    global _rate_limiter
+    _rate_limiter = limiter
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    return _rate_limiter
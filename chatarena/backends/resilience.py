@@ -0,0 +1,304 @@
+from typing import Awaitable, Callable, Optional, Tuple, TypeVar
+import time
+import asyncio
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
+
+try:
+    from openai import APITimeoutError
+except ImportError:
+    APITimeoutError = None  # openai.py reports the missing package
+
+from .concurrency import is_overload_error, percentile
+
+T = TypeVar("T")
+
+# The hedging percentile is estimated from the latencies of this many recent calls, once there are enough
+LATENCY_WINDOW = 500
+DEFAULT_HEDGE_MIN_SAMPLES = 20
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0  # seconds
+# The threads of the sync calls and their hedges
+MAX_CALL_THREADS = 64
+
+
+class CircuitOpenError(Exception):
+    """The endpoint failed too many times in a row, the call is rejected without a request."""
+
+
+def is_endpoint_failure(error: Exception) -> bool:
+    """An error that tells the endpoint is unhealthy (an overload or a connection error), not that the request is wrong."""
+    return is_overload_error(error) or "Connection" in type(error).__name__
+
+
+def is_timeout_error(error: BaseException) -> bool:
+    """The deadline of the policy or the timeout of the OpenAI client, which is not a TimeoutError."""
+    if APITimeoutError is not None and isinstance(error, APITimeoutError):
+        return True
+    return isinstance(error, (asyncio.TimeoutError, TimeoutError))
+
+
+class LatencyTracker:
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, q: float, min_samples: int = 1) -> Optional[float]:
+        with self._lock:
+            if len(self._latencies) < max(min_samples, 1):
+                return None
+            return percentile(list(self._latencies), q)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` endpoint failures in a row, and rejects the calls for `reset_timeout` seconds.
+    Then one trial call goes through (half-open): the circuit closes if it succeeds and opens again if it fails
+    on the endpoint. A trial that ends otherwise, e.g. cancelled or with a 400, is released and the next call is
+    the trial.
+    """
+
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0  # the times the circuit opened
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self) -> bool:
+        """Reject the call if the circuit is open, and return whether it is the trial call."""
+        with self._lock:
+            if self.state == "closed":
+                return False
+            if self.state == "open" and time.time() - self._opened_at >= self.reset_timeout:
+                self.state = "half-open"
+                return True
+            raise CircuitOpenError(f"The circuit is {self.state} after {self.failures} failures in a row.")
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.state = "open"
+                self.opened += 1
+                self._opened_at = time.time()
+
+    def release_trial(self):
+        """The trial call ended without telling whether the endpoint is healthy, the circuit waits for another."""
+        with self._lock:
+            if self.state == "half-open":
+                self.state = "open"  # the reset timeout is over, the next call is the trial
+
+
+class ResilienceStats:
+    def __init__(self):
+        self.calls = 0
+        self.hedges = 0  # the duplicate requests sent
+        self.hedge_wins = 0  # the calls answered by a duplicate
+        self.timeouts = 0
+        self.rejected = 0  # by the open circuit
+        self.latencies = LatencyTracker()  # of the calls, from the first request to the answer
+        self._lock = threading.Lock()
+
+    def record(self, **counts):
+        with self._lock:
+            for key, count in counts.items():
+                setattr(self, key, getattr(self, key) + count)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "p50": self.latencies.percentile(50),
+                "p95": self.latencies.percentile(95),
+                "p99": self.latencies.percentile(99),
+            }
+
+
+class ResiliencePolicy:
+    """
+    Wraps the requests of the OpenAI backends with a deadline of `timeout` seconds per call, hedging and a
+    circuit breaker. With `hedge_percentile`, a call that has not answered after that percentile of the recent
+    request latencies sends a duplicate request, up to `max_hedges` of them, and the first answer wins. The
+    percentile is used once `hedge_min_samples` latencies were seen. The calls of an open circuit fail at once
+    with `CircuitOpenError`.
+    """
+
+    def __init__(self, timeout: float = None, hedge_percentile: float = None, hedge_min_samples: int = DEFAULT_HEDGE_MIN_SAMPLES,
+                 max_hedges: int = 1, circuit_breaker: CircuitBreaker = None):
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.max_hedges = max_hedges if hedge_percentile is not None else 0
+        self.circuit_breaker = circuit_breaker
+        self.request_latencies = LatencyTracker()  # of the single requests, the hedging delay is taken from them
+        self.stats = ResilienceStats()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.max_hedges:
+            return None
+        return self.request_latencies.percentile(self.hedge_percentile, self.hedge_min_samples)
+
+    def _before_call(self) -> bool:
+        """Returns whether the call is the trial of the circuit breaker."""
+        self.stats.record(calls=1)
+        if self.circuit_breaker is None:
+            return False
+        try:
+            return self.circuit_breaker.before_call()
+        except CircuitOpenError:
+            self.stats.record(rejected=1)
+            raise
+
+    def _after_call(self, started_at: float, trial: bool, error: BaseException = None, hedge_won: bool = False):
+        """Settles every call, whatever its outcome, so that the trial of the circuit breaker always ends."""
+        if error is None:
+            self.stats.latencies.add(time.time() - started_at)
+            self.stats.record(hedge_wins=int(hedge_won))
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_success()
+            return
+        if is_timeout_error(error):
+            self.stats.record(timeouts=1)
+        if self.circuit_breaker is None:
+            return
+        if isinstance(error, Exception) and is_endpoint_failure(error):
+            self.circuit_breaker.record_failure()
+        elif trial:
+            self.circuit_breaker.release_trial()
+
+    async def async_call(self, make_call: Callable[[], Awaitable[T]]) -> T:
+        """The answer of the first of the requests made by `make_call` to succeed, within the deadline."""
+        trial = self._before_call()
+        started_at = time.time()
+        deadline = started_at + self.timeout if self.timeout is not None else None
+
+        async def timed_request():
+            request_started_at = time.time()
+            result = await make_call()
+            self.request_latencies.add(time.time() - request_started_at)
+            return result
+
+        def start_request():
+            task = asyncio.ensure_future(timed_request())
+            # a lost request may still fail after the call is over, its error is not logged as never retrieved
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            return task
+
+        tasks = []
+        error, last_error, hedge_won = None, None, False
+        try:
+            tasks.append(start_request())
+            while True:
+                hedge_delay = self._hedge_delay() if len(tasks) <= self.max_hedges else None
+                wait_until = [t for t in (deadline, started_at + hedge_delay * len(tasks) if hedge_delay is not None else None) if t is not None]
+                timeout = max(0.0, min(wait_until) - time.time()) if wait_until else None
+                done, _ = await asyncio.wait([task for task in tasks if not task.done()], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        hedge_won = task is not tasks[0]
+                        return task.result()
+                    last_error = task.exception()
+                if all(task.done() for task in tasks):
+                    raise last_error
+                if deadline is not None and time.time() >= deadline:
+                    raise asyncio.TimeoutError(f"No answer within {self.timeout}s ({len(tasks)} requests).")
+                if not done and len(tasks) <= self.max_hedges:
+                    self.stats.record(hedges=1)
+                    tasks.append(start_request())
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._after_call(started_at, trial, error=error, hedge_won=hedge_won)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=MAX_CALL_THREADS, thread_name_prefix="resilience")
+            return self._executor
+
+    def call(self, make_call: Callable[[], T]) -> T:
+        """
+        sync version of `async_call`, the requests run in threads. A lost request cannot be cancelled, it ends
+        when it answers or at the client timeout, which is the per-call timeout.
+        """
+        trial = self._before_call()
+        started_at = time.time()
+        error, hedge_won = None, False
+        try:
+            if not self.max_hedges:
+                # nothing to wait for in parallel, the client timeout is the deadline
+                result = make_call()
+                self.request_latencies.add(time.time() - started_at)
+                return result
+            result, hedge_won = self._hedged_call(make_call, started_at)
+            return result
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._after_call(started_at, trial, error=error, hedge_won=hedge_won)
+
+    def _hedged_call(self, make_call: Callable[[], T], started_at: float) -> Tuple[T, bool]:
+        """The first answer of the requests in threads, and whether a duplicate request gave it."""
+        deadline = started_at + self.timeout if self.timeout is not None else None
+
+        def timed_request():
+            request_started_at = time.time()
+            result = make_call()
+            self.request_latencies.add(time.time() - request_started_at)
+            return result
+
+        executor = self._get_executor()
+        futures = [executor.submit(timed_request)]
+        error = None
+        while True:
+            hedge_delay = self._hedge_delay() if len(futures) <= self.max_hedges else None
+            wait_until = [t for t in (deadline, started_at + hedge_delay * len(futures) if hedge_delay is not None else None) if t is not None]
+            timeout = max(0.0, min(wait_until) - time.time()) if wait_until else None
+            done, _ = wait_futures([future for future in futures if not future.done()], timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result(), future is not futures[0]
+                error = future.exception()
+            if all(future.done() for future in futures):
+                raise error
+            if deadline is not None and time.time() >= deadline:
+                raise TimeoutError(f"No answer within {self.timeout}s ({len(futures)} requests).")
+            if not done and len(futures) <= self.max_hedges:
+                self.stats.record(hedges=1)
+                futures.append(executor.submit(timed_request))
+
+
+# The policy is shared by all the OpenAI backends of the process, the requests are sent as they are unless it is set
+_resilience_policy: Optional[ResiliencePolicy] = None
+
+
+def set_resilience_policy(policy: Optional[ResiliencePolicy]):
+    global _resilience_policy
+    _resilience_policy = policy
+
+
+def get_resilience_policy() -> Optional[ResiliencePolicy]:
+    return _resilience_policy
@@ -0,0 +1,142 @@
+from typing import List, Optional
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# Inline images are replaced by their digest in the cache key, so that the key does not depend on the encoding
+DATA_URL_PATTERN = re.compile(r"^data:(image/[\w.+-]+);base64,(.*)$", re.DOTALL)
+
+# Run the eviction after this many insertions instead of after every one
+EVICT_EVERY_N_PUTS = 100
+
+
+def _canonical_content(content):
+    if isinstance(content, list):
+        return [_canonical_content(part) for part in content]
+    if isinstance(content, dict):
+        return {k: _canonical_content(v) for k, v in content.items()}
+    if isinstance(content, str):
+        match = DATA_URL_PATTERN.match(content)
+        if match is not None:
+            return f"{match.group(1)};sha256,{hashlib.sha256(match.group(2).encode('ascii')).hexdigest()}"
+    return content
+
+
+class ResponseCache:
+    """
+    A persistent cache of LLM responses stored in SQLite, keyed by a hash of the rendered request
+    (model, messages with image digests, temperature, max_tokens and stop tokens).
+    Entries are evicted when they are older than `max_age_seconds`, and the least recently used ones
+    are evicted when the cache holds more than `max_entries` entries or `max_bytes` bytes of responses.
+    The same file can be shared by several worker processes.
+    """
+
+    def __init__(self, path: str, max_entries: int = None, max_bytes: int = None, max_age_seconds: float = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+
+        self.hits = 0
+        self.misses = 0
+        self._num_puts = 0
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(model: str, messages: List[dict], temperature: float, max_tokens: int, stop=None) -> str:
+        request = {
+            "model": model,
+            "messages": _canonical_content(messages),
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stop": list(stop) if stop is not None else None,
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.max_age_seconds is not None and now - row[1] > self.max_age_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response.encode("utf-8")), now, now))
+            self._conn.commit()
+            self._num_puts += 1
+            evict = self._num_puts % EVICT_EVERY_N_PUTS == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Drop the expired entries, then the least recently used ones until the size limits hold."""
+        with self._lock:
+            if self.max_age_seconds is not None:
+                self._conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_seconds,))
+            if self.max_entries is not None:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,))
+            if self.max_bytes is not None:
+                # keep the most recently used entries whose cumulative size fits in max_bytes
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM ("
+                    "SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS total FROM responses"
+                    ") WHERE total > ?)",
+                    (self.max_bytes,))
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total_bytes = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": total_bytes,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# The cache is shared by all the backends of the process, it is disabled unless a cache is set
+_response_cache: Optional[ResponseCache] = None
+
+
+def set_response_cache(cache: Optional[ResponseCache]):
+    global _response_cache
+    _response_cache = cache
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    return _response_cache
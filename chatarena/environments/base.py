@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import List, Dict
+from typing import List, Dict, Callable
 from abc import abstractmethod
 
 from ..message import Message
@@ -84,6 +84,16 @@ class Environment(Configurable):
         """
         pass
 
+    async def async_step(self, player_name: str, action: str, speculate: Callable[[], None] = None) -> TimeStep:
+        """
+        async version of `step`, environments that query agents (e.g. a moderator) can override it
+        Args:
+            speculate: called by the environments that check the conversation after an action, once the
+                state of the next turn is known and before the check is awaited, so that the arena can start
+                the next player's turn concurrently
+        """
+        return self.step(player_name, action)
+
     @abstractmethod
     def check_action(self, action: str, player_name: str) -> bool:
         """
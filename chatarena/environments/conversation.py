@@ -1,4 +1,4 @@
-from typing import List, Union
+from typing import List, Union, Callable
 
 from .base import TimeStep, Environment
 from ..message import Message, MessagePool
@@ -112,12 +112,13 @@ class ModeratedConversation(Conversation):
         # This environment contains some speical config arguments that needs to be handle specially
         return EnvironmentConfig(env_type=self.type_name, player_names=self.player_names, parallel=self.parallel, moderator=self.moderator.to_config(), moderator_visibility=self.moderator_visibility, moderator_period=self.moderator_period)
 
-    def step(self, player_name: str, action: str) -> TimeStep:
+    def record_action(self, player_name: str, action: str) -> bool:
         """
-        step function that is called by the arena
-        Args:
-            player_name: the name of the player that takes the action
-            action: the action that the agents wants to take
+        append the action to the message pool and move to the next player. `step` is `record_action`, the moderator
+        check if it asks for one, then `finish_step`; an engine that sends the moderator checks itself (e.g.
+        `VectorArena`) calls the two in the same order
+        Returns:
+            whether the moderator should check the conversation after this action
         """
         message = Message(agent_name=player_name, content=action, turn=self._current_turn)
         self.message_pool.append_message(message)
@@ -125,7 +126,32 @@ class ModeratedConversation(Conversation):
         # Round-robin order for the next player
         self._next_player_idx = (self._next_player_idx + 1) % self.num_players
 
-        if self.moderator_period == "turn" or (self.moderator_period == "round" and self._next_player_idx == 0):
+        return self.moderator_period == "turn" or (self.moderator_period == "round" and self._next_player_idx == 0)
+
+    def _advance_turn(self):
+        # Update the counters
+        if not self.parallel or self._next_player_idx == 0:
+            self._current_turn += 1
+
+    def _make_timestep(self, terminal: bool) -> TimeStep:
+        timestep = TimeStep(observation=self.get_observation(),
+                            reward=self.get_zero_rewards(),
+                            terminal=terminal)  # Return all the messages
+        return timestep
+
+    def finish_step(self, terminal: bool) -> TimeStep:
+        """update the turn counter after a recorded action, and return the timestep with the moderator's decision"""
+        self._advance_turn()
+        return self._make_timestep(terminal)
+
+    def step(self, player_name: str, action: str) -> TimeStep:
+        """
+        step function that is called by the arena
+        Args:
+            player_name: the name of the player that takes the action
+            action: the action that the agents wants to take
+        """
+        if self.record_action(player_name, action):
             # Moderator's turn
             moderator_history = self.message_pool.get_all_messages()
 
@@ -142,11 +168,25 @@ class ModeratedConversation(Conversation):
         else:
             terminal = self.is_terminal()
 
-        # Update the counters
-        if not self.parallel or self._next_player_idx == 0:
-            self._current_turn += 1
+        return self.finish_step(terminal)
 
-        timestep = TimeStep(observation=self.get_observation(),
-                            reward=self.get_zero_rewards(),
-                            terminal=terminal)  # Return all the messages
-        return timestep
+    async def async_step(self, player_name: str, action: str, speculate: Callable[[], None] = None) -> TimeStep:
+        """
+        async version of `step`, the moderator check is awaited instead of blocking
+        Args:
+            speculate: called before the moderator check is awaited, see `Environment.async_step`. The moderator's
+                decision only sets the terminal flag of the timestep, the next turn sees the same state either way
+        """
+        if self.record_action(player_name, action):
+            moderator_history = self.message_pool.get_all_messages()
+            if speculate is not None and not self.is_terminal():
+                # the counters are updated before the check, so that the next turn can start during it
+                self._advance_turn()
+                speculate()
+                terminal = await self.moderator.async_is_terminal(moderator_history) or self.is_terminal()
+                return self._make_timestep(terminal)
+            terminal = await self.moderator.async_is_terminal(moderator_history) or self.is_terminal()
+        else:
+            terminal = self.is_terminal()
+
+        return self.finish_step(terminal)
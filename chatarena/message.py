@@ -1,5 +1,5 @@
 from typing import List, Union
-from dataclasses import dataclass
+from bisect import bisect_left
 import time
 from uuid import uuid1
 import hashlib
@@ -8,27 +8,67 @@ import hashlib
 SYSTEM_NAME = "System"
 MODERATOR_NAME = "Moderator"
 
+# The default timestamp of a message, evaluated once when the module is imported as the dataclass default was
+_DEFAULT_TIMESTAMP = time.time_ns()
+_HASHED_FIELDS = frozenset(["agent_name", "content", "timestamp", "turn", "msg_type"])
+
 
 def _hash(input: str):
     hex_dig = hashlib.sha256(input.encode()).hexdigest()
     return hex_dig
 
 
-@dataclass
 class Message:
-    agent_name: str
-    content: str  # it can be an image or a text
-    turn: int
-    timestamp: int = time.time_ns()
-    visible_to: Union[str, List[str]] = 'all'
-    msg_type: str = "text"
-    logged: bool = False  # Whether the message is logged in the database
+    """
+    A message of the conversation. It has the fields, the constructor, the repr and the equality of the former
+    dataclass, with `__slots__` instead of an instance dict. `msg_hash` is computed once and recomputed only after
+    one of the fields it covers is assigned.
+    """
+    __slots__ = ("agent_name", "content", "turn", "timestamp", "visible_to", "msg_type", "logged", "_msg_hash")
+    _fields = ("agent_name", "content", "turn", "timestamp", "visible_to", "msg_type", "logged")
+
+    def __init__(self, agent_name: str, content: str, turn: int, timestamp: int = _DEFAULT_TIMESTAMP,
+                 visible_to: Union[str, List[str]] = 'all', msg_type: str = "text", logged: bool = False):
+        set_field = object.__setattr__
+        set_field(self, "agent_name", agent_name)
+        set_field(self, "content", content)  # it can be an image or a text
+        set_field(self, "turn", turn)
+        set_field(self, "timestamp", timestamp)
+        set_field(self, "visible_to", visible_to)
+        set_field(self, "msg_type", msg_type)
+        set_field(self, "logged", logged)  # Whether the message is logged in the database
+        set_field(self, "_msg_hash", None)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in _HASHED_FIELDS:
+            object.__setattr__(self, "_msg_hash", None)
+
+    def _astuple(self):
+        return tuple(getattr(self, field) for field in self._fields)
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self._fields)
+        return f"{self.__class__.__qualname__}({fields})"
+
+    def __eq__(self, other):
+        if other.__class__ is self.__class__:
+            return self._astuple() == other._astuple()
+        return NotImplemented
+
+    __hash__ = None
 
     @property
     def msg_hash(self):
         # Generate a unique message id given the content, timestamp and role
-        return _hash(
-            f"agent: {self.agent_name}\ncontent: {self.content}\ntimestamp: {str(self.timestamp)}\nturn: {self.turn}\nmsg_type: {self.msg_type}")
+        if self._msg_hash is None:
+            object.__setattr__(self, "_msg_hash", _hash(
+                f"agent: {self.agent_name}\ncontent: {self.content}\ntimestamp: {str(self.timestamp)}\nturn: {self.turn}\nmsg_type: {self.msg_type}"))
+        return self._msg_hash
+
+
+def _is_visible(message: Message, agent_name: str) -> bool:
+    return message.visible_to == "all" or agent_name in message.visible_to or agent_name == MODERATOR_NAME
 
 
 class MessagePool():
@@ -41,18 +81,38 @@ class MessagePool():
     The agents can only see the messages that
     1) before the current turn, and
     2) visible to the current role
+
+    The turns of the messages are kept in a list, so the messages before a turn are found by bisection as long as
+    the turns never decrease (otherwise the pool scans the messages as before). The messages visible to an agent
+    are indexed the first time it asks for them and kept up to date as messages are appended; the visibility of a
+    message is read when it is appended.
     """
 
     def __init__(self):
         self.conversation_id = str(uuid1())
         self._messages: List[Message] = []  # TODO: for the sake of thread safety, use a queue instead
         self._last_message_idx = 0
+        self._turns: List[int] = []
+        self._turns_sorted = True
+        # agent name -> (the messages visible to the agent, their positions in the pool)
+        self._visible_index = {}
 
     def reset(self):
         self._messages = []
+        self._turns = []
+        self._turns_sorted = True
+        self._visible_index = {}
 
     def append_message(self, message: Message):
+        if self._turns and message.turn < self._turns[-1]:
+            self._turns_sorted = False
+        position = len(self._messages)
         self._messages.append(message)
+        self._turns.append(message.turn)
+        for agent_name, (visible_messages, positions) in self._visible_index.items():
+            if _is_visible(message, agent_name):
+                visible_messages.append(message)
+                positions.append(position)
 
     def print(self):
         for message in self._messages:
@@ -75,16 +135,26 @@ class MessagePool():
     def get_all_messages(self) -> List[Message]:
         return self._messages
 
+    def _get_visible_index(self, agent_name):
+        if agent_name not in self._visible_index:
+            visible_messages, positions = [], []
+            for position, message in enumerate(self._messages):
+                if _is_visible(message, agent_name):
+                    visible_messages.append(message)
+                    positions.append(position)
+            self._visible_index[agent_name] = (visible_messages, positions)
+        return self._visible_index[agent_name]
+
     def get_visible_messages(self, agent_name, turn: int) -> List[Message]:
         """
         get the messages that are visible to the agents before the specified turn
         """
-
-        # Get the messages before the current turn
-        prev_messages = [message for message in self._messages if message.turn < turn]
-
-        visible_messages = []
-        for message in prev_messages:
-            if message.visible_to == "all" or agent_name in message.visible_to or agent_name == "Moderator":
-                visible_messages.append(message)
-        return visible_messages
+        if not self._turns_sorted:
+            return [message for message in self._messages if message.turn < turn and _is_visible(message, agent_name)]
+
+        # The number of messages before the current turn
+        num_prev_messages = bisect_left(self._turns, turn)
+        if agent_name == MODERATOR_NAME:
+            return self._messages[:num_prev_messages]
+        visible_messages, positions = self._get_visible_index(agent_name)
+        return visible_messages[:bisect_left(positions, num_prev_messages)]
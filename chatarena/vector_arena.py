@@ -0,0 +1,151 @@
+from typing import Any, Callable, List, Optional, Tuple
+import logging
+
+from tenacity import RetryError
+
+from .arena import Arena
+from .agent import Moderator, SIGNAL_END_OF_CONVERSATION
+from .backends.base import grouped_batch_query
+from .environments.conversation import ModeratedConversation
+
+
+class _Slot:
+    """A dialog of the vector arena and its progress."""
+
+    def __init__(self, key: Any, arena: Arena):
+        self.key = key
+        self.arena = arena
+        self.num_steps = 0
+        self.invalid_actions = 0  # in a row, the turn is asked again at the next step
+
+
+class VectorArena:
+    """
+    Runs up to `num_envs` arenas of `ModeratedConversation` turn-synchronously. At every step, the next turn of
+    every dialog is sent in one batch (one `batch_query` per backend class), the actions are recorded, and the
+    moderator checks of the dialogs that need one are sent in a second batch. The steps of the environments are
+    driven through `ModeratedConversation.record_action` and `finish_step`.
+    A dialog that is over, or that took `max_steps` steps, is handed to `on_finished(key, arena)` and replaced by
+    the next `(key, arena)` of `arena_factory`, until the factory returns None. A dialog whose query raised is
+    handed to `on_failed(key, arena, error)` instead.
+    """
+
+    def __init__(self, arena_factory: Callable[[], Optional[Tuple[Any, Arena]]], num_envs: int, max_steps: int,
+                 on_finished: Callable[[Any, Arena], None] = None, on_failed: Callable[[Any, Arena, Exception], None] = None):
+        self.arena_factory = arena_factory
+        self.num_envs = num_envs
+        self.max_steps = max_steps
+        self.on_finished = on_finished
+        self.on_failed = on_failed
+
+        self.slots: List[_Slot] = []
+        self._exhausted = False
+        # the number of steps and of queries in their batches
+        self.num_steps = 0
+        self.num_player_queries = 0
+        self.num_moderator_queries = 0
+        self._fill()
+
+    def _fill(self):
+        while not self._exhausted and len(self.slots) < self.num_envs:
+            item = self.arena_factory()
+            if item is None:
+                self._exhausted = True
+                break
+            key, arena = item
+            if not isinstance(arena.environment, ModeratedConversation):
+                raise ValueError(f"VectorArena runs moderated conversations, not {type(arena.environment).__name__}.")
+            self.slots.append(_Slot(key, arena))
+
+    def _finish_step(self, slot: _Slot, terminal: bool, finished: List[_Slot]):
+        slot.arena.current_timestep = slot.arena.environment.finish_step(terminal)
+        if slot.arena.current_timestep.terminal or slot.num_steps >= self.max_steps:
+            finished.append(slot)
+
+    def step(self):
+        """One turn of every dialog, then the dialogs that are over are replaced."""
+        turns = []
+        for slot in self.slots:
+            env = slot.arena.environment
+            player = slot.arena.name_to_player[env.get_next_player()]
+            turns.append((slot, player, player.query_kwargs(env.get_observation(player.name))))
+        actions = grouped_batch_query([(player.backend, kwargs) for _, player, kwargs in turns])
+        self.num_steps += 1
+        self.num_player_queries += len(turns)
+
+        finished, failed, checks = [], [], []
+        for (slot, player, _), action in zip(turns, actions):
+            env = slot.arena.environment
+            if isinstance(action, RetryError):
+                logging.warning(f"Agent {player.name} failed to generate a response. "
+                                f"Error: {action.last_attempt.exception()}. "
+                                f"Sending signal to end the conversation.")
+                action = SIGNAL_END_OF_CONVERSATION
+            elif isinstance(action, Exception):
+                failed.append((slot, action))
+                continue
+
+            if not env.check_action(action, player.name):
+                logging.warning(f"{player.name} made an invalid action {action}")
+                slot.invalid_actions += 1
+                if slot.invalid_actions >= slot.arena.invalid_actions_retry:
+                    # as with Arena.run, the dialog ends with the messages it has
+                    logging.warning(f"{player.name} has made invalid actions for {slot.arena.invalid_actions_retry} times. Terminating the game.")
+                    finished.append(slot)
+                continue
+            slot.invalid_actions = 0
+            slot.num_steps += 1
+            if env.record_action(player.name, action):
+                checks.append(slot)
+            else:
+                self._finish_step(slot, env.is_terminal(), finished)
+
+        # The moderator checks, a player that sent the end signal ends the conversation without one
+        queries, checked = [], []
+        for slot in checks:
+            env = slot.arena.environment
+            history = env.message_pool.get_all_messages()
+            if history[-1].content == SIGNAL_END_OF_CONVERSATION:
+                self._finish_step(slot, True, finished)
+            else:
+                queries.append((env.moderator.backend, env.moderator.terminal_query_kwargs(history)))
+                checked.append(slot)
+        self.num_moderator_queries += len(queries)
+        for slot, response in zip(checked, grouped_batch_query(queries)):
+            env = slot.arena.environment
+            if isinstance(response, RetryError):
+                logging.warning(f"Agent {env.moderator.name} failed to generate a response. "
+                                f"Error: {response.last_attempt.exception()}.")
+                terminal = True
+            elif isinstance(response, Exception):
+                failed.append((slot, response))
+                continue
+            else:
+                terminal = Moderator._parse_decision(response)
+            self._finish_step(slot, terminal or env.is_terminal(), finished)
+
+        done = {id(slot) for slot in finished} | {id(slot) for slot, _ in failed}
+        self.slots = [slot for slot in self.slots if id(slot) not in done]
+        for slot in finished:
+            if self.on_finished is not None:
+                self.on_finished(slot.key, slot.arena)
+        for slot, error in failed:
+            if self.on_failed is not None:
+                self.on_failed(slot.key, slot.arena, error)
+            else:
+                logging.warning(f"Dialog {slot.key} failed: {error!r}")
+        self._fill()
+
+    def run(self):
+        """Step until the factory is exhausted and every dialog is over."""
+        while self.slots:
+            self.step()
+
+    def stats(self) -> dict:
+        return {
+            "steps": self.num_steps,
+            "player_queries": self.num_player_queries,
+            "moderator_queries": self.num_moderator_queries,
+            "player_queries_per_step": self.num_player_queries / self.num_steps if self.num_steps else 0.0,
+            "moderator_queries_per_step": self.num_moderator_queries / self.num_steps if self.num_steps else 0.0,
+        }
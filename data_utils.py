@@ -5,9 +5,16 @@ import os
 from typing import List
 import json
 import statistics
+import hashlib
+import functools
+import uuid
+import threading
+from collections import OrderedDict
+import numpy as np
 from PIL import Image
 import io
 from colorama import Fore, Back, Style, init
+from prompt_templates import render_instructions
 def find_word_in_string(w, s):
     return re.compile(r"\b({0})\b".format(w), flags=re.IGNORECASE).search(s)
 
@@ -26,28 +33,44 @@ def reformate_dialog_data(seed_dialog_data):
             })
     return reformated_data
 
-def random_select_scene(image_pool_path, image_info_pool_path, fashion_metadata, furniture_metadata, seed_dialog_data, scene_begin_id=None):
-    if scene_begin_id is not None:
-        selected_dialog_data = seed_dialog_data[scene_begin_id]
-    else:
-        selected_dialog_data = random.choice(seed_dialog_data)
-    domain = selected_dialog_data["domain"]
-    
+def resolve_scene_paths(dialog_data, image_pool_path, image_info_pool_path, exists=os.path.exists):
+    """The screenshot and scene json paths of the scenes of a seed dialog, skipping the scenes missing from the pools."""
     scene_images_paths = []
     scene_images_info_paths = []
-    for turn_ids, scene_id in selected_dialog_data["scene_ids"].items():
+    for turn_ids, scene_id in dialog_data["scene_ids"].items():
         trimmed_scene_name = scene_id[2:] if scene_id[:2] == "m_" else scene_id
         screenshot_load_path = os.path.join(image_pool_path, f"{trimmed_scene_name}.png")
 
         json_path = os.path.join(image_info_pool_path, f"{trimmed_scene_name}_scene.json")
-        if not os.path.exists(json_path):
+        if not exists(json_path):
             json_path = os.path.join(image_info_pool_path, f"m_{trimmed_scene_name}_scene.json")
         
-        if not os.path.exists(json_path) or not os.path.exists(screenshot_load_path):
+        if not exists(json_path) or not exists(screenshot_load_path):
             continue
         
         scene_images_paths.append(screenshot_load_path)
         scene_images_info_paths.append(json_path)
+    return scene_images_paths, scene_images_info_paths
+
+def random_select_scene(image_pool_path, image_info_pool_path, fashion_metadata, furniture_metadata, seed_dialog_data, scene_begin_id=None, scene_index=None):
+    """
+    Select a seed dialog with its scenes and another scene of the same domain with a type of object that the first scene lacks.
+    With a `scene_index` (see scene_index.py) the scene paths are looked up instead of probing the filesystem,
+    only the seed dialogs with at least one scene in the pools are drawn, and the other scene is drawn directly
+    from its type index instead of by rejection sampling.
+    """
+    if scene_begin_id is None and scene_index is not None:
+        scene_begin_id = random.choice(scene_index.valid_dialog_ids)
+    if scene_begin_id is not None:
+        selected_dialog_data = seed_dialog_data[scene_begin_id]
+    else:
+        selected_dialog_data = random.choice(seed_dialog_data)
+    domain = selected_dialog_data["domain"]
+    
+    if scene_index is not None:
+        scene_images_paths, scene_images_info_paths = scene_index.get_scene_paths(scene_begin_id)
+    else:
+        scene_images_paths, scene_images_info_paths = resolve_scene_paths(selected_dialog_data, image_pool_path, image_info_pool_path)
     
     assert len(scene_images_paths) == len(scene_images_info_paths)
     assert len(scene_images_paths) > 0
@@ -60,6 +83,11 @@ def random_select_scene(image_pool_path, image_info_pool_path, fashion_metadata,
         raise ValueError(f"Invalid domain: {domain}")
     dialog = reformate_dialog_data(selected_dialog_data["dialogue"])
     
+    if scene_index is not None:
+        another_dialog_id, different_type_name = scene_index.sample_partner(scene_begin_id)
+        another_scene_images_paths, another_scene_images_info_paths = scene_index.get_scene_paths(another_dialog_id)
+        return scene_images_paths, scene_images_info_paths, metadata, dialog, domain, another_scene_images_paths, another_scene_images_info_paths, different_type_name
+    
     # Collect all objects info in the first scene and select another scene have different classes of objects
     object_info_in_select_scene = extract_object_info(scene_images_info_paths[0], metadata)
     collected_classes_info = collect_type_info(object_info_in_select_scene)
@@ -69,18 +97,7 @@ def random_select_scene(image_pool_path, image_info_pool_path, fashion_metadata,
         another_selected_dialog_data = random.choice(seed_dialog_data)
         if another_selected_dialog_data["domain"] != domain:
             continue
-        another_scene_images_paths = []
-        another_scene_images_info_paths = []
-        for turn_ids, scene_id in another_selected_dialog_data["scene_ids"].items():
-            trimmed_scene_name = scene_id[2:] if scene_id[:2] == "m_" else scene_id
-            screenshot_load_path = os.path.join(image_pool_path, f"{trimmed_scene_name}.png")
-            json_path = os.path.join(image_info_pool_path, f"{trimmed_scene_name}_scene.json")
-            if not os.path.exists(json_path):
-                json_path = os.path.join(image_info_pool_path, f"m_{trimmed_scene_name}_scene.json")
-            if not os.path.exists(json_path) or not os.path.exists(screenshot_load_path):
-                continue
-            another_scene_images_paths.append(screenshot_load_path)
-            another_scene_images_info_paths.append(json_path)
+        another_scene_images_paths, another_scene_images_info_paths = resolve_scene_paths(another_selected_dialog_data, image_pool_path, image_info_pool_path)
         
         assert len(another_scene_images_paths) == len(another_scene_images_info_paths)
         assert len(another_scene_images_paths) > 0
@@ -111,7 +128,7 @@ def collect_type_info(object_info):
     for k, v in object_info.items():
         if "type" in v:
             all_type.add(v["type"])
-    return list(all_type)
+    return sorted(all_type)
     
 def sample_profile(profile_slots, exclude_name=None):
     sampled_profile = {}
@@ -123,203 +140,239 @@ def sample_profile(profile_slots, exclude_name=None):
         sampled_profile[slot_key] = sampled_value
     return sampled_profile
 
+class SceneObjectsCache:
+    """
+    A bounded LRU cache of the prefab paths of the objects of parsed scene JSON files, keyed by path,
+    modification time and size. A scene is picked by many dialogs and read by both the scene selection
+    and the instruction building, so each file is only decoded once.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, scene_image_info_path):
+        stat = os.stat(scene_image_info_path)
+        key = (os.path.abspath(scene_image_info_path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            object_names = self._entries.get(key)
+            if object_names is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return object_names
+
+        with open(scene_image_info_path, "r", encoding="utf-8") as f:
+            scene_info = json.load(f)
+        object_names = tuple(datum["prefab_path"] for datum in scene_info["scenes"][0]["objects"])
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = object_names
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return object_names
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
+
+# Shared by all the dialogs of the process
+_scene_objects_cache = SceneObjectsCache()
+
+def get_scene_objects_cache():
+    return _scene_objects_cache
+
 def extract_object_info(scene_image_info_path, metadata):
-    with open(scene_image_info_path, "r", encoding="utf-8") as f:
-        scene_info = json.load(f)
-    scene_json = scene_info["scenes"][0]["objects"]
     return_obj_info = {}
-    for datum in scene_json:
-        object_name = datum["prefab_path"]
+    for object_name in _scene_objects_cache.get(scene_image_info_path):
         if object_name in metadata:
             return_obj_info[object_name] = metadata[object_name]
     return return_obj_info
 
-def simulate_user_preference(objects_info, domain, strict_preference=None):
-    if domain == "fashion":
-        all_assetType = set()
-        all_customerReview = set()
-        all_availableSizes = set()
-        all_color = set()
-        all_pattern = set()
-        all_brand = set()
-        all_sleeveLength = set()
-        all_type = set()
-        all_price = set()
-        for k, v in objects_info.items():
-            all_assetType.add(v.get("assetType", "NULL"))
-            all_customerReview.add(v.get("customerReview", "NULL"))
-            all_availableSizes.update(set(v.get("availableSizes", "NULL")))
-            all_color.add(v.get("color", "NULL"))
-            all_pattern.add(v.get("pattern", "NULL"))
-            all_brand.add(v.get("brand", "NULL"))
-            all_sleeveLength.add(v.get("sleeveLength", "NULL"))
-            all_type.add(v.get("type", "NULL"))
-            all_price.add(v.get("price", "NULL"))
-        
-        
-        # remove "NULL" from all sets
-        all_assetType.discard("NULL")
-        all_customerReview.discard("NULL")
-        all_availableSizes.discard("NULL")
-        all_color.discard("NULL")
-        all_pattern.discard("NULL")
-        all_brand.discard("NULL")
-        all_sleeveLength.discard("NULL")
-        all_type.discard("NULL")
-        all_price.discard("NULL")
-        
-        # convert all set to list
-        all_assetType = list(all_assetType)
-        all_customerReview = list(all_customerReview)
-        all_availableSizes = list(all_availableSizes)
-        all_color = list(all_color)
-        all_pattern = list(all_pattern)
-        all_brand = list(all_brand)
-        all_sleeveLength = list(all_sleeveLength)
-        all_type = list(all_type)
-        all_price = list(all_price)
-        
-        # convert all_customerReview and all_price to float
-        all_customerReview = [float(cr) for cr in all_customerReview]
-        all_price = [float(p) for p in all_price]
-        return_string = ""
-        
-        if len(all_assetType) != 0:
-            assertType_preference = "Assert Type Preference: "
-            for i in all_assetType:
-                assertType_preference += f"{i}({random.choice(['favor', 'aversion','neutral'])}) "
-            assertType_preference = assertType_preference.strip() + ";\n"
-            return_string += assertType_preference
-        
-        if len(all_customerReview) != 0:
-            median_value = round(statistics.median(all_customerReview), 1)
-            customerReview_preference = f"Review Preference: greater than {median_value};\n"
-            return_string += customerReview_preference
-        
-        if len(all_availableSizes) != 0:
-            size_preference = f"Size Preference: {random.choice(list(all_availableSizes))};\n"
-            return_string += size_preference
-        
-        if len(all_color) != 0:
-            color_preference = f"Color Preference: "
-            for i in all_color:
-                color_preference += f"{i}({random.choice(['favor', 'aversion','neutral'])}) "
-            color_preference = color_preference.strip() + ";\n"
-            return_string += color_preference
-        
-        if len(all_pattern) != 0:
-            pattern_preference = f"Pattern Preference: "
-            for i in all_pattern:
-                pattern_preference += f"{i}({random.choice(['favor', 'aversion','neutral'])}) "
-            pattern_preference = pattern_preference.strip() + ";\n"
-            return_string += pattern_preference
-        
-        if len(all_brand) != 0:
-            brand_preference = f"Brand Preference: "
-            for i in all_brand:
-                brand_preference += f"{i}({random.choice(['favor', 'aversion','neutral'])}) "
-            brand_preference = brand_preference.strip() + ";\n"
-            return_string += brand_preference
-        
-        if len(all_sleeveLength) != 0:
-            sleeveLength_preference = f"Sleeve Length Preference: "
-            for i in all_sleeveLength:
-                sleeveLength_preference += f"{i}({random.choice(['favor', 'aversion','neutral'])}) "
-            sleeveLength_preference = sleeveLength_preference.strip() + ";\n"
-            return_string += sleeveLength_preference
-        
-        if len(all_type) != 0:
-            type_preference = f"Type Preference: "
-            for i in all_type:
-                if strict_preference is not None and i == strict_preference:
-                    type_preference += f"{i}({random.choice(['favor', 'neutral'])}) "
+# A price written with its currency sign, e.g. "$199" in the furniture metadata
+CURRENCY_PATTERN = re.compile(r"^([^\d\s.+-]+)(\d+(?:\.\d+)?)$")
+
+def parse_currency(value):
+    """The amount of a price written with its currency sign, e.g. 199.0 for "$199"."""
+    return float(CURRENCY_PATTERN.match(value).group(2))
+
+PREFERENCE_CHOICES = ['favor', 'aversion', 'neutral']
+# the type a user must seek in the transition turn is never disliked
+STRICT_PREFERENCE_CHOICES = ['favor', 'neutral']
+
+# The sections of the preferences of a user, in order: (label, attribute, kind, parse), where kind is
+#   "choices": every value gets one of PREFERENCE_CHOICES, "type_choices": the same, except for the strict preference,
+#   "one_of": one of the values, "greater_than_median"/"less_than_median": the median of the values, parsed by `parse`
+#   (or read from the numeric column of a product catalog)
+FASHION_PREFERENCE_SCHEMA = [
+    ("Assert Type Preference", "assetType", "choices", None),
+    ("Review Preference", "customerReview", "greater_than_median", float),
+    ("Size Preference", "availableSizes", "one_of", None),
+    ("Color Preference", "color", "choices", None),
+    ("Pattern Preference", "pattern", "choices", None),
+    ("Brand Preference", "brand", "choices", None),
+    ("Sleeve Length Preference", "sleeveLength", "choices", None),
+    ("Type Preference", "type", "type_choices", None),
+    ("Price Preference", "price", "less_than_median", float),
+]
+FURNITURE_PREFERENCE_SCHEMA = [
+    ("Brand Preference", "brand", "choices", None),
+    ("Color Preference", "color", "choices", None),
+    ("Review Preference", "customerRating", "greater_than_median", float),
+    ("Materials Preference", "materials", "choices", None),
+    ("Price Preference", "price", "less_than_median", parse_currency),
+    ("Type Preference", "type", "type_choices", None),
+]
+PREFERENCE_SCHEMAS = {
+    "fashion": FASHION_PREFERENCE_SCHEMA,
+    "furniture": FURNITURE_PREFERENCE_SCHEMA,
+}
+
+MAX_PREFERENCE_SUMMARIES = 4096
+_preference_summaries = OrderedDict()
+
+def _catalog_numbers(metadata, attribute, names):
+    """The values of a numeric attribute of the objects read from a product catalog, None without a numeric column."""
+    numeric_values = getattr(metadata, "numeric_values", None)
+    return numeric_values(attribute, names) if numeric_values is not None else None
+
+def summarize_preferences(objects_info, domain, metadata=None):
+    """
+    The attribute values of the objects of a scene that the preferences are drawn from: a list of
+    (label, kind, values) following the schema of the domain, where values are the sorted distinct values
+    (without "NULL") or, for a median, the rounded median. Empty sections are left out.
+    With a product catalog as `metadata`, the medians are taken from its numeric columns without parsing.
+    """
+    summary = []
+    for label, attribute, kind, parse in PREFERENCE_SCHEMAS[domain]:
+        numbers = None
+        if kind == "greater_than_median" or kind == "less_than_median":
+            numbers = _catalog_numbers(metadata, attribute, list(objects_info))
+        if numbers is not None:
+            values = sorted(set(numbers))
+        else:
+            values = set()
+            for k, v in objects_info.items():
+                if kind == "one_of":
+                    values.update(set(v.get(attribute, "NULL")))
                 else:
-                    type_preference += f"{i}({random.choice(['favor', 'aversion','neutral'])}) "
-            type_preference = type_preference.strip() + ";\n"
-            return_string += type_preference
-        
-        if len(all_price) != 0:
-            median_value = round(statistics.median(all_price), 2)
-            price_preference = f"Price Preference: less than {median_value};\n"
-            return_string += price_preference
-        
-        return return_string
-    elif domain == "furniture":
-        all_brand = set()
-        all_color = set()
-        all_customerRating = set()
-        all_materials = set()
-        all_price = set()
-        all_type = set()
-        for k, v in objects_info.items():
-            all_brand.add(v.get("brand", "NULL"))
-            all_color.add(v.get("color", "NULL"))
-            all_customerRating.add(v.get("customerRating", "NULL"))
-            all_materials.add(v.get("materials", "NULL"))
-            all_price.add(v.get("price", "NULL"))
-            all_type.add(v.get("type", "NULL"))
-        
-        all_brand.discard("NULL")
-        all_color.discard("NULL")
-        all_customerRating.discard("NULL")
-        all_materials.discard("NULL")
-        all_price.discard("NULL")
-        all_type.discard("NULL")
-        
-        all_brand = list(all_brand)
-        all_color = list(all_color)
-        all_customerRating = list(all_customerRating)
-        all_materials = list(all_materials)
-        all_price = list(all_price)
-        all_type = list(all_type)
-        
-        all_customerRating = [float(cr) for cr in all_customerRating]
-        all_price = [float(p[1:]) for p in all_price] # remove the $ sign
-        
-        return_string = ""
-        
-        if len(all_brand) != 0:
-            brand_preference = f"Brand Preference: "
-            for i in all_brand:
-                brand_preference += f"{i}({random.choice(['favor', 'aversion','neutral'])}) "
-            brand_preference = brand_preference.strip() + ";\n"
-            return_string += brand_preference
-        
-        if len(all_color) != 0:
-            color_preference = f"Color Preference: "
-            for i in all_color:
-                color_preference += f"{i}({random.choice(['favor', 'aversion','neutral'])}) "
-            color_preference = color_preference.strip() + ";\n"
-            return_string += color_preference
-            
-        if len(all_customerRating) != 0:
-            median_value = round(statistics.median(all_customerRating), 1)
-            customerRating_preference = f"Review Preference: greater than {median_value};\n"
-            return_string += customerRating_preference
-        
-        if len(all_materials) != 0:
-            materials_preference = f"Materials Preference: "
-            for i in all_materials:
-                materials_preference += f"{i}({random.choice(['favor', 'aversion','neutral'])}) "
-            materials_preference = materials_preference.strip() + ";\n"
-            return_string += materials_preference
-        
-        if len(all_price) != 0:
-            median_value = round(statistics.median(all_price), 2)
-            price_preference = f"Price Preference: less than {median_value};\n"
-            return_string += price_preference
-            
-        if len(all_type) != 0:
-            type_preference = f"Type Preference: "
-            for i in all_type:
-                if strict_preference is not None and i == strict_preference:
-                    type_preference += f"{i}({random.choice(['favor', 'neutral'])}) "
+                    values.add(v.get(attribute, "NULL"))
+            values.discard("NULL")
+            # sorted, since set order depends on the string hash seed of the process
+            values = sorted(values, key=str)
+        if len(values) == 0:
+            continue
+        if kind == "greater_than_median":
+            values = round(statistics.median(values if numbers is not None else [parse(x) for x in values]), 1)
+        elif kind == "less_than_median":
+            values = round(statistics.median(values if numbers is not None else [parse(x) for x in values]), 2)
+        else:
+            values = tuple(values)
+        summary.append((label, kind, values))
+    return summary
+
+def get_preference_summary(objects_info, domain, metadata=None):
+    """The summary of a scene, computed once per set of objects and kept in a bounded process-wide cache."""
+    key = (domain, tuple(sorted(objects_info)))
+    summary = _preference_summaries.get(key)
+    if summary is None:
+        summary = _preference_summaries[key] = summarize_preferences(objects_info, domain, metadata=metadata)
+        if len(_preference_summaries) > MAX_PREFERENCE_SUMMARIES:
+            _preference_summaries.popitem(last=False)
+    else:
+        _preference_summaries.move_to_end(key)
+    return summary
+
+def _median_preference(label, kind, median_value):
+    return f"{label}: {'greater' if kind == 'greater_than_median' else 'less'} than {median_value};\n"
+
+def simulate_user_preference(objects_info, domain, strict_preference=None, metadata=None):
+    if domain not in PREFERENCE_SCHEMAS:
+        return None
+    return_string = ""
+    for label, kind, values in get_preference_summary(objects_info, domain, metadata=metadata):
+        if kind == "choices" or kind == "type_choices":
+            preferences = []
+            for i in values:
+                if kind == "type_choices" and strict_preference is not None and i == strict_preference:
+                    preferences.append(f"{i}({random.choice(STRICT_PREFERENCE_CHOICES)})")
                 else:
-                    type_preference += f"{i}({random.choice(['favor', 'aversion','neutral'])}) "
-            type_preference = type_preference.strip() + ";\n"
-            return_string += type_preference
-        
-        return return_string
+                    preferences.append(f"{i}({random.choice(PREFERENCE_CHOICES)})")
+            return_string += f"{label}: " + " ".join(preferences) + ";\n"
+        elif kind == "one_of":
+            return_string += f"{label}: {random.choice(values)};\n"
+        else:
+            return_string += _median_preference(label, kind, values)
+    return return_string
+
+
+
+@functools.lru_cache(maxsize=MAX_PREFERENCE_SUMMARIES)
+def _preference_fragments(summary, strict_preference):
+    """
+    The preferences of a scene as a list of (label, kind, fragments): a random section has one tuple of
+    fragments per draw, one of which is picked, and a median section has its text.
+    """
+    sections = []
+    for label, kind, values in summary:
+        if kind == "choices" or kind == "type_choices":
+            fragments = [tuple(f"{i}({choice})" for choice in
+                               (STRICT_PREFERENCE_CHOICES if kind == "type_choices" and strict_preference is not None and i == strict_preference else PREFERENCE_CHOICES))
+                         for i in values]
+            sections.append((label, kind, fragments))
+        elif kind == "one_of":
+            sections.append((label, kind, [tuple(str(i) for i in values)]))
+        else:
+            sections.append((label, kind, _median_preference(label, kind, values)))
+    return sections
+
+def sample_user_preferences(requests, rng=None, metadata_by_domain=None):
+    """
+    The preferences of many users at once, each with the same distribution as `simulate_user_preference`:
+    `requests` is a list of (objects_info, domain, strict_preference), and the random draws of all of them are
+    made by a single call on the numpy generator `rng`. Without `rng`, a generator is seeded from the `random`
+    module, so a seeded run stays reproducible. A request of an unknown domain gets None. The metadata of a
+    domain in `metadata_by_domain` are used as in `simulate_user_preference`.
+    """
+    metadata_by_domain = metadata_by_domain or {}
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+    plans = [_preference_fragments(tuple(get_preference_summary(objects_info, domain, metadata=metadata_by_domain.get(domain))), strict_preference) if domain in PREFERENCE_SCHEMAS else None
+             for objects_info, domain, strict_preference in requests]
+    sizes = [len(fragments) for plan in plans if plan is not None for label, kind, section in plan if not isinstance(section, str) for fragments in section]
+    draws = rng.integers(0, sizes).tolist() if sizes else []
+
+    preferences = []
+    position = 0
+    for plan in plans:
+        if plan is None:
+            preferences.append(None)
+            continue
+        return_string = ""
+        for label, kind, section in plan:
+            if isinstance(section, str):
+                return_string += section
+                continue
+            picked = [fragments[draw] for fragments, draw in zip(section, draws[position:position + len(section)])]
+            position += len(section)
+            if kind == "one_of":
+                return_string += f"{label}: {picked[0]};\n"
+            else:
+                return_string += f"{label}: " + " ".join(picked) + ";\n"
+        preferences.append(return_string)
+    return preferences
         
         
 def reformat_objects_info(objects_info, domain):
@@ -332,29 +385,131 @@ def reformat_objects_info(objects_info, domain):
             return_reformat_objects_info += v["type"] + ": customer rating (" + str(v["customerRating"]) + "), color (" + v["color"] + "), brand (" + v["brand"] + "), materials (" + v["materials"] + "), price (" + v["price"] + ");\n"
     return return_reformat_objects_info
 
+# The product descriptions of the scenes seen last; a scene is drawn by many dialogs, and describing its products
+# takes most of the time of create_instruct
+PRODUCT_DESCRIPTIONS_MAX_ENTRIES = 4096
+_product_descriptions = OrderedDict()
+_product_descriptions_lock = threading.Lock()
+
+def describe_scene_products(objects_info, domain):
+    """reformat_objects_info of the products of a scene, computed once per scene."""
+    key = (domain, tuple(objects_info))
+    with _product_descriptions_lock:
+        products_desc = _product_descriptions.get(key)
+        if products_desc is not None:
+            _product_descriptions.move_to_end(key)
+            return products_desc
+    products_desc = reformat_objects_info(objects_info, domain=domain)
+    with _product_descriptions_lock:
+        _product_descriptions[key] = products_desc
+        while len(_product_descriptions) > PRODUCT_DESCRIPTIONS_MAX_ENTRIES:
+            _product_descriptions.popitem(last=False)
+    return products_desc
+
+COMPRESS_META_SUFFIX = ".meta.json"
+SMALL_IMAGE_TARGET_SIZE_KB = 100
+
+def get_small_image_path(image_path, small_image_cache_dir):
+    """The path of the compressed copy of a scene image in the small image cache."""
+    return os.path.join(small_image_cache_dir, os.path.basename(image_path).replace(".png", "_small.jpg"))
+
+def file_sha256(path, chunk_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def _load_compress_meta(meta_path):
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_atomic(path, data):
+    # 每个写入者使用自己的临时文件 (同一目录下), 多个进程同时压缩同一图片时互不干扰
+    tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _save_compress_meta(meta_path, meta):
+    _write_atomic(meta_path, json.dumps(meta, indent=4).encode("utf-8"))
+
+def _encode_jpeg(img, quality):
+    with io.BytesIO() as buffer:
+        img.save(buffer, format='JPEG', quality=quality)
+        return buffer.getvalue()
+
 # 将 PNG 图片转换为 JPEG，并压缩到100KB以内
-def compress_image(input_path, output_path, target_size_kb=100):
+def compress_image(input_path, output_path, target_size_kb=100, max_side=None, min_quality=10, max_quality=85):
+    """
+    Convert the image to a JPEG of at most `target_size_kb` KB with the highest quality in
+    [min_quality, max_quality] found by binary search (min_quality if no quality fits), optionally
+    downscaling it first so that its longer side is at most `max_side` pixels.
+    A sidecar `<output_path>.meta.json` records the source hash and the settings; when it matches,
+    the existing output is reused without decoding the source.
+    Returns the metadata of the compressed image.
+    """
+    meta_path = output_path + COMPRESS_META_SUFFIX
+    settings = {"target_size_kb": target_size_kb, "max_side": max_side, "min_quality": min_quality, "max_quality": max_quality}
+    source_stat = os.stat(input_path)
+
+    # 缓存命中: 设置相同, 源文件未变 (先比较 mtime 和大小, 不同时再比较哈希), 输出文件完整
+    meta = _load_compress_meta(meta_path)
+    if meta is not None and meta.get("settings") == settings and os.path.exists(output_path) and os.path.getsize(output_path) == meta["output_bytes"]:
+        if meta["source_mtime_ns"] == source_stat.st_mtime_ns and meta["source_bytes"] == source_stat.st_size:
+            return meta
+        if meta["source_sha256"] == file_sha256(input_path):
+            meta.update(source_mtime_ns=source_stat.st_mtime_ns, source_bytes=source_stat.st_size)
+            _save_compress_meta(meta_path, meta)
+            return meta
+
     # 打开原始图片
     with Image.open(input_path) as img:
         # 转换为 JPEG 格式
         img = img.convert('RGB')
+        # 先缩小尺寸 (可选)
+        if max_side is not None and max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
 
-        # 逐步调整质量来压缩图片大小
-        quality = 85  # 初始压缩质量
-        while True:
-            # 将图片保存到字节流中
-            with io.BytesIO() as buffer:
-                img.save(buffer, format='JPEG', quality=quality)
-                size_kb = buffer.tell() / 1024  # 计算图片的KB大小
-                
-                if size_kb <= target_size_kb or quality <= 10:  # 满足条件则停止
-                    buffer.seek(0)
-                    # 将压缩后的图片保存到文件中
-                    with open(output_path, 'wb') as f:
-                        f.write(buffer.read())
-                    break
-                # 降低质量继续压缩
-                quality -= 5
+        # 二分查找满足大小限制的最高质量
+        low, high = min_quality, max_quality
+        best_quality, best_data = None, None
+        while low <= high:
+            quality = (low + high) // 2
+            data = _encode_jpeg(img, quality)
+            if len(data) / 1024 <= target_size_kb:
+                best_quality, best_data = quality, data
+                low = quality + 1
+            else:
+                high = quality - 1
+        if best_data is None:  # 最低质量也超出限制时, 使用最低质量
+            best_quality, best_data = min_quality, _encode_jpeg(img, min_quality)
+        width, height = img.size
+
+    # 将压缩后的图片保存到文件中 (先写临时文件, 避免留下不完整的输出)
+    _write_atomic(output_path, best_data)
+
+    meta = {
+        "source_path": input_path,
+        "source_sha256": file_sha256(input_path),
+        "source_mtime_ns": source_stat.st_mtime_ns,
+        "source_bytes": source_stat.st_size,
+        "settings": settings,
+        "quality": best_quality,
+        "width": width,
+        "height": height,
+        "output_bytes": len(best_data),
+    }
+    _save_compress_meta(meta_path, meta)
+    return meta
 
 def create_instruct(
         scene_image_path,
@@ -369,115 +524,46 @@ def create_instruct(
         max_interaction_step,
         second_scene_image_path,
         second_scene_image_info_path,
-        different_type_name
+        different_type_name,
+        simulate_preference=None,
+        second_simulate_preference=None
     ):
-    """Create instructions about the conversation environment and roles."""
-    # Describe the environment (shared by all roles)
-    env_desc = f"You are now participating in a conversation happening in a {domain} store."
-    if scene_image_path is not None and second_scene_image_path is not None:
-        env_desc += f"The image provided is the snapshot of this store."
-    
-    # Describe the user
-    user_desc = "You are {}, ".format(user_profile["Name"])
-    profile_desc = ""
-    
-    if user_profile["Occupation"] == "Student":
-        if user_profile["Gender"] == "Male":
-            profile_desc = "a male student in the age range of {}, living in {}".format(user_profile["Age Range"].lower(), user_profile["Residence"])
-        else:
-            profile_desc = "a female student in the age range of {}, living in {}".format(user_profile["Age Range"].lower(), user_profile["Residence"])
-    elif user_profile["Occupation"] == "Employed":
-        if user_profile["Gender"] == "Male":
-            profile_desc = "a man in the age range of {}, working in a company and living in {}".format(user_profile["Age Range"].lower(), user_profile["Residence"])
-        else:
-            profile_desc = "a woman in the age range of {}, working in a company and living in {}".format(user_profile["Age Range"].lower(), user_profile["Residence"])
-    else:
-        if user_profile["Gender"] == "Male":
-            profile_desc = "a retired man in the age range of {}, living in {}".format(user_profile["Age Range"].lower(), user_profile["Residence"])
-        else:
-            profile_desc = "a retired woman in the age range of {}, living in {}".format(user_profile["Age Range"].lower(), user_profile["Residence"])
-    user_desc += profile_desc + ".\n\n"
-    
+    """Create instructions about the conversation environment and roles, the preferences are drawn unless given."""
     # extract_object_info
     objects_info = extract_object_info(scene_image_info_path, metadata)
     second_objects_info = extract_object_info(second_scene_image_info_path, metadata)
-    # user_desc += "You are currently in a {} store, where you can see the following objects:\n".format(domain)
-    user_desc += "Based on your past experiences, you have the following preferences:\n"
-    
-    simulate_preference = simulate_user_preference(objects_info, domain=domain)
-    second_simulate_preference = simulate_user_preference(second_objects_info, domain=domain, strict_preference=different_type_name)
-    
-    user_desc_original = user_desc + simulate_preference + "\n"
-    user_desc_transition = user_desc + second_simulate_preference + "\n"
-    
-    # print (Fore.GREEN + f"user_desc_original: {user_desc_original}" + Style.RESET_ALL)
-    # print (Fore.GREEN + f"user_desc_transition: {user_desc_transition}" + Style.RESET_ALL)
-    
-    user_desc_original += "Based on the Big-5 personality traits, your personality is measured as:\n"
-    user_desc_transition += "Based on the Big-5 personality traits, your personality is measured as:\n"
-    for k, v in user_personality.items():
-        user_desc_original += "For {}, you are {}.\n".format(k, v)
-        user_desc_transition += "For {}, you are {}.\n".format(k, v)
-    user_desc_original += "\n"
-    user_desc_transition += "\n"
     
-    user_desc_original += "Your response should match your profile and personality, and be concise (no longer than 30 words).\n"
-    user_desc_original += "You don't need to recommend anything, but feel free to express your personal interests."
+    if simulate_preference is None:
+        simulate_preference = simulate_user_preference(objects_info, domain=domain, metadata=metadata)
+    if second_simulate_preference is None:
+        second_simulate_preference = simulate_user_preference(second_objects_info, domain=domain, strict_preference=different_type_name, metadata=metadata)
     
-    user_desc_transition += "Your response should match your profile and personality, and be concise (no longer than 30 words).\n"
-    user_desc_transition += "You don't need to recommend anything, but feel free to express your personal interests."
-    
-    user_desc_at_transition_turn = user_desc_transition + " In this round, you must seek recommendations of type {0}, and you should shift the topic of the conversation to the content of type {0}.".format(different_type_name)
-    user_desc_at_transition_turn += "For example: 'That sounds good, but I would like to buy a type {0} instead.'".format(different_type_name)
-
-    user_dict = {
-        "name": user_profile["Name"],
-        "role_desc": user_desc_original,
-        "role_desc_in_transition_turn": user_desc_at_transition_turn,
-        "role_desc_after_transition_turn": user_desc_transition
-    }
-    
-    assistant_name = assistant_profile["Name"]
-    assistant_desc = f"You are {assistant_name}, a saleperson in a {domain} store.\n"
-    assistant_desc += "You are here to converse and assist {} with {} shopping.\n".format(user_profile["Name"], domain)
-    assistant_desc += "Your goal is to capture user preferences and make recommendations based on the products in the store."
-    assistant_desc += "Below are the products available in the store:\n\n"
-    
-    assistant_desc_original = assistant_desc + reformat_objects_info(objects_info, domain=domain) + "\n"
-    assistant_desc_transition = assistant_desc + reformat_objects_info(second_objects_info, domain=domain) + "\n"
-    
-    assistant_desc_original += "Be informative and engaging while providing insights to arouse {}'s interest.\n".format(user_profile["Name"])
-    assistant_desc_original += "Your words at each turn should be concise (no longer than 30 words).\n\n"
-    
-    assistant_desc_transition += "Be informative and engaging while providing insights to arouse {}'s interest.\n".format(user_profile["Name"])
-    assistant_desc_transition += "Your words at each turn should be concise (no longer than 30 words).\n\n"
-    
-    assistant_dict = {
-        "name": assistant_profile["Name"],
-        "role_desc": assistant_desc_original,
-        "role_desc_in_transition_turn": assistant_desc_original,
-        "role_desc_after_transition_turn": assistant_desc_transition
-    }
-
-    # Describe the moderator
-    moderator_desc = "You are the moderator of a conversation. You need to determine whether the discussion between Role-S and Role-U should come to an immediate end.\n"
-    moderator_desc += "The conversation should conclude under the following two conditions:\n"
-    moderator_desc += "(1) If Role-S completes the recommendation, the user accepts the recommendation\n"
-    moderator_desc += "(2) If Role-U explicitly rejects Role-S's recommendation when Role-S has tried to recommend it for the second time.\n"
-    moderator_desc += f"(3) The conversation between the user and the system reaches the maximum number of rounds limit ({max_interaction_step} rounds)"
-    
-    moderator_desc += "In either of these cases, the conversation should be brought to an immediate end.\n\n"
-
-    moderator_desc += "For example, here is a conversation:\n## {}".format(conversation_end_or_continue_sample["seed_continue"])
-    moderator_desc += "Should the conversation end? The answer is no.\n\n"
-    moderator_desc += "Here is another conversation:\n## {}".format(conversation_end_or_continue_sample["seed_end"])
-    moderator_desc += "Should the conversation end? The answer is yes."
-
-    terminal_condition = "Now, for the above discussion between {} (Role-S) and {} (Role-U), should the conversation end? Answer yes or no.".format(user_profile["Name"], assistant_name)
-
-    moderator_dict = {
-        "role_desc": moderator_desc,
-        "terminal_condition": terminal_condition
-    }
+    env_desc, user_dict, assistant_dict, moderator_dict = render_instructions(
+        domain=domain,
+        user_profile=user_profile,
+        assistant_profile=assistant_profile,
+        user_personality=user_personality,
+        conversation_end_or_continue_sample=conversation_end_or_continue_sample,
+        max_interaction_step=max_interaction_step,
+        different_type_name=different_type_name,
+        simulate_preference=simulate_preference,
+        second_simulate_preference=second_simulate_preference,
+        products_desc=describe_scene_products(objects_info, domain),
+        second_products_desc=describe_scene_products(second_objects_info, domain),
+        with_image=scene_image_path is not None and second_scene_image_path is not None
+    )
+    return env_desc, user_dict, assistant_dict, moderator_dict, objects_info, simulate_preference, second_objects_info, second_simulate_preference
 
-    return env_desc, user_dict, assistant_dict, moderator_dict, objects_info, simulate_preference, second_objects_info, second_simulate_preference
\ No newline at end of file
+def create_instruct_batch(instruct_kwargs_list):
+    """
+    Create the instructions of several dialogs (a list of create_instruct keyword arguments); the preferences of
+    all the users are drawn by one `sample_user_preferences` call, and the products of a scene are described once
+    for all the dialogs that share it.
+    """
+    requests = []
+    for kwargs in instruct_kwargs_list:
+        requests.append((extract_object_info(kwargs["scene_image_info_path"], kwargs["metadata"]), kwargs["domain"], None))
+        requests.append((extract_object_info(kwargs["second_scene_image_info_path"], kwargs["metadata"]), kwargs["domain"], kwargs["different_type_name"]))
+    preferences = sample_user_preferences(requests, metadata_by_domain={kwargs["domain"]: kwargs["metadata"] for kwargs in instruct_kwargs_list})
+    return [create_instruct(**kwargs, simulate_preference=preferences[2 * i], second_simulate_preference=preferences[2 * i + 1])
+            for i, kwargs in enumerate(instruct_kwargs_list)]
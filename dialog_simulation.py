@@ -4,12 +4,28 @@ import json
 import os
 import random
 import argparse
+import asyncio
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from chatarena.agent import Player, Moderator
-from chatarena.backends import OpenAIChat
+from chatarena.backends import OpenAIChat, LocalModerator
+from chatarena.backends.local_moderator import get_local_moderator_stats
+from chatarena.backends.moderator_batcher import BatchedModerator, get_moderator_batcher_stats
+from chatarena.backends.response_cache import ResponseCache, set_response_cache, get_response_cache
+from chatarena.backends.openai_clients import configure_openai_clients
+from chatarena.backends.concurrency import AdaptiveConcurrencyLimiter, set_concurrency_limiter
+from chatarena.backends.resilience import ResiliencePolicy, CircuitBreaker, set_resilience_policy, get_resilience_policy
+from chatarena.backends.rate_limit import RateLimiter, set_rate_limiter, get_rate_limiter
+from chatarena.backends.openai_batch import BatchJobRunner, OpenAIBatchTransport, LocalBatchTransport, set_batch_job_runner, get_batch_job_runner
 from chatarena.environments.conversation import ModeratedConversation
-from chatarena.arena import Arena
-from data_utils import find_word_in_string, random_select_scene, sample_profile, create_instruct, compress_image
+from chatarena.arena import Arena, TooManyInvalidActions, SpeculationStats
+from chatarena.vector_arena import VectorArena
+from run_manifest import RunManifest
+from scene_index import SceneIndex
+from product_catalog import load_product_catalog
+from accept_policy import InteractivePolicy, AcceptAllPolicy, load_policy, POLICY_REGISTRY
+from data_utils import find_word_in_string, random_select_scene, sample_profile, create_instruct, compress_image, get_small_image_path, SMALL_IMAGE_TARGET_SIZE_KB, get_scene_objects_cache
 from colorama import Fore, Back, Style, init
 
 
@@ -38,12 +54,50 @@ def parse_args():
     parser.add_argument("--model_name", type=str, default="gpt-4o-mini", help="The chat model to use.")
     parser.add_argument("--output_dir", type=str, default="data/SCREEN", help="The output directory to save the simulated dialog data.")
     parser.add_argument("--temperature", type=float, default=0.75, help="The temperature to use in sampling.")
+    parser.add_argument("--moderator_backend", type=str, default="llm", choices=["llm", "local"], help="Decide whether a dialog ends with the LLM moderator (llm), or with local rules and classifier that ask the LLM only when they are uncertain (local).")
+    parser.add_argument("--moderator_classifier_path", type=str, default=None, help="The classifier of the local moderator, trained by train_moderator_classifier.py (default: rules only).")
+    parser.add_argument("--moderator_threshold", type=float, default=0.95, help="The probability the classifier of the local moderator needs to decide without the LLM.")
+    parser.add_argument("--moderator_fallback", type=str2bool, default="true", help="Whether the local moderator asks the LLM when it is uncertain, instead of continuing the dialog.")
+    parser.add_argument("--moderator_min_rounds", type=int, default=0, help="The local moderator continues the dialogs shorter than this number of rounds without checking them.")
+    parser.add_argument("--moderator_batch_size", type=int, default=0, help="Send the moderator checks of up to this many in-flight dialogs in one request (async engine and worker processes, 0: one request per check).")
+    parser.add_argument("--moderator_batch_wait", type=float, default=0.05, help="How long (in seconds) a moderator check waits for the others of its batch.")
     parser.add_argument("--small_img_cache_dir", type=str, default="./cache/images", help="The directory to save the small image cache.")
+    parser.add_argument("--catalog_dir", type=str, default="./cache/catalogs", help="Where to build and memory-map the product catalogs of the metadata files (empty: load the metadata JSON files).")
+    parser.add_argument("--scene_index_path", type=str, default="./cache/scene_index.json", help="Where to persist the index of the scenes of the seed dialogs, it is rebuilt when the scene pools or the seed data change (empty: rebuild it in memory every run).")
+    parser.add_argument("--small_img_max_side", type=int, default=None, help="Downscale the scene images so that their longer side is at most this many pixels before compressing them.")
+    parser.add_argument("--engine", type=str, default="sync", choices=["sync", "async", "vector"], help="Run the dialogs one by one in the CLI (sync), concurrently in an event loop (async), or in lockstep with their turns sent in batches (vector).")
+    parser.add_argument("--concurrency", type=int, default=8, help="The max number of dialogs in flight with the async and vector engines.")
+    parser.add_argument("--speculative_turns", type=str2bool, default="false", help="Start the next player's turn while the moderator checks whether the dialog is over, and drop it if the dialog is over (async engine and worker processes).")
+    parser.add_argument("--num_workers", type=int, default=0, help="Split the dialogs across this many worker processes (0: generate in the main process).")
+    parser.add_argument("--resume", type=str, default=None, help="Resume the run in this run directory, skipping the dialogs it has already finished.")
+    parser.add_argument("--headless", type=str2bool, default="false", help="Run the dialogs back-to-back without the CLI rendering and the save prompt.")
+    parser.add_argument("--accept_policy", type=str, default=None, choices=list(POLICY_REGISTRY), help="How to decide whether a dialog is saved (default: interactive in the sync CLI, accept_all otherwise). Rejected dialogs go to rejected_dialogs.json.")
     
     # Output Control
     parser.add_argument("--show_message", type=str2bool, default="true", help="Whether to show the conversation messages.")
     parser.add_argument("--show_description", type=str2bool, default="false", help="Whether to show the role description.")
     
+    # LLM Backends
+    parser.add_argument("--openai_base_url", type=str, default=None, help="The base URL of the OpenAI API (default: $OPENAI_BASE_URL or the official endpoint).")
+    parser.add_argument("--max_connections", type=int, default=None, help="The size of the connection pool shared by all the OpenAI backends of a process.")
+    parser.add_argument("--response_cache_path", type=str, default=None, help="Cache the LLM responses in this SQLite file and reuse them for identical requests.")
+    parser.add_argument("--response_cache_max_entries", type=int, default=None, help="Evict the least recently used responses beyond this number of entries.")
+    parser.add_argument("--response_cache_max_age_days", type=float, default=None, help="Evict the responses older than this number of days.")
+    parser.add_argument("--adaptive_concurrency", type=str2bool, default="false", help="Adapt the number of OpenAI requests in flight to the provider: grow it while the requests succeed and cut it on 429s, 5xx errors and rising latency (async engine, --concurrency is then the number of dialogs in flight).")
+    parser.add_argument("--adaptive_initial_limit", type=int, default=8, help="The number of requests in flight the adaptive concurrency starts with.")
+    parser.add_argument("--adaptive_max_limit", type=int, default=None, help="The max number of requests in flight of the adaptive concurrency (default: --concurrency).")
+    parser.add_argument("--request_timeout", type=float, default=None, help="The deadline (in seconds) of an OpenAI request, a request past it is retried.")
+    parser.add_argument("--hedge_percentile", type=float, default=None, help="Send a duplicate of an OpenAI request slower than this percentile of the recent latencies (e.g. 95), and take the first answer.")
+    parser.add_argument("--max_hedges", type=int, default=1, help="The max number of duplicates of a slow request.")
+    parser.add_argument("--circuit_breaker_failures", type=int, default=0, help="Fail the requests at once for --circuit_breaker_reset seconds after this many failures of the endpoint in a row (0: off).")
+    parser.add_argument("--circuit_breaker_reset", type=float, default=30.0, help="How long (in seconds) the circuit stays open before a trial request.")
+    parser.add_argument("--rpm_limit", type=float, default=None, help="Keep the OpenAI requests under this many requests per minute, across the worker processes.")
+    parser.add_argument("--tpm_limit", type=float, default=None, help="Keep the OpenAI requests under this many estimated tokens per minute, across the worker processes.")
+    parser.add_argument("--rate_limit_state_path", type=str, default=None, help="The file that shares the rate limits between processes, e.g. between runs of the same account (default: in the run directory with --num_workers).")
+    parser.add_argument("--openai_batch_dir", type=str, default=None, help="Send the turns of every step as an OpenAI Batch API job, with the batch files in this directory (vector engine).")
+    parser.add_argument("--openai_batch_poll_interval", type=float, default=30.0, help="How often (in seconds) to poll a submitted batch job.")
+    parser.add_argument("--openai_batch_local", type=str2bool, default="false", help="Run the batch jobs with the local file-based stand-in of the Batch API, which sends the requests one by one.")
+    
     parser.add_argument("--random_seed", type=int, default=1135)
     return parser.parse_args()
 
@@ -103,29 +157,11 @@ def sample_personality():
     return sampled_personality
 
 #### generate dialog data
-def generate_dialog_data(
-    train_scenes_images_pool_path,
-    test_scenes_images_pool_path,
-    train_scenes_images_info_pool_path,
-    test_scenes_images_info_pool_path,
-    fashion_metadata_path,
-    furniture_metadata_path,
-    user_profiles_path,
-    seed_data_path,
-    max_generated_dialogs=2,
-    max_interaction_step=10,
-    min_transition_step=3,
-    max_transition_step=5,
-    max_system_tokens=100,
-    max_user_tokens=80,
-    max_moderator_tokens=10,
-    model_name="gpt-4o-mini",
-    temperature=0.75,
-    output_dir=os.path.join("GeneratedData", "SCREEN"),
-    show_description=True,
-    show_message=True,
-    small_image_cache_dir="./cache/images"
-):
+def load_generation_resources(seed_data_path, user_profiles_path, fashion_metadata_path, furniture_metadata_path, catalog_dir=None):
+    """
+    Load the seed dialogs, user profile slots and product metadata shared by all dialogs.
+    With a `catalog_dir` the metadata are memory-mapped product catalogs (see product_catalog.py) instead of dicts.
+    """
     if not os.path.exists(seed_data_path):
         raise ValueError(f"Few-shot data path {seed_data_path} does not exist.")
     else:
@@ -142,6 +178,16 @@ def generate_dialog_data(
     # for key, value in profile_slots.items():
     #     print (f"Key: {key} - Num of Value: {len(value)}", flush=True)
         
+    if catalog_dir:
+        fashion_metadata = load_product_catalog(fashion_metadata_path, catalog_dir)
+        furniture_metadata = load_product_catalog(furniture_metadata_path, catalog_dir)
+        return {
+            "seed_dialog_data": seed_dialog_data,
+            "profile_slots": profile_slots,
+            "fashion_metadata": fashion_metadata,
+            "furniture_metadata": furniture_metadata,
+        }
+
     # load fashion metadata
     with open(fashion_metadata_path, "r", encoding='utf-8') as f:
         fashion_metadata = json.load(f)
@@ -154,128 +200,658 @@ def generate_dialog_data(
     # print (Fore.RED + f"Loaded Furniture Metadata" + Style.RESET_ALL, flush=True)
     # print (Fore.GREEN + f"Total Furniture Metadata: {len(furniture_metadata)}" + Style.RESET_ALL, flush=True)
 
-    # Create the output directory
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-        
-    if not os.path.exists(small_image_cache_dir):
-        os.makedirs(small_image_cache_dir)
-        
-    # Create the output file with the timestamp
-    time_flag = time.strftime("%Y%m%d%H%M%S", time.localtime())
-    output_path = os.path.join(output_dir, f"simulated_dialogs_{time_flag}.json")
+    return {
+        "seed_dialog_data": seed_dialog_data,
+        "profile_slots": profile_slots,
+        "fashion_metadata": fashion_metadata,
+        "furniture_metadata": furniture_metadata,
+    }
+
+def load_scene_index(resources, spec_kwargs, scene_index_path=None):
+    """Add the index of the scenes of the seed dialogs in the scene pool to the resources."""
+    resources["scene_index"] = SceneIndex.load_or_build(scene_index_path or None, spec_kwargs["scenes_images_pool_path"], spec_kwargs["scenes_images_info_pool_path"], resources["seed_dialog_data"], resources["fashion_metadata"], resources["furniture_metadata"])
+    return resources
+
+def sample_dialog_spec(
+    resources,
+    scenes_images_pool_path,
+    scenes_images_info_pool_path,
+    max_interaction_step=10,
+    min_transition_step=3,
+    max_transition_step=5,
+    small_image_cache_dir="./cache/images",
+    small_image_max_side=None
+):
+    """Sample the scenes, roles and instructions of one dialog (everything before the LLM calls)."""
+    scene_image_paths, scene_image_info_paths, metadata, dialog_example, domain, second_scene_images_paths, second_scene_images_info_paths, different_type_name = random_select_scene(scenes_images_pool_path, scenes_images_info_pool_path, resources["fashion_metadata"], resources["furniture_metadata"], resources["seed_dialog_data"], scene_begin_id=None, scene_index=resources.get("scene_index"))
+    # print (Fore.GREEN + f"Selected Scene: {scene_image_paths}" + Style.RESET_ALL)
+    # print (Fore.GREEN + f"Selected Scene Info: {scene_image_info_paths}" + Style.RESET_ALL)
+    # print (Fore.GREEN + f"Selected Domain: {domain}" + Style.RESET_ALL)
+    # print (Fore.GREEN + f"Selected Dialog Example: {dialog_example}" + Style.RESET_ALL)
     
+    # dict return {"seed_continue", "seed_end"}
+    conversation_end_or_continue_sample = sample_continue_or_end_conversation(dialog_example)
+
+    # randomly sample a personality
+    # {"agreeableness": ["trustworthy], "conscientiousness": ["efficient"], "extraversion": ["outgoing"], "neuroticism": ["sensitive"], "openness": ["intellectual"]}
+    simulated_user_personality = sample_personality()
+    simulated_assistant_personality = sample_personality()
+    
+    # randomly sample a user profile and a assistant profile
+    simulated_user_profile = sample_profile(resources["profile_slots"])
+    simulated_assistant_profile = sample_profile(resources["profile_slots"], exclude_name=simulated_user_profile["Name"])
+    
+    # print (Fore.GREEN + f"Simulated User Profile: {simulated_user_profile}" + Style.RESET_ALL)
+    # print (Fore.GREEN + f"Simulated Assistant Profile: {simulated_assistant_profile}" + Style.RESET_ALL)
+    
+    small_image_path = get_small_image_path(scene_image_paths[0], small_image_cache_dir)
+    compress_image(scene_image_paths[0], small_image_path, target_size_kb=SMALL_IMAGE_TARGET_SIZE_KB, max_side=small_image_max_side)
+    second_small_image_path = get_small_image_path(second_scene_images_paths[0], small_image_cache_dir)
+    compress_image(second_scene_images_paths[0], second_small_image_path, target_size_kb=SMALL_IMAGE_TARGET_SIZE_KB, max_side=small_image_max_side)
     
-    with open(output_path, "w", encoding='utf-8') as fw:
-        for i in range(max_generated_dialogs):
-            print (Fore.RED + f"Generating Dialog {i+1}/{max_generated_dialogs}" + Style.RESET_ALL, flush=True)
-            
-            scene_image_paths, scene_image_info_paths, metadata, dialog_example, domain, second_scene_images_paths, second_scene_images_info_paths, different_type_name = random_select_scene(train_scenes_images_pool_path, train_scenes_images_info_pool_path, fashion_metadata, furniture_metadata, seed_dialog_data, scene_begin_id=None)
-            # print (Fore.GREEN + f"Selected Scene: {scene_image_paths}" + Style.RESET_ALL)
-            # print (Fore.GREEN + f"Selected Scene Info: {scene_image_info_paths}" + Style.RESET_ALL)
-            # print (Fore.GREEN + f"Selected Domain: {domain}" + Style.RESET_ALL)
-            # print (Fore.GREEN + f"Selected Dialog Example: {dialog_example}" + Style.RESET_ALL)
             
-            # dict return {"seed_continue", "seed_end"}
-            conversation_end_or_continue_sample = sample_continue_or_end_conversation(dialog_example)
+    env_desc, user_dict, assistant_dict, moderator_dict, objects_info_in_scene, simulate_user_preference, second_objects_info, second_simulate_preference = create_instruct(
+        scene_image_path=small_image_path,
+        scene_image_info_path=scene_image_info_paths[0],
+        metadata=metadata,
+        domain=domain,
+        user_profile=simulated_user_profile,
+        assistant_profile=simulated_assistant_profile,
+        user_personality=simulated_user_personality,
+        assistant_personality=simulated_assistant_personality,
+        conversation_end_or_continue_sample=conversation_end_or_continue_sample,
+        max_interaction_step=max_interaction_step,
+        second_scene_image_path=second_small_image_path,
+        second_scene_image_info_path=second_scene_images_info_paths[0],
+        different_type_name=different_type_name
+    )
+    # print (Fore.GREEN + f"Environment Description: {env_desc}" + Style.RESET_ALL)
+    # print (Fore.GREEN + f"User Dict: {user_dict}" + Style.RESET_ALL)
+    # print (Fore.GREEN + f"Assistant Dict: {assistant_dict}" + Style.RESET_ALL)
+    # print (Fore.GREEN + f"Moderator Dict: {moderator_dict}" + Style.RESET_ALL)
+    
+    transition_turn = random.choice(range(min_transition_step, max_transition_step))
+    
+    # print (Fore.GREEN + f"Transition Turn: {transition_turn}" + Style.RESET_ALL)
+    # print (Fore.GREEN + f"Different Type Name: {different_type_name}" + Style.RESET_ALL)
+    
+    # print (Fore.BLUE + f"User Dict: {user_dict}" + Style.RESET_ALL)
+    # print (Fore.RED + f"Assistant Dict: {assistant_dict}" + Style.RESET_ALL)
 
-            # randomly sample a personality
-            # {"agreeableness": ["trustworthy], "conscientiousness": ["efficient"], "extraversion": ["outgoing"], "neuroticism": ["sensitive"], "openness": ["intellectual"]}
-            simulated_user_personality = sample_personality()
-            simulated_assistant_personality = sample_personality()
-            
-            # randomly sample a user profile and a assistant profile
-            simulated_user_profile = sample_profile(profile_slots)
-            simulated_assistant_profile = sample_profile(profile_slots, exclude_name=simulated_user_profile["Name"])
-            
-            # print (Fore.GREEN + f"Simulated User Profile: {simulated_user_profile}" + Style.RESET_ALL)
-            # print (Fore.GREEN + f"Simulated Assistant Profile: {simulated_assistant_profile}" + Style.RESET_ALL)
-            
-            small_image_path = os.path.join(small_image_cache_dir, os.path.basename(scene_image_paths[0]).replace(".png", "_small.jpg"))
-            compress_image(scene_image_paths[0], small_image_path, target_size_kb=100)
-            second_small_image_path = os.path.join(small_image_cache_dir, os.path.basename(second_scene_images_paths[0]).replace(".png", "_small.jpg"))
-            compress_image(second_scene_images_paths[0], second_small_image_path, target_size_kb=100)
-            
-                    
-            env_desc, user_dict, assistant_dict, moderator_dict, objects_info_in_scene, simulate_user_preference, second_objects_info, second_simulate_preference = create_instruct(
-                scene_image_path=small_image_path,
-                scene_image_info_path=scene_image_info_paths[0],
-                metadata=metadata,
-                domain=domain,
-                user_profile=simulated_user_profile,
-                assistant_profile=simulated_assistant_profile,
-                user_personality=simulated_user_personality,
-                assistant_personality=simulated_assistant_personality,
-                conversation_end_or_continue_sample=conversation_end_or_continue_sample,
-                max_interaction_step=max_interaction_step,
-                second_scene_image_path=second_small_image_path,
-                second_scene_image_info_path=second_scene_images_info_paths[0],
-                different_type_name=different_type_name
-            )
-            # print (Fore.GREEN + f"Environment Description: {env_desc}" + Style.RESET_ALL)
-            # print (Fore.GREEN + f"User Dict: {user_dict}" + Style.RESET_ALL)
-            # print (Fore.GREEN + f"Assistant Dict: {assistant_dict}" + Style.RESET_ALL)
-            # print (Fore.GREEN + f"Moderator Dict: {moderator_dict}" + Style.RESET_ALL)
-            
-            transition_turn = random.choice(range(min_transition_step, max_transition_step))
-            
-            # print (Fore.GREEN + f"Transition Turn: {transition_turn}" + Style.RESET_ALL)
-            # print (Fore.GREEN + f"Different Type Name: {different_type_name}" + Style.RESET_ALL)
-            
-            # print (Fore.BLUE + f"User Dict: {user_dict}" + Style.RESET_ALL)
-            # print (Fore.RED + f"Assistant Dict: {assistant_dict}" + Style.RESET_ALL)
-            
-            assistant = Player(
-                name=assistant_dict["name"], backend=OpenAIChat(model=model_name, temperature=temperature, max_tokens=max_system_tokens), role_desc=assistant_dict["role_desc"], role_desc_in_transition_turn=assistant_dict["role_desc_in_transition_turn"], role_desc_after_transition_turn=assistant_dict["role_desc_after_transition_turn"], transition_turn=transition_turn, global_prompt=env_desc, visual_path=small_image_path, second_visual_path=second_small_image_path)
-            user = Player(
-                name=user_dict["name"], backend=OpenAIChat(model=model_name, temperature=temperature, max_tokens=max_user_tokens), role_desc=user_dict["role_desc"], role_desc_in_transition_turn=user_dict["role_desc_in_transition_turn"], role_desc_after_transition_turn=user_dict["role_desc_after_transition_turn"], transition_turn=transition_turn, global_prompt=env_desc, visual_path=small_image_path, second_visual_path=second_small_image_path)
-            moderator = Moderator(
-                backend=OpenAIChat(model=model_name, temperature=temperature, max_tokens=max_moderator_tokens), 
-                role_desc=moderator_dict["role_desc"], 
-                role_desc_in_transition_turn=moderator_dict["role_desc"], 
-                role_desc_after_transition_turn=moderator_dict["role_desc"], 
-                transition_turn=transition_turn,
-                terminal_condition=moderator_dict["terminal_condition"])
-            # let assistant start the conversation
-            env = ModeratedConversation(player_names=[p.name for p in [assistant, user]], moderator=moderator, moderator_period="round")
-            arena = Arena(players=[assistant, user], environment=env, global_prompt=env_desc)
-            
-            arena.launch_cli(max_steps=max_interaction_step, show_description=show_description, show_message=show_message, interactive=False)
+    return {
+        "scene_image_paths": scene_image_paths,
+        "scene_image_info_paths": scene_image_info_paths,
+        "second_scene_images_paths": second_scene_images_paths,
+        "second_scene_images_info_paths": second_scene_images_info_paths,
+        "small_image_path": small_image_path,
+        "second_small_image_path": second_small_image_path,
+        "transition_turn": transition_turn,
+        "domain": domain,
+        "dialog_example": dialog_example,
+        "user_profile": simulated_user_profile,
+        "assistant_profile": simulated_assistant_profile,
+        "user_personality": simulated_user_personality,
+        "env_desc": env_desc,
+        "user_dict": user_dict,
+        "assistant_dict": assistant_dict,
+        "moderator_dict": moderator_dict,
+        "objects_info_in_scene": objects_info_in_scene,
+        "simulate_user_preference": simulate_user_preference,
+        "second_objects_info": second_objects_info,
+        "second_simulate_preference": second_simulate_preference,
+    }
+
+def build_arena(spec, model_name="gpt-4o-mini", temperature=0.75, max_system_tokens=100, max_user_tokens=80, max_moderator_tokens=10,
+                moderator_backend="llm", moderator_classifier_path=None, moderator_threshold=0.95, moderator_fallback=True, moderator_min_rounds=0, moderator_batch_size=0, moderator_batch_wait=0.05, speculative=False):
+    """Create the assistant, user and moderator of a sampled dialog and put them in an arena."""
+    env_desc = spec["env_desc"]
+    assistant_dict = spec["assistant_dict"]
+    user_dict = spec["user_dict"]
+    moderator_dict = spec["moderator_dict"]
+    transition_turn = spec["transition_turn"]
+    small_image_path = spec["small_image_path"]
+    second_small_image_path = spec["second_small_image_path"]
+
+    assistant = Player(
+        name=assistant_dict["name"], backend=OpenAIChat(model=model_name, temperature=temperature, max_tokens=max_system_tokens), role_desc=assistant_dict["role_desc"], role_desc_in_transition_turn=assistant_dict["role_desc_in_transition_turn"], role_desc_after_transition_turn=assistant_dict["role_desc_after_transition_turn"], transition_turn=transition_turn, global_prompt=env_desc, visual_path=small_image_path, second_visual_path=second_small_image_path)
+    user = Player(
+        name=user_dict["name"], backend=OpenAIChat(model=model_name, temperature=temperature, max_tokens=max_user_tokens), role_desc=user_dict["role_desc"], role_desc_in_transition_turn=user_dict["role_desc_in_transition_turn"], role_desc_after_transition_turn=user_dict["role_desc_after_transition_turn"], transition_turn=transition_turn, global_prompt=env_desc, visual_path=small_image_path, second_visual_path=second_small_image_path)
+    moderator_llm = OpenAIChat(model=model_name, temperature=temperature, max_tokens=max_moderator_tokens)
+    if moderator_batch_size > 1:
+        moderator_llm = BatchedModerator(moderator_llm, max_batch_size=moderator_batch_size, max_wait=moderator_batch_wait)
+    if moderator_backend == "local":
+        moderator_llm = LocalModerator(fallback=moderator_llm if moderator_fallback else None, classifier_path=moderator_classifier_path, threshold=moderator_threshold, min_rounds=moderator_min_rounds)
+    moderator = Moderator(
+        backend=moderator_llm, 
+        role_desc=moderator_dict["role_desc"], 
+        role_desc_in_transition_turn=moderator_dict["role_desc"], 
+        role_desc_after_transition_turn=moderator_dict["role_desc"], 
+        transition_turn=transition_turn,
+        terminal_condition=moderator_dict["terminal_condition"])
+    # let assistant start the conversation
+    env = ModeratedConversation(player_names=[p.name for p in [assistant, user]], moderator=moderator, moderator_period="round")
+    arena = Arena(players=[assistant, user], environment=env, global_prompt=env_desc, speculative=speculative)
+    return arena
+
+def make_dialog_id(run_id, dialog_idx):
+    """The id of a dialog, unique within and across runs and the same when the run is resumed or sharded."""
+    return f"{run_id}_{dialog_idx:06d}"
+
+def dialog_record(spec, arena, dialog_id):
+    """Convert a finished arena to the line written to the output file."""
+    assistant_name = spec["assistant_dict"]["name"]
+
+    # save the simulated dialog to file
+    messages = arena.environment.get_observation()
+    simulated_convs = []
+    for msg in messages:
+        if msg.agent_name == assistant_name:
+            utt = {"system": msg.content}
+        else:
+            utt = {"user": msg.content}
+        simulated_convs.append(utt)
+    
+    write_line = {
+        "id": dialog_id,
+        "scene_image_path": spec["scene_image_paths"][0],
+        "scene_image_info_path": spec["scene_image_info_paths"][0],
+        "second_scene_image_path": spec["second_scene_images_paths"][0],
+        "second_scene_image_info_path": spec["second_scene_images_info_paths"][0],
+        "transition_turn": spec["transition_turn"],
+        "domain": spec["domain"],
+        "seed_dialog": spec["dialog_example"],
+        "user_profile": spec["user_profile"],
+        "assistant_profile": spec["assistant_profile"],
+        "user_personality": spec["user_personality"],
+        "objects_info_in_scene": spec["objects_info_in_scene"],
+        "simulate_user_preference": spec["simulate_user_preference"],
+        "second_objects_info": spec["second_objects_info"],
+        "second_simulate_preference": spec["second_simulate_preference"],
+        "conversation": simulated_convs
+    }
+    return write_line
+
+def write_dialog_record(fw, write_line):
+    fw.write(json.dumps(write_line, ensure_ascii=False, indent=4) + "\n")
+    fw.flush()
+
+def setup_backend_services(backend_options):
+    """Set up the process-wide services shared by all the backends, in the main process and in every worker."""
+    configure_openai_clients(base_url=backend_options.get("openai_base_url"), max_connections=backend_options.get("max_connections"))
+    if backend_options.get("response_cache_path"):
+        max_age_days = backend_options.get("response_cache_max_age_days")
+        set_response_cache(ResponseCache(
+            backend_options["response_cache_path"],
+            max_entries=backend_options.get("response_cache_max_entries"),
+            max_age_seconds=max_age_days * 24 * 3600 if max_age_days is not None else None))
+    if backend_options.get("request_timeout") or backend_options.get("hedge_percentile") or backend_options.get("circuit_breaker_failures"):
+        breaker = CircuitBreaker(backend_options["circuit_breaker_failures"], backend_options.get("circuit_breaker_reset", 30.0)) if backend_options.get("circuit_breaker_failures") else None
+        set_resilience_policy(ResiliencePolicy(timeout=backend_options.get("request_timeout"), hedge_percentile=backend_options.get("hedge_percentile"),
+                                               max_hedges=backend_options.get("max_hedges", 1), circuit_breaker=breaker))
+    if backend_options.get("rpm_limit") or backend_options.get("tpm_limit"):
+        set_rate_limiter(RateLimiter(rpm=backend_options.get("rpm_limit"), tpm=backend_options.get("tpm_limit"),
+                                     state_path=backend_options.get("rate_limit_state_path")))
+    if backend_options.get("openai_batch_dir"):
+        batch_dir = backend_options["openai_batch_dir"]
+        transport = LocalBatchTransport(os.path.join(batch_dir, "local_api")) if backend_options.get("openai_batch_local") else OpenAIBatchTransport()
+        set_batch_job_runner(BatchJobRunner(transport, batch_dir, poll_interval=backend_options.get("openai_batch_poll_interval", 30.0)))
+
+def report_backend_services(progress_prefix=""):
+    cache = get_response_cache()
+    if cache is not None:
+        stats = cache.stats()
+        print (Fore.GREEN + f"{progress_prefix}Response cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%}), {stats['entries']} entries" + Style.RESET_ALL, flush=True)
+    policy = get_resilience_policy()
+    if policy is not None and policy.stats.calls > 0:
+        stats = policy.stats.stats()
+        latencies = "".join(f", {q} {stats[q]:.2f}s" for q in ("p50", "p95", "p99") if stats[q] is not None)
+        print (Fore.GREEN + f"{progress_prefix}Requests: {stats['calls']} calls{latencies}, {stats['hedges']} hedges ({stats['hedge_wins']} won), {stats['timeouts']} timeouts, {stats['rejected']} rejected by the circuit breaker" + Style.RESET_ALL, flush=True)
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        stats = limiter.stats.stats()
+        print (Fore.GREEN + f"{progress_prefix}Rate limiter: {stats['requests']} requests, {stats['tokens']} estimated tokens, {stats['waits']} waited for {stats['wait_seconds']:.1f}s in total" + Style.RESET_ALL, flush=True)
+    runner = get_batch_job_runner()
+    if runner is not None:
+        stats = runner.stats.stats()
+        print (Fore.GREEN + f"{progress_prefix}Batch jobs: {stats['requests']} requests in {stats['jobs']} jobs ({stats['batches']} batches), {stats['failed_requests']} sent again, {stats['wait_seconds']:.0f}s waiting" + Style.RESET_ALL, flush=True)
+    stats = get_local_moderator_stats().stats()
+    if stats["checks"] > 0:
+        print (Fore.GREEN + f"{progress_prefix}Local moderator: {stats['avoided_calls']}/{stats['checks']} moderator calls avoided ({stats['avoided_rate']:.1%}), {stats['rules']} by the rules, {stats['classifier']} by the classifier" + Style.RESET_ALL, flush=True)
+    stats = get_moderator_batcher_stats().stats()
+    if stats["requests"] > 0:
+        print (Fore.GREEN + f"{progress_prefix}Moderator batches: {stats['checks']} checks in {stats['requests']} requests ({stats['checks_per_request']:.1f} per request), {stats['fallbacks']} sent again on their own" + Style.RESET_ALL, flush=True)
+    stats = get_scene_objects_cache().stats()
+    print (Fore.GREEN + f"{progress_prefix}Scene cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%}), {stats['entries']} scenes" + Style.RESET_ALL, flush=True)
+
+def derive_seed(random_seed, *keys):
+    """Derive an independent, reproducible seed from the run seed, e.g. for a shard or a dialog."""
+    digest = hashlib.sha256(":".join(str(k) for k in (random_seed,) + keys).encode("utf-8")).hexdigest()
+    return int(digest[:16], 16)
+
+def sample_seeded_dialog_spec(resources, dialog_idx, random_seed=None, **spec_kwargs):
+    """
+    Sample the spec of the `dialog_idx`-th dialog. With a run seed the random state is reset from
+    (random_seed, dialog_idx) first, so a dialog gets the same spec no matter which process or shard samples it.
+    """
+    if random_seed is not None:
+        random.seed(derive_seed(random_seed, "dialog", dialog_idx))
+    return sample_dialog_spec(resources, **spec_kwargs)
+
+async def run_dialog_async(spec, max_interaction_step, **arena_kwargs):
+    """Run one dialog to completion without the CLI."""
+    arena = build_arena(spec, **arena_kwargs)
+    try:
+        await arena.async_run(num_steps=max_interaction_step)
+    except TooManyInvalidActions as e:
+        print (Fore.RED + f"Too many invalid actions: {e}" + Style.RESET_ALL, flush=True)
+    return arena
+
+async def async_generate_dialogs(dialog_ids, make_spec, on_finished, arena_kwargs, max_interaction_step, concurrency=8, progress_prefix="", adaptive_concurrency=None):
+    """
+    Keep up to `concurrency` dialogs in flight, and hand every dialog to `on_finished(dialog_idx, spec, arena)`
+    as soon as it finishes. The specs are sampled by `make_spec(dialog_idx)` one after another in the event loop
+    thread, so the random draws happen in the same order as in the sequential mode.
+    With `adaptive_concurrency` (the options of an `AdaptiveConcurrencyLimiter`), the requests of the dialogs
+    in flight are limited by an adaptive concurrency limiter for the duration of the run.
+    """
+    if adaptive_concurrency is not None:
+        limiter = AdaptiveConcurrencyLimiter(**adaptive_concurrency)
+        set_concurrency_limiter(limiter)
+        try:
+            await async_generate_dialogs(dialog_ids, make_spec, on_finished, arena_kwargs, max_interaction_step, concurrency=concurrency, progress_prefix=progress_prefix)
+        finally:
+            set_concurrency_limiter(None)
+        stats = limiter.stats()
+        print (Fore.GREEN + f"{progress_prefix}Adaptive concurrency: limit {stats['limit']} (between {stats['min_limit_reached']} and {stats['max_limit_reached']}), {stats['increases']} increases, "
+               f"{stats['decreases']} decreases, {stats['overloads']}/{stats['requests']} requests overloaded" + Style.RESET_ALL, flush=True)
+        return
+
+    dialog_ids = list(dialog_ids)
+    num_dialogs = len(dialog_ids)
+    speculation_stats = SpeculationStats()
+    pending = set()
+    task_dialogs = {}
+    next_dialog = 0
+    num_finished = 0
+    while next_dialog < num_dialogs or pending:
+        while next_dialog < num_dialogs and len(pending) < concurrency:
+            dialog_idx = dialog_ids[next_dialog]
+            spec = make_spec(dialog_idx)
+            task = asyncio.create_task(run_dialog_async(spec, max_interaction_step, **arena_kwargs))
+            task_dialogs[task] = (dialog_idx, spec)
+            pending.add(task)
+            next_dialog += 1
 
-            print("Save? (y/n)")
-            if input() == "n":
-               continue
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            num_finished += 1
+            dialog_idx, spec = task_dialogs.pop(task)
+            try:
+                arena = task.result()
+            except Exception as e:
+                print (Fore.RED + f"{progress_prefix}Dialog {num_finished}/{num_dialogs} failed: {e!r}" + Style.RESET_ALL, flush=True)
+                continue
+            on_finished(dialog_idx, spec, arena)
+            speculation_stats.update(arena.speculation_stats)
+            print (Fore.RED + f"{progress_prefix}Finished Dialog {num_finished}/{num_dialogs} ({len(pending)} in flight)" + Style.RESET_ALL, flush=True)
+
+    if speculation_stats.checks > 0:
+        stats = speculation_stats.stats()
+        print (Fore.GREEN + f"{progress_prefix}Speculative turns: {stats['used']}/{stats['checks']} used, {stats['saved_seconds_per_round']:.2f}s saved per moderator check, "
+               f"{stats['wasted_tokens']}/{stats['speculative_tokens']} estimated tokens wasted ({stats['wasted_token_rate']:.1%})" + Style.RESET_ALL, flush=True)
+
+def vector_generate_dialogs(dialog_ids, make_spec, on_finished, arena_kwargs, max_interaction_step, num_envs=8, progress_prefix=""):
+    """
+    Run the dialogs in lockstep with a `VectorArena` of `num_envs` dialogs, whose turns are sent in one batch per
+    step, and hand every dialog to `on_finished(dialog_idx, spec, arena)` as soon as it finishes. The specs are
+    sampled by `make_spec(dialog_idx)` one after another, as the slots of the finished dialogs free up.
+    """
+    dialog_ids = list(dialog_ids)
+    num_dialogs = len(dialog_ids)
+    next_ids = iter(dialog_ids)
+    num_finished = 0
+
+    def arena_factory():
+        dialog_idx = next(next_ids, None)
+        if dialog_idx is None:
+            return None
+        spec = make_spec(dialog_idx)
+        return (dialog_idx, spec), build_arena(spec, **arena_kwargs)
+
+    def finished(key, arena):
+        nonlocal num_finished
+        num_finished += 1
+        on_finished(*key, arena)
+        print (Fore.RED + f"{progress_prefix}Finished Dialog {num_finished}/{num_dialogs} ({len(vector_arena.slots)} in flight)" + Style.RESET_ALL, flush=True)
+
+    def failed(key, arena, error):
+        nonlocal num_finished
+        num_finished += 1
+        print (Fore.RED + f"{progress_prefix}Dialog {num_finished}/{num_dialogs} failed: {error!r}" + Style.RESET_ALL, flush=True)
+
+    vector_arena = VectorArena(arena_factory, num_envs, max_interaction_step, on_finished=finished, on_failed=failed)
+    vector_arena.run()
+    stats = vector_arena.stats()
+    print (Fore.GREEN + f"{progress_prefix}Vector arena: {stats['steps']} steps, {stats['player_queries_per_step']:.1f} turns and {stats['moderator_queries_per_step']:.1f} moderator checks per step" + Style.RESET_ALL, flush=True)
+
+def run_generation_engine(engine, dialog_ids, make_spec, on_finished, arena_kwargs, max_interaction_step, concurrency=8, progress_prefix="", adaptive_concurrency=None):
+    """Run the dialogs without the CLI with the async or the vector engine."""
+    if engine == "vector":
+        vector_generate_dialogs(dialog_ids, make_spec, on_finished, arena_kwargs, max_interaction_step, num_envs=concurrency, progress_prefix=progress_prefix)
+    else:
+        asyncio.run(async_generate_dialogs(dialog_ids, make_spec, on_finished, arena_kwargs, max_interaction_step, concurrency=concurrency, progress_prefix=progress_prefix, adaptive_concurrency=adaptive_concurrency))
+
+def flush_to_disk(fw):
+    """Flush the output file to disk and return its size, i.e. the number of bytes that are complete."""
+    fw.flush()
+    os.fsync(fw.fileno())
+    return os.fstat(fw.fileno()).st_size
+
+def read_shard(shard_path):
+    """
+    Read the items ({"dialog_idx", "record", "reject_reason"}) of a shard file. A trailing line cut off by a
+    crash is dropped and truncated away, so that the shard can be appended to when the run is resumed.
+    """
+    items = []
+    if not os.path.exists(shard_path):
+        return items
+    valid_bytes = 0
+    with open(shard_path, "rb") as f:
+        for line in f:
+            try:
+                item = json.loads(line.decode("utf-8"))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                break
+            if not line.endswith(b"\n"):
+                break
+            items.append(item)
+            valid_bytes += len(line)
+    if valid_bytes != os.path.getsize(shard_path):
+        with open(shard_path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return items
+
+def generate_shard(shard_config):
+    """
+    Process pool entry: generate the dialogs of one shard (every `num_shards`-th unfinished dialog starting at
+    `shard_idx`) and append them with their dialog index to the shard file, one JSON object per line.
+    """
+    init(autoreset=True)
+    setup_backend_services(shard_config["backend_options"])
+    shard_idx = shard_config["shard_idx"]
+    random.seed(derive_seed(shard_config["random_seed"], "shard", shard_idx))
+
+    resources = load_generation_resources(**shard_config["resource_paths"], catalog_dir=shard_config["catalog_dir"])
+    load_scene_index(resources, shard_config["spec_kwargs"], shard_config["scene_index_path"])
+    dialog_ids = shard_config["dialog_ids"][shard_idx::shard_config["num_shards"]]
+
+    def make_spec(dialog_idx):
+        return sample_seeded_dialog_spec(resources, dialog_idx, random_seed=shard_config["random_seed"], **shard_config["spec_kwargs"])
+
+    accept_policy = shard_config["accept_policy"]
+
+    with open(shard_config["shard_path"], "a", encoding='utf-8') as fw:
+        def on_finished(dialog_idx, spec, arena):
+            accepted, reason = accept_policy(arena.environment.message_pool, arena.environment.player_names)
+            item = {"dialog_idx": dialog_idx, "record": dialog_record(spec, arena, make_dialog_id(shard_config["run_id"], dialog_idx)), "reject_reason": None if accepted else reason}
+            fw.write(json.dumps(item, ensure_ascii=False) + "\n")
+            flush_to_disk(fw)
+
+        run_generation_engine(shard_config["engine"], dialog_ids, make_spec, on_finished, shard_config["arena_kwargs"], shard_config["spec_kwargs"]["max_interaction_step"], concurrency=shard_config["concurrency"], progress_prefix=f"[Shard {shard_idx}] ", adaptive_concurrency=shard_config["backend_options"].get("adaptive_concurrency"))
+    report_backend_services(progress_prefix=f"[Shard {shard_idx}] ")
+    return shard_config["shard_path"]
+
+def merge_shards(shard_paths, output_path, rejected_path):
+    """
+    Merge the shard files into one output file (and one rejected dialogs file) ordered by dialog index,
+    independent of the number of shards.
+    """
+    items = []
+    for shard_path in shard_paths:
+        items.extend(read_shard(shard_path))
+    items.sort(key=lambda x: x["dialog_idx"])
+
+    with open(output_path, "w", encoding='utf-8') as fw, open(rejected_path, "w", encoding='utf-8') as fw_rejected:
+        for item in items:
+            if item["reject_reason"] is None:
+                write_dialog_record(fw, item["record"])
+            else:
+                write_dialog_record(fw_rejected, dict(item["record"], reject_reason=item["reject_reason"]))
+        output_bytes = flush_to_disk(fw)
+        rejected_bytes = flush_to_disk(fw_rejected)
+    return [item["dialog_idx"] for item in items], output_bytes, rejected_bytes
+
+def generate_dialog_data(
+    train_scenes_images_pool_path,
+    test_scenes_images_pool_path,
+    train_scenes_images_info_pool_path,
+    test_scenes_images_info_pool_path,
+    fashion_metadata_path,
+    furniture_metadata_path,
+    user_profiles_path,
+    seed_data_path,
+    max_generated_dialogs=2,
+    max_interaction_step=10,
+    min_transition_step=3,
+    max_transition_step=5,
+    max_system_tokens=100,
+    max_user_tokens=80,
+    max_moderator_tokens=10,
+    moderator_backend="llm",
+    moderator_classifier_path=None,
+    moderator_threshold=0.95,
+    moderator_fallback=True,
+    moderator_min_rounds=0,
+    moderator_batch_size=0,
+    moderator_batch_wait=0.05,
+    model_name="gpt-4o-mini",
+    temperature=0.75,
+    output_dir=os.path.join("GeneratedData", "SCREEN"),
+    show_description=True,
+    show_message=True,
+    small_image_cache_dir="./cache/images",
+    small_image_max_side=None,
+    scene_index_path=None,
+    catalog_dir=None,
+    engine="sync",
+    concurrency=8,
+    speculative_turns=False,
+    num_workers=0,
+    random_seed=None,
+    resume_dir=None,
+    headless=False,
+    accept_policy=None,
+    backend_options=None
+):
+    if engine not in ("sync", "async", "vector"):
+        raise ValueError(f"Invalid engine: {engine}")
+    if moderator_backend not in ("llm", "local"):
+        raise ValueError(f"Invalid moderator backend: {moderator_backend}")
+
+    # Only the sequential CLI can ask the user whether to save a dialog
+    interactive = engine == "sync" and num_workers == 0 and not headless
+    if accept_policy is None:
+        accept_policy = InteractivePolicy() if interactive else AcceptAllPolicy()
+    elif accept_policy.interactive and not interactive:
+        raise ValueError(f"The {accept_policy.type_name} accept policy needs the sequential CLI (--engine sync, no --headless or --num_workers).")
+
+    resource_paths = {
+        "seed_data_path": seed_data_path,
+        "user_profiles_path": user_profiles_path,
+        "fashion_metadata_path": fashion_metadata_path,
+        "furniture_metadata_path": furniture_metadata_path,
+    }
+    # Everything that changes the generated data, a resumed run must use the same values
+    generation_config = dict(
+        train_scenes_images_pool_path=train_scenes_images_pool_path,
+        test_scenes_images_pool_path=test_scenes_images_pool_path,
+        train_scenes_images_info_pool_path=train_scenes_images_info_pool_path,
+        test_scenes_images_info_pool_path=test_scenes_images_info_pool_path,
+        max_generated_dialogs=max_generated_dialogs,
+        max_interaction_step=max_interaction_step,
+        min_transition_step=min_transition_step,
+        max_transition_step=max_transition_step,
+        max_system_tokens=max_system_tokens,
+        max_user_tokens=max_user_tokens,
+        max_moderator_tokens=max_moderator_tokens,
+        model_name=model_name,
+        temperature=temperature,
+        small_image_cache_dir=small_image_cache_dir,
+        random_seed=random_seed,
+        **resource_paths
+    )
+    if small_image_max_side is not None:
+        # only recorded when set, so that the runs started before the option existed can still be resumed
+        generation_config["small_image_max_side"] = small_image_max_side
+    if moderator_backend != "llm":
+        generation_config.update(moderator_backend=moderator_backend, moderator_classifier_path=moderator_classifier_path,
+                                 moderator_threshold=moderator_threshold, moderator_fallback=moderator_fallback)
+        if moderator_min_rounds > 0:
+            generation_config["moderator_min_rounds"] = moderator_min_rounds
+    if moderator_batch_size > 1:
+        generation_config["moderator_batch_size"] = moderator_batch_size
+
+    if not os.path.exists(small_image_cache_dir):
+        os.makedirs(small_image_cache_dir)
+
+    backend_options = backend_options or {}
+    if backend_options.get("openai_batch_dir") and engine != "vector":
+        raise ValueError("The OpenAI Batch API mode sends the turns of all the dialogs at once, it needs --engine vector.")
+    if backend_options.get("adaptive_concurrency") and not (engine == "async" or (engine == "sync" and num_workers > 0)):
+        raise ValueError("The adaptive concurrency limits the async requests, it needs --engine async or --num_workers.")
+
+    if resume_dir is not None:
+        manifest = RunManifest.load(resume_dir)
+        manifest.check_config(generation_config)
+        manifest.restore_rng_state()
+        print (Fore.GREEN + f"Resuming run {resume_dir}: {len(manifest.completed)}/{max_generated_dialogs} dialogs already finished" + Style.RESET_ALL, flush=True)
+    else:
+        # Create the run directory and the output file with the timestamp
+        time_flag = time.strftime("%Y%m%d%H%M%S", time.localtime())
+        run_dir = os.path.join(output_dir, f"run_{time_flag}")
+        manifest = RunManifest.create(run_dir, generation_config, f"simulated_dialogs_{time_flag}.json", random_seed=random_seed)
+    output_path = manifest.output_path
+    rejected_path = manifest.rejected_path
+    remaining_ids = [i for i in range(max_generated_dialogs) if not manifest.is_completed(i)]
+
+    spec_kwargs = {
+        "scenes_images_pool_path": train_scenes_images_pool_path,
+        "scenes_images_info_pool_path": train_scenes_images_info_pool_path,
+        "max_interaction_step": max_interaction_step,
+        "min_transition_step": min_transition_step,
+        "max_transition_step": max_transition_step,
+        "small_image_cache_dir": small_image_cache_dir,
+        "small_image_max_side": small_image_max_side,
+    }
+    arena_kwargs = {
+        "model_name": model_name,
+        "temperature": temperature,
+        "max_system_tokens": max_system_tokens,
+        "max_user_tokens": max_user_tokens,
+        "max_moderator_tokens": max_moderator_tokens,
+        "moderator_backend": moderator_backend,
+        "moderator_classifier_path": moderator_classifier_path,
+        "moderator_threshold": moderator_threshold,
+        "moderator_fallback": moderator_fallback,
+        "moderator_min_rounds": moderator_min_rounds,
+        "moderator_batch_size": moderator_batch_size,
+        "moderator_batch_wait": moderator_batch_wait,
+        "speculative": speculative_turns,
+    }
+
+    # The workers load the catalogs and the index saved by the main process
+    resources = load_scene_index(load_generation_resources(**resource_paths, catalog_dir=catalog_dir), spec_kwargs, scene_index_path)
+
+    if num_workers > 0:
+        # Every worker appends to its own shard headlessly, then the shards are merged by dialog index.
+        # The shard files are the durable record of finished dialogs, the manifest is updated after the merge.
+        if random_seed is None:
+            raise ValueError("A random seed is required to derive the per-shard seeds.")
+        shard_dir = os.path.join(manifest.run_dir, "shards")
+        os.makedirs(shard_dir, exist_ok=True)
+        existing_shard_paths = sorted(os.path.join(shard_dir, name) for name in os.listdir(shard_dir) if name.endswith(".jsonl"))
+        finished_in_shards = {item["dialog_idx"] for shard_path in existing_shard_paths for item in read_shard(shard_path)}
+        if not manifest.completed <= finished_in_shards:
+            raise ValueError(f"The run in {manifest.run_dir} was generated in the main process, resume it without --num_workers.")
+        remaining_ids = [i for i in remaining_ids if i not in finished_in_shards]
+        if (backend_options.get("rpm_limit") or backend_options.get("tpm_limit")) and not backend_options.get("rate_limit_state_path"):
+            # the workers share the budget through a state file of the run
+            backend_options = dict(backend_options, rate_limit_state_path=os.path.join(manifest.run_dir, "rate_limit.json"))
+
+        shard_configs = [{
+            "shard_idx": shard_idx,
+            "num_shards": num_workers,
+            "run_id": manifest.run_id,
+            "random_seed": random_seed,
+            "dialog_ids": remaining_ids,
+            "resource_paths": resource_paths,
+            "spec_kwargs": spec_kwargs,
+            "arena_kwargs": arena_kwargs,
+            "engine": "vector" if engine == "vector" else "async",
+            "concurrency": concurrency if engine in ("async", "vector") else 1,
+            "accept_policy": accept_policy,
+            "backend_options": backend_options,
+            "scene_index_path": scene_index_path,
+            "catalog_dir": catalog_dir,
+            "shard_path": os.path.join(shard_dir, f"shard_{shard_idx:03d}.jsonl"),
+        } for shard_idx in range(num_workers)]
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            shard_paths = list(executor.map(generate_shard, shard_configs))
+        merged_ids, output_bytes, rejected_bytes = merge_shards(sorted(set(existing_shard_paths) | set(shard_paths)), output_path, rejected_path)
+        manifest.completed.update(merged_ids)
+        manifest.output_bytes = output_bytes
+        manifest.rejected_bytes = rejected_bytes
+        manifest.save()
+        print (Fore.GREEN + f"Merged {len(merged_ids)} dialogs from {num_workers} shards into {output_path}" + Style.RESET_ALL, flush=True)
+        return
+
+    shard_dir = os.path.join(manifest.run_dir, "shards")
+    if os.path.exists(shard_dir) and any(not manifest.is_completed(item["dialog_idx"]) for name in os.listdir(shard_dir) for item in read_shard(os.path.join(shard_dir, name))):
+        raise ValueError(f"The run in {manifest.run_dir} has unmerged worker shards, resume it with --num_workers.")
+
+    setup_backend_services(backend_options)
+
+    def make_spec(dialog_idx):
+        return sample_seeded_dialog_spec(resources, dialog_idx, random_seed=random_seed, **spec_kwargs)
+
+    # Drop a dialog that was only partially written when the previous run stopped, then append
+    for path, complete_bytes in ((output_path, manifest.output_bytes), (rejected_path, manifest.rejected_bytes)):
+        if os.path.exists(path):
+            with open(path, "r+b") as f:
+                f.truncate(complete_bytes)
+    
+    with open(output_path, "a", encoding='utf-8') as fw, open(rejected_path, "a", encoding='utf-8') as fw_rejected:
+        def save_or_reject(dialog_idx, spec, arena):
+            accepted, reason = accept_policy(arena.environment.message_pool, arena.environment.player_names)
+            record = dialog_record(spec, arena, make_dialog_id(manifest.run_id, dialog_idx))
+            if accepted:
+                write_dialog_record(fw, record)
+            else:
+                write_dialog_record(fw_rejected, dict(record, reject_reason=reason))
+            manifest.mark_completed(dialog_idx, output_bytes=flush_to_disk(fw), rejected_bytes=flush_to_disk(fw_rejected))
+
+        if engine in ("async", "vector"):
+            run_generation_engine(engine, remaining_ids, make_spec, save_or_reject, arena_kwargs, max_interaction_step, concurrency=concurrency, adaptive_concurrency=backend_options.get("adaptive_concurrency"))
+            report_backend_services()
+            return
+
+        for i in remaining_ids:
+            print (Fore.RED + f"Generating Dialog {i+1}/{max_generated_dialogs}" + Style.RESET_ALL, flush=True)
             
-            # save the simulated dialog to file
-            messages = env.get_observation()
-            simulated_convs = []
-            for msg in messages:
-                if msg.agent_name == assistant.name:
-                    utt = {"system": msg.content}
-                else:
-                    utt = {"user": msg.content}
-                simulated_convs.append(utt)
+            spec = make_spec(i)
+            arena = build_arena(spec, **arena_kwargs)
             
-            write_line = {
-                "id": time.strftime("%Y%m%d%H%M%S", time.localtime()),
-                "scene_image_path": scene_image_paths[0],
-                "scene_image_info_path": scene_image_info_paths[0],
-                "second_scene_image_path": second_scene_images_paths[0],
-                "second_scene_image_info_path": second_scene_images_info_paths[0],
-                "transition_turn": transition_turn,
-                "domain": domain,
-                "seed_dialog": dialog_example,
-                "user_profile": simulated_user_profile,
-                "assistant_profile": simulated_assistant_profile,
-                "user_personality": simulated_user_personality,
-                "objects_info_in_scene": objects_info_in_scene,
-                "simulate_user_preference": simulate_user_preference,
-                "second_objects_info": second_objects_info,
-                "second_simulate_preference": second_simulate_preference,
-                "conversation": simulated_convs
-            }
-            fw.write(json.dumps(write_line, ensure_ascii=False, indent=4) + "\n")
-            fw.flush()
+            if headless:
+                # Run the dialog without rendering anything on the console
+                try:
+                    arena.run(num_steps=max_interaction_step)
+                except TooManyInvalidActions as e:
+                    print (Fore.RED + f"Too many invalid actions: {e}" + Style.RESET_ALL, flush=True)
+            else:
+                arena.launch_cli(max_steps=max_interaction_step, show_description=show_description, show_message=show_message, interactive=False)
+
+            save_or_reject(i, spec, arena)
+        report_backend_services()
 
         #     print("Sleeping for 5 seconds...")
         #     time.sleep(5)
@@ -289,16 +865,15 @@ def generate_dialog_data(
 if __name__ == '__main__':
     init(autoreset=True)
     args = parse_args()
-    random.seed(args.random_seed)
-    generate_dialog_data(
-        args.train_scenes_images_pool_path,
-        args.test_scenes_images_pool_path,
-        args.train_scenes_images_info_pool_path,
-        args.test_scenes_images_info_pool_path,
-        args.fashion_metadata_path,
-        args.furniture_metadata_path,
-        args.user_profiles_path,
-        args.seed_data_path,
+    generation_kwargs = dict(
+        train_scenes_images_pool_path=args.train_scenes_images_pool_path,
+        test_scenes_images_pool_path=args.test_scenes_images_pool_path,
+        train_scenes_images_info_pool_path=args.train_scenes_images_info_pool_path,
+        test_scenes_images_info_pool_path=args.test_scenes_images_info_pool_path,
+        fashion_metadata_path=args.fashion_metadata_path,
+        furniture_metadata_path=args.furniture_metadata_path,
+        user_profiles_path=args.user_profiles_path,
+        seed_data_path=args.seed_data_path,
         max_generated_dialogs=args.max_generated_dialogs,
         max_interaction_step=args.max_interaction_step,
         min_transition_step=args.min_transition_step,
@@ -306,10 +881,54 @@ if __name__ == '__main__':
         max_system_tokens=args.max_system_tokens,
         max_user_tokens=args.max_user_tokens,
         max_moderator_tokens=args.max_moderator_tokens,
+        moderator_backend=args.moderator_backend,
+        moderator_classifier_path=args.moderator_classifier_path,
+        moderator_threshold=args.moderator_threshold,
+        moderator_fallback=args.moderator_fallback,
+        moderator_min_rounds=args.moderator_min_rounds,
+        moderator_batch_size=args.moderator_batch_size,
         model_name=args.model_name,
         temperature=args.temperature,
+        small_image_cache_dir=args.small_img_cache_dir,
+        small_image_max_side=args.small_img_max_side,
+        random_seed=args.random_seed
+    )
+    if args.resume is not None:
+        # A resumed run keeps the generation config of the original run
+        generation_kwargs.update(RunManifest.load(args.resume).config)
+    random.seed(generation_kwargs["random_seed"])
+    generate_dialog_data(
         output_dir=args.output_dir,
         show_description=args.show_description,
         show_message=args.show_message,
-        small_image_cache_dir=args.small_img_cache_dir
+        scene_index_path=args.scene_index_path,
+        catalog_dir=args.catalog_dir,
+        engine=args.engine,
+        concurrency=args.concurrency,
+        speculative_turns=args.speculative_turns,
+        moderator_batch_wait=args.moderator_batch_wait,
+        num_workers=args.num_workers,
+        resume_dir=args.resume,
+        headless=args.headless,
+        accept_policy=load_policy(args.accept_policy) if args.accept_policy is not None else None,
+        backend_options=dict(
+            openai_base_url=args.openai_base_url,
+            max_connections=args.max_connections,
+            response_cache_path=args.response_cache_path,
+            response_cache_max_entries=args.response_cache_max_entries,
+            response_cache_max_age_days=args.response_cache_max_age_days,
+            adaptive_concurrency=dict(initial_limit=args.adaptive_initial_limit, max_limit=args.adaptive_max_limit or args.concurrency) if args.adaptive_concurrency else None,
+            request_timeout=args.request_timeout,
+            hedge_percentile=args.hedge_percentile,
+            max_hedges=args.max_hedges,
+            circuit_breaker_failures=args.circuit_breaker_failures,
+            circuit_breaker_reset=args.circuit_breaker_reset,
+            rpm_limit=args.rpm_limit,
+            tpm_limit=args.tpm_limit,
+            rate_limit_state_path=args.rate_limit_state_path,
+            openai_batch_dir=args.openai_batch_dir,
+            openai_batch_poll_interval=args.openai_batch_poll_interval,
+            openai_batch_local=args.openai_batch_local
+        ),
+        **generation_kwargs
     )
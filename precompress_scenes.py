@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os
+import math
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from data_utils import compress_image, get_small_image_path, SMALL_IMAGE_TARGET_SIZE_KB
+from colorama import Fore, Back, Style, init
+
+PRECOMPRESS_MANIFEST_FILE_NAME = "precompress_manifest.json"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compress every scene image into the small image cache before a generation run.")
+    parser.add_argument("--train_scenes_images_pool_path", type=str, default="./scene_info_pool/original_data/train_scene_images", help="The training scenes images pool.")
+    parser.add_argument("--test_scenes_images_pool_path", type=str, default="./scene_info_pool/original_data/test_scene_images", help="The test scenes images pool.")
+    parser.add_argument("--small_img_cache_dir", type=str, default="./cache/images", help="The directory to save the small image cache.")
+    parser.add_argument("--small_img_max_side", type=int, default=None, help="Downscale the scene images so that their longer side is at most this many pixels before compressing them.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="The number of worker processes.")
+    parser.add_argument("--manifest_path", type=str, default=None, help=f"Where to write the manifest (default: <small_img_cache_dir>/{PRECOMPRESS_MANIFEST_FILE_NAME}).")
+    return parser.parse_args()
+
+
+def estimate_image_tokens(width, height):
+    """
+    The input tokens of an image sent with detail "high" (the default "auto" picks it for large images):
+    the image is scaled to fit in 2048x2048, then its shortest side to 768 pixels, and costs 85 tokens
+    plus 170 tokens per 512x512 tile.
+    """
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def list_scene_images(images_pool_paths):
+    image_paths = []
+    for images_pool_path in images_pool_paths:
+        if not os.path.isdir(images_pool_path):
+            print (Fore.YELLOW + f"Skipping missing directory {images_pool_path}" + Style.RESET_ALL, flush=True)
+            continue
+        image_paths.extend(os.path.join(images_pool_path, name) for name in sorted(os.listdir(images_pool_path)) if name.endswith(".png"))
+    return image_paths
+
+
+def precompress_image(task):
+    image_path, small_image_cache_dir, max_side = task
+    meta = compress_image(image_path, get_small_image_path(image_path, small_image_cache_dir), target_size_kb=SMALL_IMAGE_TARGET_SIZE_KB, max_side=max_side)
+    return dict(meta, estimated_tokens=estimate_image_tokens(meta["width"], meta["height"]))
+
+
+def precompress_scenes(images_pool_paths, small_image_cache_dir="./cache/images", small_image_max_side=None, num_workers=None, manifest_path=None):
+    """Compress every PNG of the pools into the small image cache and write a manifest of the compressed images."""
+    os.makedirs(small_image_cache_dir, exist_ok=True)
+    image_paths = list_scene_images(images_pool_paths)
+    tasks = [(image_path, small_image_cache_dir, small_image_max_side) for image_path in image_paths]
+
+    start_time = time.perf_counter()
+    images = {}
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for idx, meta in enumerate(executor.map(precompress_image, tasks, chunksize=16)):
+            small_image_path = get_small_image_path(meta["source_path"], small_image_cache_dir)
+            if small_image_path in images:
+                # the cache is keyed by file name, a later pool overwrites an image with the same name
+                print (Fore.YELLOW + f"{meta['source_path']} has the same name as {images[small_image_path]['source_path']}" + Style.RESET_ALL, flush=True)
+            images[small_image_path] = meta
+            if (idx + 1) % 500 == 0:
+                print (Fore.GREEN + f"Compressed {idx + 1}/{len(tasks)} images" + Style.RESET_ALL, flush=True)
+    elapsed = time.perf_counter() - start_time
+
+    summary = {
+        "num_images": len(images),
+        "source_bytes": sum(meta["source_bytes"] for meta in images.values()),
+        "output_bytes": sum(meta["output_bytes"] for meta in images.values()),
+        "mean_quality": sum(meta["quality"] for meta in images.values()) / len(images) if images else None,
+        "estimated_tokens": sum(meta["estimated_tokens"] for meta in images.values()),
+        "elapsed_seconds": round(elapsed, 2),
+    }
+    manifest_path = manifest_path or os.path.join(small_image_cache_dir, PRECOMPRESS_MANIFEST_FILE_NAME)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "images_pool_paths": list(images_pool_paths),
+            "target_size_kb": SMALL_IMAGE_TARGET_SIZE_KB,
+            "max_side": small_image_max_side,
+            "summary": summary,
+            "images": images,
+        }, f, indent=4)
+
+    print (Fore.GREEN + f"Compressed {summary['num_images']} images in {elapsed:.1f}s: "
+           f"{summary['source_bytes'] / 2**20:.1f}MB -> {summary['output_bytes'] / 2**20:.1f}MB, "
+           f"about {summary['estimated_tokens']} image tokens if every image is sent once. Manifest: {manifest_path}" + Style.RESET_ALL, flush=True)
+    return summary
+
+
+if __name__ == '__main__':
+    init(autoreset=True)
+    args = parse_args()
+    precompress_scenes(
+        images_pool_paths=[args.train_scenes_images_pool_path, args.test_scenes_images_pool_path],
+        small_image_cache_dir=args.small_img_cache_dir,
+        small_image_max_side=args.small_img_max_side,
+        num_workers=args.num_workers,
+        manifest_path=args.manifest_path
+    )
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import mmap
+import struct
+import argparse
+from collections.abc import Mapping
+
+import numpy as np
+
+from data_utils import file_sha256, CURRENCY_PATTERN
+
+CATALOG_MAGIC = b"SCRNCAT1"
+CATALOG_VERSION = 3
+CATALOG_SUFFIX = ".catalog"
+_HEADER_LENGTH = struct.Struct("<Q")
+_ALIGNMENT = 8
+
+def _pack_strings(strings):
+    """The string table as binary arrays: the UTF-8 text of all the strings and the offset of each, in characters."""
+    text = "".join(strings)
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in strings], out=offsets[1:])
+    return np.frombuffer(text.encode("utf-8"), dtype=np.uint8), offsets
+
+
+def _unpack_strings(text, offsets):
+    text = text.tobytes().decode("utf-8")
+    offsets = offsets.tolist()
+    return [sys.intern(text[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _parse_currency(value):
+    """The (sign, amount, decimals) of a price like "$199", None unless it is written back the same from them."""
+    match = CURRENCY_PATTERN.match(value)
+    if match is None:
+        return None
+    sign, amount = match.groups()
+    decimals = len(amount.partition(".")[2])
+    if f"{float(amount):.{decimals}f}" != amount:  # e.g. "$0199"
+        return None
+    return sign, float(amount), decimals
+
+
+def _column_kind(values):
+    present = [v for v in values if v is not None]
+    if all(isinstance(v, str) for v in present):
+        if present and all(_parse_currency(v) is not None for v in present):
+            return "currency"
+        return "str"
+    if all(isinstance(v, int) and not isinstance(v, bool) for v in present):
+        return "int"
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        return "float"
+    if all(isinstance(v, list) and all(isinstance(x, str) for x in v) for v in present):
+        return "str_list"
+    return "json"
+
+
+class ProductCatalog(Mapping):
+    """
+    A read-only view of the prefab metadata (prefab path -> attributes) stored column by column: every string
+    (prefab paths and attribute values) is interned once in a string table and referenced by id, and the numeric
+    attributes, prices written with a currency sign included, are arrays. Saved catalogs are memory-mapped: the string table and the columns are binary, only
+    the small header (the columns and the attribute layouts) is JSON, and the processes reading the same file
+    share its pages.
+    Looking up a prefab returns a new dict equal to its entry in the metadata JSON, so the catalog can be used
+    wherever the metadata dict was.
+    """
+
+    def __init__(self, header, arrays, buffer=None):
+        self.header = header
+        self._arrays = arrays
+        self._buffer = buffer  # the mmap backing the arrays of a loaded catalog
+        self.strings = _unpack_strings(arrays["_strings"], arrays["_strings.offsets"])
+        self.fields = list(header["columns"])
+        self.layouts = [tuple(layout) for layout in header["layouts"]]
+        self.names = [self.strings[i] for i in arrays["_names"]]
+        self._row_ids = {name: row for row, name in enumerate(self.names)}
+
+    @classmethod
+    def from_metadata(cls, metadata, source=None):
+        names = list(metadata)
+        strings, string_ids = [], {}
+
+        def intern_string(s):
+            if s not in string_ids:
+                string_ids[s] = len(strings)
+                strings.append(s)
+            return string_ids[s]
+
+        layouts, layout_ids = [], {}
+        for name in names:
+            layout = tuple(metadata[name])
+            if layout not in layout_ids:
+                layout_ids[layout] = len(layouts)
+                layouts.append(layout)
+        fields = list(dict.fromkeys(field for layout in layouts for field in layout))
+
+        arrays = {
+            "_names": np.array([intern_string(name) for name in names], dtype=np.int32),
+            "_layouts": np.array([layout_ids[tuple(metadata[name])] for name in names], dtype=np.int32),
+        }
+        columns = {}
+        for field in fields:
+            values = [metadata[name].get(field) for name in names]
+            kind = _column_kind(values)
+            columns[field] = {"kind": kind}
+            if kind == "str":
+                arrays[field] = np.array([-1 if v is None else intern_string(v) for v in values], dtype=np.int32)
+            elif kind == "json":
+                arrays[field] = np.array([-1 if v is None else intern_string(json.dumps(v, ensure_ascii=False)) for v in values], dtype=np.int32)
+            elif kind in ("int", "float"):
+                arrays[field] = np.array([0 if v is None else v for v in values], dtype=np.int64 if kind == "int" else np.float64)
+            elif kind == "currency":
+                # the amounts are numbers, the sign and the number of decimals give back the text, e.g. "$199"
+                prices = [(None, 0.0, 0) if v is None else _parse_currency(v) for v in values]
+                arrays[field] = np.array([amount for sign, amount, decimals in prices], dtype=np.float64)
+                arrays[f"{field}.sign"] = np.array([-1 if sign is None else intern_string(sign) for sign, amount, decimals in prices], dtype=np.int32)
+                arrays[f"{field}.decimals"] = np.array([decimals for sign, amount, decimals in prices], dtype=np.uint8)
+            else:
+                lengths = [-1 if v is None else len(v) for v in values]
+                arrays[f"{field}.offsets"] = np.concatenate([[0], np.cumsum(np.maximum(lengths, 0))]).astype(np.int32)
+                arrays[f"{field}.lengths"] = np.array(lengths, dtype=np.int32)
+                arrays[field] = np.array([intern_string(x) for v in values if v is not None for x in v], dtype=np.int32)
+            if kind in ("int", "float", "currency"):
+                arrays[f"{field}.present"] = np.array([v is not None for v in values], dtype=np.uint8)
+            if kind == "float":
+                # the ints of a column that also has floats are read back as ints, e.g. a price of 25 and not 25.0
+                arrays[f"{field}.integral"] = np.array([isinstance(v, int) for v in values], dtype=np.uint8)
+        arrays["_strings"], arrays["_strings.offsets"] = _pack_strings(strings)
+
+        header = {
+            "version": CATALOG_VERSION,
+            "source": source,
+            "num_rows": len(names),
+            "layouts": [list(layout) for layout in layouts],
+            "columns": columns,
+        }
+        return cls(header, arrays)
+
+    @classmethod
+    def from_json(cls, metadata_path):
+        with open(metadata_path, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        stat = os.stat(metadata_path)
+        source = {"sha256": file_sha256(metadata_path), "mtime_ns": stat.st_mtime_ns, "bytes": stat.st_size}
+        return cls.from_metadata(metadata, source=source)
+
+    def save(self, path):
+        header = dict(self.header, arrays={})
+        offset = 0
+        for key, array in self._arrays.items():
+            header["arrays"][key] = {"dtype": array.dtype.str, "offset": offset, "length": len(array)}
+            offset += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        header_bytes += b" " * (-(len(CATALOG_MAGIC) + _HEADER_LENGTH.size + len(header_bytes)) % _ALIGNMENT)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"  # the workers of a run may build the same catalog at once
+        with open(tmp_path, "wb") as f:
+            f.write(CATALOG_MAGIC)
+            f.write(_HEADER_LENGTH.pack(len(header_bytes)))
+            f.write(header_bytes)
+            for array in self._arrays.values():
+                data = array.tobytes()
+                f.write(data + b"\0" * (-len(data) % _ALIGNMENT))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(CATALOG_MAGIC)] != CATALOG_MAGIC:
+            raise ValueError(f"{path} is not a product catalog.")
+        (header_length,) = _HEADER_LENGTH.unpack_from(buffer, len(CATALOG_MAGIC))
+        data_start = len(CATALOG_MAGIC) + _HEADER_LENGTH.size + header_length
+        header = json.loads(buffer[len(CATALOG_MAGIC) + _HEADER_LENGTH.size:data_start])
+        if header.get("version") != CATALOG_VERSION:
+            raise ValueError(f"Unsupported product catalog version: {header.get('version')}")
+        arrays = {key: np.frombuffer(buffer, dtype=np.dtype(spec["dtype"]), count=spec["length"], offset=data_start + spec["offset"])
+                  for key, spec in header.pop("arrays").items()}
+        return cls(header, arrays, buffer=buffer)
+
+    def row_id(self, name):
+        return self._row_ids[name]
+
+    def _value(self, field, row):
+        # an attribute set to null in the metadata is -1 in the string columns and not present in the numeric ones
+        kind = self.header["columns"][field]["kind"]
+        column = self._arrays[field]
+        if kind in ("str", "json"):
+            if column[row] < 0:
+                return None
+            return self.strings[column[row]] if kind == "str" else json.loads(self.strings[column[row]])
+        if kind in ("int", "float", "currency"):
+            if not self._arrays[f"{field}.present"][row]:
+                return None
+            if kind == "currency":
+                return f"{self.strings[self._arrays[f'{field}.sign'][row]]}{column[row]:.{self._arrays[f'{field}.decimals'][row]}f}"
+            if kind == "int" or self._arrays[f"{field}.integral"][row]:
+                return int(column[row])
+            return float(column[row])
+        length = self._arrays[f"{field}.lengths"][row]
+        if length < 0:
+            return None
+        start = self._arrays[f"{field}.offsets"][row]
+        return [self.strings[i] for i in column[start:start + length]]
+
+    def numeric_values(self, field, names):
+        """
+        The numbers of a numeric attribute (the amounts of the prices) of the prefabs `names` that have it, read
+        from its column; None when the attribute is not numeric.
+        """
+        if self.header["columns"].get(field, {}).get("kind") not in ("int", "float", "currency"):
+            return None
+        rows = np.array([self._row_ids[name] for name in names], dtype=np.int64)
+        present = self._arrays[f"{field}.present"][rows].astype(bool)
+        values = self._arrays[field][rows][present].tolist()
+        if self.header["columns"][field]["kind"] == "float":
+            integral = self._arrays[f"{field}.integral"][rows][present].tolist()
+            values = [int(v) if i else v for v, i in zip(values, integral)]
+        return values
+
+    def __getitem__(self, name):
+        row = self._row_ids[name]
+        return {field: self._value(field, row) for field in self.layouts[self._arrays["_layouts"][row]]}
+
+    def __contains__(self, name):
+        return name in self._row_ids
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def get_catalog_path(metadata_path, catalog_dir):
+    return os.path.join(catalog_dir, os.path.splitext(os.path.basename(metadata_path))[0] + CATALOG_SUFFIX)
+
+
+def load_product_catalog(metadata_path, catalog_dir):
+    """
+    Memory-map the catalog of `metadata_path` saved in `catalog_dir`, building it first when it is missing or
+    was built from another version of the metadata file.
+    """
+    catalog_path = get_catalog_path(metadata_path, catalog_dir)
+    if os.path.exists(catalog_path):
+        try:
+            catalog = ProductCatalog.load(catalog_path)
+        except (OSError, ValueError, KeyError):
+            catalog = None
+        if catalog is not None:
+            source = catalog.header["source"] or {}
+            stat = os.stat(metadata_path)
+            if source.get("mtime_ns") == stat.st_mtime_ns and source.get("bytes") == stat.st_size:
+                return catalog
+            if source.get("sha256") == file_sha256(metadata_path):
+                return catalog
+    ProductCatalog.from_json(metadata_path).save(catalog_path)
+    return ProductCatalog.load(catalog_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the product catalogs of the prefab metadata files.")
+    parser.add_argument("--metadata_paths", type=str, nargs="+", default=["./scene_info_pool/original_data/fashion_prefab_metadata_all.json", "./scene_info_pool/original_data/furniture_prefab_metadata_all.json"], help="The prefab metadata files.")
+    parser.add_argument("--catalog_dir", type=str, default="./cache/catalogs", help="The directory to save the catalogs in.")
+    args = parser.parse_args()
+    for metadata_path in args.metadata_paths:
+        catalog_path = get_catalog_path(metadata_path, args.catalog_dir)
+        ProductCatalog.from_json(metadata_path).save(catalog_path)
+        catalog = ProductCatalog.load(catalog_path)
+        print(f"{metadata_path} -> {catalog_path}: {len(catalog)} prefabs, {len(catalog.strings)} strings, {os.path.getsize(catalog_path)} bytes")
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+The prompts of the simulated dialogs. The static text of every prompt is assembled once when the module is
+imported, and a dialog only fills the slots of the templates.
+"""
+import string
+
+
+class PromptTemplate:
+    """
+    A prompt with named `{slots}`, parsed once into its static parts; rendering copies the parts, puts the slot
+    values in place and joins them, without parsing the template again as str.format would.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self._parts = []
+        self._slot_positions = []  # (index in _parts, slot name)
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+            if literal:
+                self._parts.append(literal)
+            if field_name is None:
+                continue
+            if not field_name.isidentifier() or format_spec or conversion:
+                raise ValueError(f"Prompt template slots must be plain names: {template!r}")
+            self._slot_positions.append((len(self._parts), field_name))
+            self._parts.append(None)
+        self.slots = {name for _, name in self._slot_positions}
+
+    def render(self, **slots):
+        parts = self._parts.copy()
+        for index, name in self._slot_positions:
+            parts[index] = str(slots[name])
+        return "".join(parts)
+
+    def render_many(self, slots_list):
+        return [self.render(**slots) for slots in slots_list]
+
+
+ENV_TEMPLATE = PromptTemplate("You are now participating in a conversation happening in a {domain} store.")
+ENV_WITH_IMAGE_TEMPLATE = PromptTemplate(ENV_TEMPLATE.template + "The image provided is the snapshot of this store.")
+
+# (occupation, gender) -> how the user is introduced, any other occupation is retired and any other gender female
+PROFILE_TEMPLATES = {
+    ("Student", "Male"): PromptTemplate("a male student in the age range of {age_range}, living in {residence}"),
+    ("Student", "Female"): PromptTemplate("a female student in the age range of {age_range}, living in {residence}"),
+    ("Employed", "Male"): PromptTemplate("a man in the age range of {age_range}, working in a company and living in {residence}"),
+    ("Employed", "Female"): PromptTemplate("a woman in the age range of {age_range}, working in a company and living in {residence}"),
+    ("Retired", "Male"): PromptTemplate("a retired man in the age range of {age_range}, living in {residence}"),
+    ("Retired", "Female"): PromptTemplate("a retired woman in the age range of {age_range}, living in {residence}"),
+}
+
+USER_TEMPLATE = PromptTemplate(
+    "You are {name}, {profile}.\n\n"
+    "Based on your past experiences, you have the following preferences:\n"
+    "{preference}\n"
+    "Based on the Big-5 personality traits, your personality is measured as:\n"
+    "{personality}\n"
+    "Your response should match your profile and personality, and be concise (no longer than 30 words).\n"
+    "You don't need to recommend anything, but feel free to express your personal interests."
+)
+PERSONALITY_TRAIT_TEMPLATE = PromptTemplate("For {trait}, you are {value}.\n")
+USER_TRANSITION_TURN_TEMPLATE = PromptTemplate(
+    " In this round, you must seek recommendations of type {type_name}, and you should shift the topic of the conversation to the content of type {type_name}."
+    "For example: 'That sounds good, but I would like to buy a type {type_name} instead.'"
+)
+
+ASSISTANT_TEMPLATE = PromptTemplate(
+    "You are {assistant_name}, a saleperson in a {domain} store.\n"
+    "You are here to converse and assist {user_name} with {domain} shopping.\n"
+    "Your goal is to capture user preferences and make recommendations based on the products in the store."
+    "Below are the products available in the store:\n\n"
+    "{products}\n"
+    "Be informative and engaging while providing insights to arouse {user_name}'s interest.\n"
+    "Your words at each turn should be concise (no longer than 30 words).\n\n"
+)
+
+MODERATOR_TEMPLATE = PromptTemplate(
+    "You are the moderator of a conversation. You need to determine whether the discussion between Role-S and Role-U should come to an immediate end.\n"
+    "The conversation should conclude under the following two conditions:\n"
+    "(1) If Role-S completes the recommendation, the user accepts the recommendation\n"
+    "(2) If Role-U explicitly rejects Role-S's recommendation when Role-S has tried to recommend it for the second time.\n"
+    "(3) The conversation between the user and the system reaches the maximum number of rounds limit ({max_interaction_step} rounds)"
+    "In either of these cases, the conversation should be brought to an immediate end.\n\n"
+    "For example, here is a conversation:\n## {seed_continue}"
+    "Should the conversation end? The answer is no.\n\n"
+    "Here is another conversation:\n## {seed_end}"
+    "Should the conversation end? The answer is yes."
+)
+TERMINAL_CONDITION_TEMPLATE = PromptTemplate(
+    "Now, for the above discussion between {user_name} (Role-S) and {assistant_name} (Role-U), should the conversation end? Answer yes or no."
+)
+
+
+def render_profile(user_profile):
+    occupation = user_profile["Occupation"] if user_profile["Occupation"] in ("Student", "Employed") else "Retired"
+    gender = "Male" if user_profile["Gender"] == "Male" else "Female"
+    return PROFILE_TEMPLATES[(occupation, gender)].render(age_range=user_profile["Age Range"].lower(), residence=user_profile["Residence"])
+
+
+def render_personality(personality):
+    return "".join([PERSONALITY_TRAIT_TEMPLATE.render(trait=trait, value=value) for trait, value in personality.items()])
+
+
+def render_instructions(domain, user_profile, assistant_profile, user_personality, conversation_end_or_continue_sample,
+                        max_interaction_step, different_type_name, simulate_preference, second_simulate_preference,
+                        products_desc, second_products_desc, with_image=True):
+    """
+    The environment description and the role descriptions of a dialog, once its preferences are drawn and its
+    products described. Returns (env_desc, user_dict, assistant_dict, moderator_dict) as create_instruct does.
+    """
+    env_desc = (ENV_WITH_IMAGE_TEMPLATE if with_image else ENV_TEMPLATE).render(domain=domain)
+
+    user_name = user_profile["Name"]
+    assistant_name = assistant_profile["Name"]
+    user_slots = {"name": user_name, "profile": render_profile(user_profile), "personality": render_personality(user_personality)}
+    user_desc_original = USER_TEMPLATE.render(preference=simulate_preference, **user_slots)
+    user_desc_transition = USER_TEMPLATE.render(preference=second_simulate_preference, **user_slots)
+    user_dict = {
+        "name": user_name,
+        "role_desc": user_desc_original,
+        "role_desc_in_transition_turn": user_desc_transition + USER_TRANSITION_TURN_TEMPLATE.render(type_name=different_type_name),
+        "role_desc_after_transition_turn": user_desc_transition
+    }
+
+    assistant_slots = {"assistant_name": assistant_name, "user_name": user_name, "domain": domain}
+    assistant_desc_original = ASSISTANT_TEMPLATE.render(products=products_desc, **assistant_slots)
+    assistant_dict = {
+        "name": assistant_name,
+        "role_desc": assistant_desc_original,
+        "role_desc_in_transition_turn": assistant_desc_original,
+        "role_desc_after_transition_turn": ASSISTANT_TEMPLATE.render(products=second_products_desc, **assistant_slots)
+    }
+
+    moderator_dict = {
+        "role_desc": MODERATOR_TEMPLATE.render(
+            max_interaction_step=max_interaction_step,
+            seed_continue=conversation_end_or_continue_sample["seed_continue"],
+            seed_end=conversation_end_or_continue_sample["seed_end"]),
+        # Role-S and Role-U are named in this order since the first version of the prompts
+        "terminal_condition": TERMINAL_CONDITION_TEMPLATE.render(user_name=user_name, assistant_name=assistant_name)
+    }
+    return env_desc, user_dict, assistant_dict, moderator_dict
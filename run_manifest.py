@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import random
+import hashlib
+
+MANIFEST_FILE_NAME = "manifest.json"
+REJECTED_FILE_NAME = "rejected_dialogs.json"
+MANIFEST_VERSION = 1
+
+
+def config_hash(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _write_json_atomic(path, obj):
+    # write to a temporary file first so that a crash never leaves a half-written manifest behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class RunManifest:
+    """
+    Durable state of a generation run, stored as `manifest.json` in the run directory.
+    It records the generation config (and its hash), the dialog indices that are finished, how many
+    bytes of the output and rejected dialogs files are complete and the random state, so that an
+    interrupted run can be resumed without redoing or duplicating any dialog.
+    """
+
+    def __init__(self, run_dir, config, output_file, random_seed=None, completed=None, output_bytes=0, rejected_bytes=0, rng_state=None):
+        self.run_dir = run_dir
+        self.config = config
+        self.config_hash = config_hash(config)
+        self.output_file = output_file
+        self.random_seed = random_seed
+        self.completed = set(completed or [])
+        self.output_bytes = output_bytes
+        self.rejected_bytes = rejected_bytes
+        self.rng_state = rng_state
+
+    @property
+    def run_id(self):
+        """The timestamp of the run, taken from its `run_<timestamp>` directory name."""
+        name = os.path.basename(os.path.normpath(self.run_dir))
+        return name[len("run_"):] if name.startswith("run_") else name
+
+    @property
+    def path(self):
+        return os.path.join(self.run_dir, MANIFEST_FILE_NAME)
+
+    @property
+    def output_path(self):
+        return os.path.join(self.run_dir, self.output_file)
+
+    @property
+    def rejected_path(self):
+        return os.path.join(self.run_dir, REJECTED_FILE_NAME)
+
+    @classmethod
+    def create(cls, run_dir, config, output_file, random_seed=None):
+        os.makedirs(run_dir, exist_ok=True)
+        manifest = cls(run_dir, config, output_file, random_seed=random_seed)
+        manifest.save()
+        return manifest
+
+    @classmethod
+    def load(cls, run_dir):
+        path = os.path.join(run_dir, MANIFEST_FILE_NAME)
+        if not os.path.exists(path):
+            raise ValueError(f"No run manifest found in {run_dir}.")
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported run manifest version: {data.get('version')}")
+        manifest = cls(run_dir, data["config"], data["output_file"], random_seed=data["random_seed"],
+                       completed=data["completed"], output_bytes=data["output_bytes"],
+                       rejected_bytes=data.get("rejected_bytes", 0), rng_state=data["rng_state"])
+        if manifest.config_hash != data["config_hash"]:
+            raise ValueError(f"The config in {path} does not match its hash, the manifest is corrupted.")
+        return manifest
+
+    def check_config(self, config):
+        """Make sure a resumed run uses the same generation config as the original one."""
+        if config_hash(config) != self.config_hash:
+            changed = sorted(k for k in set(config) | set(self.config) if config.get(k) != self.config.get(k))
+            raise ValueError(f"The generation config differs from the one of the run in {self.run_dir}: {changed}")
+
+    def is_completed(self, dialog_idx):
+        return dialog_idx in self.completed
+
+    def mark_completed(self, dialog_idx, output_bytes=None, rejected_bytes=None):
+        """Record a finished dialog (saved or rejected) after its output has been flushed to disk."""
+        self.completed.add(dialog_idx)
+        if output_bytes is not None:
+            self.output_bytes = output_bytes
+        if rejected_bytes is not None:
+            self.rejected_bytes = rejected_bytes
+        self.save()
+
+    def save(self):
+        # the random state only matters for runs without a seed, where dialogs share one random stream
+        self.rng_state = random.getstate() if self.random_seed is None else None
+        _write_json_atomic(self.path, {
+            "version": MANIFEST_VERSION,
+            "config": self.config,
+            "config_hash": self.config_hash,
+            "random_seed": self.random_seed,
+            "seed_scheme": "sha256(random_seed:dialog:dialog_idx)",
+            "rng_state": self.rng_state,
+            "output_file": self.output_file,
+            "output_bytes": self.output_bytes,
+            "rejected_bytes": self.rejected_bytes,
+            "completed": sorted(self.completed),
+            "updated_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+        })
+
+    def restore_rng_state(self):
+        if self.random_seed is None and self.rng_state is not None:
+            version, internal_state, gauss_next = self.rng_state
+            random.setstate((version, tuple(internal_state), gauss_next))
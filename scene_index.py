@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import random
+import hashlib
+from collections import defaultdict
+
+from data_utils import resolve_scene_paths, extract_object_info, collect_type_info
+
+SCENE_INDEX_VERSION = 2
+
+
+def _list_dir(path):
+    return set(os.path.join(path, name) for name in os.listdir(path)) if os.path.isdir(path) else set()
+
+
+def _dir_mtime_ns(path):
+    return os.stat(path).st_mtime_ns if os.path.isdir(path) else None
+
+
+def _seed_scenes_digest(seed_dialog_data):
+    scenes = [(dialog_data["domain"], dialog_data["scene_ids"]) for dialog_data in seed_dialog_data]
+    return hashlib.sha256(json.dumps(scenes, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _metadata_types_digest(metadata):
+    types = sorted((name, info.get("type")) for name, info in metadata.items())
+    return hashlib.sha256(json.dumps(types).encode("utf-8")).hexdigest()
+
+
+def scene_index_fingerprint(image_pool_path, image_info_pool_path, seed_dialog_data, fashion_metadata, furniture_metadata):
+    """
+    What an index depends on: the pool paths, their contents (through the directory mtimes), the scenes of the
+    seed dialogs and the object types of the metadata.
+    """
+    return {
+        "image_pool_path": image_pool_path,
+        "image_info_pool_path": image_info_pool_path,
+        "image_pool_mtime_ns": _dir_mtime_ns(image_pool_path),
+        "image_info_pool_mtime_ns": _dir_mtime_ns(image_info_pool_path),
+        "seed_scenes_sha256": _seed_scenes_digest(seed_dialog_data),
+        "fashion_types_sha256": _metadata_types_digest(fashion_metadata),
+        "furniture_types_sha256": _metadata_types_digest(furniture_metadata),
+    }
+
+
+class SceneIndex:
+    """
+    The screenshot and scene json paths of every seed dialog, resolved once against the scene pools
+    (listing each pool directory a single time) and persisted as JSON, so that selecting scenes for a
+    dialog is a lookup instead of `os.path.exists` calls. Only the scenes present in the pools are kept.
+
+    It also keeps the object types of the first scene of every dialog, as a bitmask over the sorted types of
+    its domain, and an inverted index from each type to the dialogs whose first scene has it, so that a
+    partner scene with a type the first scene lacks is drawn directly (see `sample_partner`).
+    """
+
+    def __init__(self, fingerprint, scene_paths, domains, scene_types):
+        self.fingerprint = fingerprint
+        # seed dialog index -> (screenshot paths, scene json paths), for the dialogs with at least one scene
+        self.scene_paths = scene_paths
+        self.valid_dialog_ids = sorted(scene_paths)
+        # seed dialog index -> domain, and the sorted object types of the first scene (None for an unknown domain)
+        self.domains = domains
+        self.scene_types = scene_types
+
+        # domain -> sorted object types, bit i of a mask stands for the i-th type
+        self.type_vocab = {}
+        for dialog_idx, types in scene_types.items():
+            if types is not None:
+                self.type_vocab.setdefault(domains[dialog_idx], set()).update(types)
+        self.type_vocab = {domain: sorted(types) for domain, types in self.type_vocab.items()}
+        type_bits = {domain: {t: bit for bit, t in enumerate(types)} for domain, types in self.type_vocab.items()}
+
+        self.type_masks = {}
+        # domain -> bit -> seed dialog indices whose first scene has the type
+        self.type_to_dialog_ids = {domain: defaultdict(list) for domain in self.type_vocab}
+        for dialog_idx in self.valid_dialog_ids:
+            types = scene_types[dialog_idx]
+            if types is None:
+                continue
+            domain = domains[dialog_idx]
+            mask = 0
+            for t in types:
+                bit = type_bits[domain][t]
+                mask |= 1 << bit
+                self.type_to_dialog_ids[domain][bit].append(dialog_idx)
+            self.type_masks[dialog_idx] = mask
+        # (domain, mask) -> seed dialog indices whose first scene has a type missing from the mask
+        self._partner_cache = {}
+
+    @classmethod
+    def build(cls, image_pool_path, image_info_pool_path, seed_dialog_data, fashion_metadata, furniture_metadata):
+        existing_paths = _list_dir(image_pool_path) | _list_dir(image_info_pool_path)
+        metadata_by_domain = {"fashion": fashion_metadata, "furniture": furniture_metadata}
+        scene_paths, domains, scene_types = {}, {}, {}
+        for dialog_idx, dialog_data in enumerate(seed_dialog_data):
+            image_paths, info_paths = resolve_scene_paths(dialog_data, image_pool_path, image_info_pool_path, exists=existing_paths.__contains__)
+            if len(image_paths) == 0:
+                continue
+            scene_paths[dialog_idx] = (image_paths, info_paths)
+            domain = domains[dialog_idx] = dialog_data["domain"]
+            if domain in metadata_by_domain:
+                scene_types[dialog_idx] = collect_type_info(extract_object_info(info_paths[0], metadata_by_domain[domain]))
+            else:
+                scene_types[dialog_idx] = None
+        fingerprint = scene_index_fingerprint(image_pool_path, image_info_pool_path, seed_dialog_data, fashion_metadata, furniture_metadata)
+        return cls(fingerprint, scene_paths, domains, scene_types)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != SCENE_INDEX_VERSION:
+            raise ValueError(f"Unsupported scene index version: {data.get('version')}")
+        scenes = {int(idx): scene for idx, scene in data["scenes"].items()}
+        return cls(data["fingerprint"],
+                   {idx: (scene["images"], scene["infos"]) for idx, scene in scenes.items()},
+                   {idx: scene["domain"] for idx, scene in scenes.items()},
+                   {idx: scene["types"] for idx, scene in scenes.items()})
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"  # the workers of a run may build it at once
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "version": SCENE_INDEX_VERSION,
+                "fingerprint": self.fingerprint,
+                "scenes": {str(idx): {"images": image_paths, "infos": info_paths, "domain": self.domains[idx], "types": self.scene_types[idx]}
+                           for idx, (image_paths, info_paths) in self.scene_paths.items()},
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load_or_build(cls, path, image_pool_path, image_info_pool_path, seed_dialog_data, fashion_metadata, furniture_metadata):
+        """Load the index saved at `path` if it matches the pools, the seed dialogs and the metadata, otherwise build and save it."""
+        fingerprint = scene_index_fingerprint(image_pool_path, image_info_pool_path, seed_dialog_data, fashion_metadata, furniture_metadata)
+        if path is not None and os.path.exists(path):
+            try:
+                index = cls.load(path)
+            except (OSError, ValueError, KeyError):
+                index = None
+            if index is not None and index.fingerprint == fingerprint:
+                return index
+        index = cls.build(image_pool_path, image_info_pool_path, seed_dialog_data, fashion_metadata, furniture_metadata)
+        if path is not None:
+            index.save(path)
+        return index
+
+    def get_scene_paths(self, dialog_idx):
+        image_paths, info_paths = self.scene_paths.get(dialog_idx, ([], []))
+        return list(image_paths), list(info_paths)
+
+    def sample_partner(self, dialog_idx):
+        """
+        Draw a seed dialog of the same domain, uniformly among those whose first scene has an object type missing from
+        the first scene of `dialog_idx`, and return it with the first of these types (in sorted order).
+        """
+        domain = self.domains[dialog_idx]
+        mask = self.type_masks[dialog_idx]
+        key = (domain, mask)
+        candidates = self._partner_cache.get(key)
+        if candidates is None:
+            candidate_ids = set()
+            for bit, dialog_ids in self.type_to_dialog_ids[domain].items():
+                if not mask >> bit & 1:
+                    candidate_ids.update(dialog_ids)
+            candidates = self._partner_cache[key] = sorted(candidate_ids)
+        if not candidates:
+            raise ValueError(f"No {domain} scene has an object type missing from {self.scene_paths[dialog_idx][1][0]}.")
+        partner_idx = random.choice(candidates)
+        new_types = self.type_masks[partner_idx] & ~mask
+        return partner_idx, self.type_vocab[domain][(new_types & -new_types).bit_length() - 1]
+
+    def __len__(self):
+        return len(self.scene_paths)
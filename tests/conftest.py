@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The tests import the scripts and the chatarena package of the repository root, like the benchmarks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
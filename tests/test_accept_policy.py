@@ -0,0 +1,96 @@
+import pytest
+
+from accept_policy import AcceptAllPolicy, RuleBasedPolicy, load_policy
+from chatarena.agent import SIGNAL_END_OF_CONVERSATION
+from chatarena.message import Message, MessagePool
+
+PLAYERS = ["Assistant", "User"]
+GOOD_DIALOG = [
+    "Hi, welcome to the store. What are you looking for today?",
+    "I need a warm jacket for the winter.",
+    "The red jacket on the left wall is lined with wool and costs 79.99.",
+    "That sounds great, I will take it.",
+]
+
+
+def pool_of(contents, names=PLAYERS):
+    """A message pool where the players take turns, starting with the first one."""
+    pool = MessagePool()
+    for turn, content in enumerate(contents):
+        pool.append_message(Message(agent_name=names[turn % len(names)], content=content, turn=turn))
+    return pool
+
+
+def replaced(index, content):
+    contents = list(GOOD_DIALOG)
+    contents[index] = content
+    return contents
+
+
+def test_a_good_dialog_is_accepted():
+    assert RuleBasedPolicy()(pool_of(GOOD_DIALOG), PLAYERS) == (True, "")
+
+
+def test_min_messages():
+    assert RuleBasedPolicy()(pool_of(GOOD_DIALOG[:3]), PLAYERS) == (False, "only 3 messages")
+    assert RuleBasedPolicy(min_messages=3)(pool_of(GOOD_DIALOG[:3]), PLAYERS) == (True, "")
+    assert RuleBasedPolicy()(pool_of([]), PLAYERS) == (False, "only 0 messages")
+
+
+def test_every_player_must_speak():
+    assert RuleBasedPolicy()(pool_of(GOOD_DIALOG, names=["Assistant"]), PLAYERS) == (False, "User never spoke")
+
+
+def test_max_words():
+    long_message = " ".join(["word"] * 81)
+    assert RuleBasedPolicy()(pool_of(replaced(1, long_message)), PLAYERS) == (False, "message from User is longer than 80 words")
+    assert RuleBasedPolicy()(pool_of(replaced(1, " ".join(["word"] * 80))), PLAYERS) == (True, "")
+    assert RuleBasedPolicy(max_words_per_message=10)(pool_of(GOOD_DIALOG), PLAYERS) == (False, "message from Assistant is longer than 10 words")
+    assert RuleBasedPolicy(max_words_per_message=None)(pool_of(replaced(1, long_message)), PLAYERS) == (True, "")
+
+
+@pytest.mark.parametrize("content, pattern", [
+    ("As an AI, I do not wear jackets.", r"\bas an ai\b"),
+    ("I am only a language model.", r"\blanguage model\b"),
+    ("I'm sorry, but I can't help with that.", r"\bi(?: a|')m sorry, but i can(?:no|')t\b"),
+    ("I am sorry, but I cannot show you that.", r"\bi(?: a|')m sorry, but i can(?:no|')t\b"),
+])
+def test_the_refusal_patterns(content, pattern):
+    assert RuleBasedPolicy()(pool_of(replaced(2, content)), PLAYERS) == (False, f"message from Assistant matches {pattern!r}")
+
+
+def test_the_refusal_patterns_match_whole_words_only():
+    # "as an aisle" and "I'm sorry, but I can find" are fine
+    contents = replaced(2, "It is as an aisle display, I'm sorry, but I can find you another one.")
+    assert RuleBasedPolicy()(pool_of(contents), PLAYERS) == (True, "")
+
+
+def test_custom_reject_patterns():
+    policy = RuleBasedPolicy(reject_patterns=[r"\bjacket\b"])
+    assert policy(pool_of(GOOD_DIALOG), PLAYERS) == (False, r"message from User matches '\\bjacket\\b'")
+    assert RuleBasedPolicy(reject_patterns=[])(pool_of(replaced(2, "As an AI, I cannot say.")), PLAYERS) == (True, "")
+
+
+@pytest.mark.parametrize("content", ["", "   \n"])
+def test_an_empty_response_is_rejected(content):
+    assert RuleBasedPolicy()(pool_of(replaced(3, content)), PLAYERS) == (False, "empty message from User")
+
+
+def test_a_failed_response_is_rejected():
+    # the player sends the end-of-conversation signal when its API call failed
+    contents = replaced(2, SIGNAL_END_OF_CONVERSATION)
+    assert RuleBasedPolicy()(pool_of(contents), PLAYERS) == (False, "Assistant failed to generate a response")
+
+
+def test_the_first_problem_is_reported():
+    contents = replaced(1, "")
+    contents[3] = "As an AI, I agree."
+    assert RuleBasedPolicy()(pool_of(contents), PLAYERS) == (False, "empty message from User")
+
+
+def test_load_policy():
+    policy = load_policy("rules", min_messages=2)
+    assert isinstance(policy, RuleBasedPolicy) and policy.min_messages == 2
+    assert isinstance(load_policy("accept_all"), AcceptAllPolicy)
+    with pytest.raises(ValueError, match="Unknown accept policy"):
+        load_policy("missing")
@@ -0,0 +1,103 @@
+import asyncio
+import time
+
+from chatarena.backends.concurrency import AdaptiveConcurrencyLimiter, is_overload_error
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+def run_requests(limiter, num_requests, error=None):
+    """Start `num_requests` requests at once and release them with `error`, returning their start times."""
+    async def run():
+        started = [await limiter.acquire() for _ in range(num_requests)]
+        for started_at in started:
+            limiter.release(started_at, error)
+        return started
+    return asyncio.run(run())
+
+
+def test_overload_errors():
+    assert is_overload_error(StatusError(429)) and is_overload_error(StatusError(503))
+    assert not is_overload_error(StatusError(400))
+    assert is_overload_error(asyncio.TimeoutError()) and not is_overload_error(ValueError())
+
+
+def run_saturated(limiter, num_requests):
+    """Keep the limit full: every request that ends is replaced by a new one."""
+    async def run():
+        in_flight = [await limiter.acquire() for _ in range(limiter.limit)]
+        for _ in range(num_requests):
+            limiter.release(in_flight.pop(0))
+            while limiter.in_flight < limiter.limit:
+                in_flight.append(await limiter.acquire())
+        for started_at in in_flight:
+            limiter.release(started_at)
+    asyncio.run(run())
+
+
+def test_the_limit_grows_by_one_after_a_saturated_window_of_successes():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=4, max_limit=6)
+    run_saturated(limiter, 4)
+    assert limiter.limit == 5
+    run_saturated(limiter, 50)
+    assert limiter.limit == 6  # the max limit
+    assert [(d.old_limit, d.new_limit, d.reason) for d in limiter.history] == [(4, 5, "increase"), (5, 6, "increase")]
+
+
+def test_the_limit_does_not_grow_while_it_is_not_used():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=4)
+    for _ in range(10):
+        run_requests(limiter, 2)
+    assert limiter.limit == 4
+
+
+def test_a_burst_of_overload_errors_halves_the_limit_once():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8, min_limit=2)
+    run_requests(limiter, 8, error=StatusError(429))
+    assert limiter.limit == 4
+    assert limiter.overloads == 8
+    time.sleep(0.001)
+    run_requests(limiter, 4, error=StatusError(503))
+    assert limiter.limit == 2
+    time.sleep(0.001)
+    run_requests(limiter, 2, error=StatusError(429))
+    assert limiter.limit == 2  # the min limit
+    run_requests(limiter, 2, error=StatusError(400))
+    assert limiter.overloads == 14
+
+
+def test_a_rising_latency_decreases_the_limit():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=8, latency_window=4, latency_tolerance=2.0)
+    now = time.time()
+    for _ in range(4):
+        limiter.in_flight += 1
+        limiter.release(now - 0.01)
+    for _ in range(4):
+        limiter.in_flight += 1
+        limiter.release(now - 0.1)
+    assert limiter.history[-1].reason == "latency"
+    assert limiter.limit == 4
+
+
+def test_the_requests_over_the_limit_wait_for_a_slot():
+    limiter = AdaptiveConcurrencyLimiter(initial_limit=2)
+
+    async def run():
+        first, second = await limiter.acquire(), await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        cancelled = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiter.done() and limiter.in_flight == 2
+        cancelled.cancel()
+        limiter.release(first)
+        await asyncio.sleep(0.01)
+        assert waiter.done() and limiter.in_flight == 2
+        limiter.release(second)
+        limiter.release(waiter.result())
+        assert limiter.in_flight == 0  # the cancelled request did not take a slot
+
+    asyncio.run(run())
@@ -0,0 +1,30 @@
+from chatarena.backends.local_moderator import LocalModerator, TerminalClassifier, round_features
+from chatarena.message import Message
+
+
+def history(*contents):
+    names = ["Assistant", "User"]
+    return [Message(agent_name=names[i % 2], content=content, turn=i) for i, content in enumerate(contents)]
+
+
+def test_every_round_is_checked_by_default():
+    moderator = LocalModerator()
+    assert moderator.decide(history("Here is a red shirt.", "Great, I'll take it!")) == ("yes", "rules")
+    assert moderator.decide(history("Here is a red shirt.", "Do you have it in blue?")) == ("no", "rules")
+    assert LocalModerator(min_rounds=2).decide(history("Here is a red shirt.", "Great, I'll take it!")) == ("no", "rules")
+
+
+def test_the_rules_only_look_at_the_last_message():
+    moderator = LocalModerator()
+    # the salesperson's goodbye alone does not end the dialog, the check is uncertain
+    assert moderator.decide(history("Have a nice day, goodbye!", "Thanks.")) == (None, "fallback")
+    assert moderator.query("Moderator", "", history("Have a nice day, goodbye!", "Thanks.")) == "no"
+
+
+def test_the_classifier_decides_the_rounds_the_rules_leave_out():
+    examples = [round_features("Have a nice day!", "Thanks.", 3)] * 20 + [round_features("What color?", "Red.", 3)] * 20
+    classifier = TerminalClassifier().fit(examples, [True] * 20 + [False] * 20)
+    moderator = LocalModerator(threshold=0.9)
+    moderator.classifier = classifier
+    assert moderator.decide(history("Have a nice day!", "Thanks.")) == ("yes", "classifier")
+    assert moderator.decide(history("What color?", "Red.")) == ("no", "classifier")
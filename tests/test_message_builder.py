@@ -0,0 +1,125 @@
+import json
+import random
+
+from chatarena.backends.openai import END_OF_MESSAGE, OpenAIChat, encode_image
+from chatarena.message import SYSTEM_NAME, Message
+
+AGENTS = ["User", "Assistant", "Moderator", SYSTEM_NAME]
+
+
+def baseline_messages(agent_name, role_desc, role_desc_in_transition_turn, role_desc_after_transition_turn, transition_turn, history_messages,
+                      global_prompt=None, request_msg=None, visual_path=None, second_visual_path=None, merge_other_agent_as_user=True):
+    """The messages that OpenAIChat.query assembled from three lists before the MessageBuilder."""
+    if global_prompt:
+        system_prompt = f"{global_prompt.strip()}\n\nYour name: {agent_name}\n\nYour role: {role_desc}"
+        system_prompt_in_transition_turn = f"{global_prompt.strip()}\n\nYour name: {agent_name}\n\nYour role: {role_desc_in_transition_turn}"
+        system_prompt_after_transition_turn = f"{global_prompt.strip()}\n\nYour name: {agent_name}\n\nYour role: {role_desc_after_transition_turn}"
+    else:
+        system_prompt = f"You are {agent_name}.\n\nYour role: {role_desc}"
+        system_prompt_in_transition_turn = f"You are {agent_name}.\n\nYour role: {role_desc_in_transition_turn}"
+        system_prompt_after_transition_turn = f"You are {agent_name}.\n\nYour role: {role_desc_after_transition_turn}"
+
+    all_messages = [(SYSTEM_NAME, system_prompt)]
+    all_messages_in_transition_turn = [(SYSTEM_NAME, system_prompt_in_transition_turn)]
+    all_messages_after_transition_turn = [(SYSTEM_NAME, system_prompt_after_transition_turn)]
+    for msg in history_messages:
+        if msg.agent_name == SYSTEM_NAME:
+            all_messages.append((SYSTEM_NAME, msg.content))
+            all_messages_in_transition_turn.append((SYSTEM_NAME, msg.content))
+            all_messages_after_transition_turn.append((SYSTEM_NAME, msg.content))
+        else:
+            all_messages.append((msg.agent_name, f"{msg.content}{END_OF_MESSAGE}"))
+            all_messages_in_transition_turn.append((msg.agent_name, f"{msg.content}{END_OF_MESSAGE}"))
+            all_messages_after_transition_turn.append((msg.agent_name, f"{msg.content}{END_OF_MESSAGE}"))
+
+    if request_msg is not None:
+        all_messages.append((SYSTEM_NAME, request_msg.content))
+        all_messages_in_transition_turn.append((SYSTEM_NAME, request_msg.content))
+        all_messages_after_transition_turn.append((SYSTEM_NAME, request_msg.content))
+    else:
+        all_messages.append((SYSTEM_NAME, f"Now you speak, {agent_name}.{END_OF_MESSAGE}"))
+        all_messages_in_transition_turn.append((SYSTEM_NAME, f"Now you speak, {agent_name}.{END_OF_MESSAGE}"))
+        all_messages_after_transition_turn.append((SYSTEM_NAME, f"Now you speak, {agent_name}.{END_OF_MESSAGE}"))
+
+    if visual_path is not None:
+        base64_image = encode_image(visual_path)
+        base64_image_in_transition_turn = encode_image(second_visual_path)
+        base64_image_after_transition_turn = encode_image(second_visual_path)
+    else:
+        base64_image = None
+        base64_image_in_transition_turn = None
+        base64_image_after_transition_turn = None
+
+    messages = []
+    if len(all_messages) <= transition_turn * 2 - 1:
+        final_use_messages = all_messages
+        final_base64_image = base64_image
+    elif len(all_messages) == transition_turn * 2 or len(all_messages) == transition_turn * 2 + 1:
+        final_use_messages = all_messages_in_transition_turn
+        final_base64_image = base64_image_in_transition_turn
+    else:
+        final_use_messages = all_messages_after_transition_turn
+        final_base64_image = base64_image_after_transition_turn
+
+    for i, msg in enumerate(final_use_messages):
+        if i == 0:
+            messages.append({"role": "system", "content": msg[1]})
+        elif msg[0] == agent_name:
+            messages.append({"role": "assistant", "content": msg[1]})
+        elif messages[-1]["role"] == "user":
+            if merge_other_agent_as_user:
+                if final_base64_image is not None:
+                    messages[-1]["content"] = [{"type": "text", "text": f"{messages[-1]['content']}\n\n[{msg[0]}]: {msg[1]}"}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{final_base64_image}"}}]
+                else:
+                    messages[-1]["content"] = f"{messages[-1]['content']}\n\n[{msg[0]}]: {msg[1]}"
+            else:
+                if final_base64_image is not None:
+                    messages.append({"role": "user", "content": [{"type": "text", "text": f"[{msg[0]}]: {msg[1]}"}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{final_base64_image}"}}]})
+                else:
+                    messages.append({"role": "user", "content": f"[{msg[0]}]: {msg[1]}"})
+        elif messages[-1]["role"] == "assistant":
+            messages[-1]["content"] = f"{messages[-1]['content']}\n{msg[1]}"
+        else:
+            messages.append({"role": "user", "content": f"[{msg[0]}]: {msg[1]}"})
+    return messages
+
+
+def random_message(rng, turn):
+    return Message(rng.choice(AGENTS), f"message {rng.randint(0, 10 ** 6)} of turn {turn}", turn)
+
+
+def test_the_builder_matches_the_baseline_assembly(tmp_path):
+    first_image, second_image = tmp_path / "first.png", tmp_path / "second.png"
+    first_image.write_bytes(b"first scene")
+    second_image.write_bytes(b"second scene")
+    rng = random.Random(0)
+    turns = 0
+    for dialog in range(60):
+        merge = rng.random() < 0.5
+        backend = OpenAIChat(merge_other_agents_as_one_user=merge)
+        with_image = rng.random() < 0.5
+        transition_turn = rng.randint(1, 6)
+        global_prompt = rng.choice([None, "", "  The shop.  "])
+        history = []
+        previous = []  # the messages returned before, they must not change afterwards
+        for turn in range(100):
+            for _ in range(rng.randint(0, 3)):
+                history.append(random_message(rng, turn))
+            edit = rng.random()
+            if edit < 0.05 and history:  # a truncated history
+                history = history[:rng.randint(0, len(history) - 1)]
+            elif edit < 0.1 and history:  # a message replaced by another one
+                history[rng.randrange(len(history))] = random_message(rng, turn)
+            elif edit < 0.12:  # a new list with the same messages
+                history = list(history)
+            kwargs = dict(agent_name=rng.choice(["User", "Assistant"]), role_desc=f"role {dialog}", role_desc_in_transition_turn=f"transition role {dialog}",
+                          role_desc_after_transition_turn=f"after role {dialog}", transition_turn=transition_turn, history_messages=history,
+                          global_prompt=global_prompt, request_msg=Message(SYSTEM_NAME, f"request {turn}", turn) if rng.random() < 0.3 else None,
+                          visual_path=str(first_image) if with_image else None, second_visual_path=str(second_image) if with_image else None)
+            messages = backend._build_messages(**kwargs)
+            expected = baseline_messages(**kwargs, merge_other_agent_as_user=merge)
+            assert json.dumps(messages) == json.dumps(expected), (dialog, turn)
+            previous.append((messages, json.dumps(messages)))
+            turns += 1
+        assert all(json.dumps(messages) == dumped for messages, dumped in previous)
+    assert turns == 6000
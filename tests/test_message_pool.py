@@ -0,0 +1,59 @@
+import random
+
+from chatarena.message import Message, MessagePool, MODERATOR_NAME
+
+AGENTS = ["Alice", "Bob", "Carol", MODERATOR_NAME]
+
+
+def linear_scan(messages, agent_name, turn):
+    # get_visible_messages before the index
+    prev_messages = [message for message in messages if message.turn < turn]
+    return [message for message in prev_messages
+            if message.visible_to == "all" or agent_name in message.visible_to or agent_name == "Moderator"]
+
+
+def random_message(rng, turn):
+    visible_to = rng.choice(["all", "all", "Alice", "Bob", ["Alice", "Carol"], [MODERATOR_NAME], []])
+    return Message(agent_name=rng.choice(AGENTS), content=f"message {rng.random()}", turn=turn, visible_to=visible_to)
+
+
+def check_against_linear_scan(pool, messages, max_turn):
+    for agent_name in AGENTS:
+        for turn in range(max_turn + 2):
+            assert pool.get_visible_messages(agent_name, turn) == linear_scan(messages, agent_name, turn)
+
+
+def test_the_index_matches_the_linear_scan_while_the_pool_grows():
+    rng = random.Random(0)
+    pool, messages = MessagePool(), []
+    turn = 0
+    for step in range(200):
+        turn += rng.choice([0, 0, 1])
+        message = random_message(rng, turn)
+        pool.append_message(message)
+        messages.append(message)
+        if step % 20 == 0:  # the agents query in between the appends, as in a dialog
+            check_against_linear_scan(pool, messages, turn)
+    check_against_linear_scan(pool, messages, turn)
+
+
+def test_decreasing_turns_fall_back_to_the_scan():
+    rng = random.Random(1)
+    pool, messages = MessagePool(), []
+    for turn in [0, 1, 2, 1, 3, 0, 4]:
+        message = random_message(rng, turn)
+        pool.append_message(message)
+        messages.append(message)
+    check_against_linear_scan(pool, messages, 4)
+
+
+def test_reset_clears_the_index():
+    pool = MessagePool()
+    pool.append_message(Message(agent_name="Alice", content="hi", turn=0))
+    assert len(pool.get_visible_messages("Bob", 1)) == 1
+    pool.reset()
+    assert pool.get_visible_messages("Bob", 1) == []
+    message = Message(agent_name="Alice", content="again", turn=0, visible_to=["Bob"])
+    pool.append_message(message)
+    assert pool.get_visible_messages("Bob", 1) == [message]
+    assert pool.get_visible_messages("Carol", 1) == []
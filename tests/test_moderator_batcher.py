@@ -0,0 +1,120 @@
+import re
+import json
+import time
+import asyncio
+
+from chatarena.backends.moderator_batcher import (ModeratorBatcher, PendingCheck, format_batch_messages, get_moderator_batcher_stats,
+                                                  parse_batch_answers)
+from chatarena.message import Message
+
+
+def pending_check(role_desc, text, global_prompt=None):
+    history = [Message(agent_name="Alice", content=text, turn=1)]
+    return PendingCheck(None, "Should the conversation end?", history, {"role_desc": role_desc, "global_prompt": global_prompt})
+
+
+def test_shared_instructions_are_sent_once_in_the_system_prompt():
+    system, user = format_batch_messages([pending_check("Rules A", "hi"), pending_check("Rules A", "hello")])
+    assert system["content"].startswith("Rules A\n\n")
+    assert "Rules A" not in user["content"]
+    assert "Conversation 1:\n[Alice]: hi\nQuestion 1:" in user["content"]
+    assert "Conversation 2:\n[Alice]: hello\nQuestion 2:" in user["content"]
+
+
+def test_every_conversation_follows_its_own_instructions():
+    checks = [pending_check("Rules A", "hi"), pending_check("Rules B", "hello", global_prompt="Shop"), pending_check("Rules A", "hey")]
+    system, user = format_batch_messages(checks)
+    assert "Rules" not in system["content"]
+    content = user["content"]
+    assert "Instructions 1:\nRules A" in content
+    assert "Instructions 2:\nShop\n\nRules B" in content
+    assert "Conversation 1 (follows Instructions 1):\n[Alice]: hi" in content
+    assert "Conversation 2 (follows Instructions 2):\n[Alice]: hello" in content
+    assert "Conversation 3 (follows Instructions 1):\n[Alice]: hey" in content
+
+
+def test_parse_batch_answers_keeps_the_yes_and_no_answers():
+    assert parse_batch_answers('```json\n{"1": "Yes", "2": "no", "3": "maybe"}\n```') == {"1": "yes", "2": "no"}
+    assert parse_batch_answers("no json here") == {}
+
+
+class StubModeratorBackend:
+    """Answers every conversation with its last message, "skip" is left out of the batch answer."""
+
+    def __init__(self):
+        self.model, self.temperature = "stub", 0.0
+        self.batches = []  # the conversations of every batch request
+        self.singles = []  # the last message of every check sent on its own
+
+    async def _async_cached_get_response(self, messages, max_tokens=None):
+        conversations = re.findall(r"Conversation (\d+)[^\n]*:\n\[Alice\]: (\w+)", messages[1]["content"])
+        self.batches.append([text for _, text in conversations])
+        return json.dumps({check_id: text for check_id, text in conversations if text != "skip"})
+
+    async def async_query(self, history_messages, **kwargs):
+        self.singles.append(history_messages[-1].content)
+        return "no"
+
+
+def check(batcher, backend, text):
+    history = [Message(agent_name="Alice", content=text, turn=1)]
+    return asyncio.ensure_future(batcher.check(backend, "Rules", "Should the conversation end?", history, {"agent_name": "Moderator"}))
+
+
+def test_the_checks_are_sent_once_the_batch_is_full():
+    async def run():
+        backend = StubModeratorBackend()
+        batcher = ModeratorBatcher(max_batch_size=3, max_wait=60)
+        answers = await asyncio.wait_for(asyncio.gather(*[check(batcher, backend, text) for text in ("yes", "no", "yes")]), timeout=5)
+        return backend, answers
+
+    backend, answers = asyncio.run(run())
+    assert answers == ["yes", "no", "yes"]
+    assert backend.batches == [["yes", "no", "yes"]] and backend.singles == []
+
+
+def test_the_checks_are_sent_after_max_wait():
+    async def run():
+        backend = StubModeratorBackend()
+        batcher = ModeratorBatcher(max_batch_size=16, max_wait=0.05)
+        started = time.perf_counter()
+        answers = await asyncio.gather(check(batcher, backend, "yes"), check(batcher, backend, "no"))
+        waited = time.perf_counter() - started
+        alone = await check(batcher, backend, "yes")  # a check alone is sent with the moderator prompt
+        return backend, answers + [alone], waited
+
+    backend, answers, waited = asyncio.run(run())
+    assert answers == ["yes", "no", "no"]
+    assert waited >= 0.05
+    assert backend.batches == [["yes", "no"]] and backend.singles == ["yes"]
+
+
+def test_the_checks_left_out_of_the_answer_are_sent_alone():
+    stats = get_moderator_batcher_stats().stats()
+
+    async def run():
+        backend = StubModeratorBackend()
+        batcher = ModeratorBatcher(max_batch_size=3, max_wait=60)
+        return backend, await asyncio.gather(*[check(batcher, backend, text) for text in ("yes", "skip", "no")])
+
+    backend, answers = asyncio.run(run())
+    assert answers == ["yes", "no", "no"]
+    assert backend.singles == ["skip"]
+    after = get_moderator_batcher_stats().stats()
+    assert after["fallbacks"] - stats["fallbacks"] == 1 and after["batched_checks"] - stats["batched_checks"] == 2
+    assert after["requests"] - stats["requests"] == 2
+
+
+def test_a_cancelled_dialog_drops_its_check():
+    async def run():
+        backend = StubModeratorBackend()
+        batcher = ModeratorBatcher(max_batch_size=16, max_wait=0.05)
+        tasks = [check(batcher, backend, text) for text in ("yes", "no", "no")]
+        await asyncio.sleep(0)
+        tasks[0].cancel()
+        answers = await asyncio.gather(*tasks[1:])
+        return backend, answers, tasks[0].cancelled()
+
+    backend, answers, cancelled = asyncio.run(run())
+    assert cancelled and answers == ["no", "no"]
+    assert backend.batches == [["no", "no"]]
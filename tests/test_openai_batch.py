@@ -0,0 +1,70 @@
+import pytest
+
+from chatarena.backends.openai import OpenAIChat
+from chatarena.backends.openai_batch import BatchJobRunner, BatchRequestError, LocalBatchTransport, set_batch_job_runner
+
+
+def body(text):
+    return {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": text}], "temperature": 0.7, "max_tokens": 10}
+
+
+def echo(request_body):
+    text = request_body["messages"][-1]["content"]
+    if text.startswith("fail"):
+        raise RuntimeError(f"cannot answer {text}")
+    return f" {text.upper()} "
+
+
+class CountingTransport(LocalBatchTransport):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.submitted = 0
+
+    def submit(self, input_file_id):
+        self.submitted += 1
+        return super().submit(input_file_id)
+
+
+def test_results_keep_the_order_of_the_requests_across_batches(tmp_path):
+    transport = CountingTransport(str(tmp_path / "api"), respond=echo)
+    runner = BatchJobRunner(transport, str(tmp_path / "batches"), poll_interval=0, max_requests_per_batch=2)
+    texts = [f"turn {i}" for i in range(5)]
+    assert runner.run([body(text) for text in texts]) == [text.upper() for text in texts]
+    assert transport.submitted == 3
+    assert runner.stats.stats()["batches"] == 3 and runner.stats.stats()["requests"] == 5
+
+
+def test_a_failed_request_is_an_error_in_its_place(tmp_path):
+    runner = BatchJobRunner(LocalBatchTransport(str(tmp_path / "api"), respond=echo), str(tmp_path / "batches"), poll_interval=0, max_requests_per_batch=2)
+    results = runner.run([body("a"), body("fail b"), body("c")])
+    assert results[0] == "A" and results[2] == "C"
+    assert isinstance(results[1], BatchRequestError) and "cannot answer fail b" in str(results[1])
+    assert runner.stats.stats()["failed_requests"] == 1
+
+
+def test_a_restarted_runner_waits_for_the_batch_it_submitted(tmp_path):
+    transport = CountingTransport(str(tmp_path / "api"), respond=echo)
+    bodies = [body("a"), body("b")]
+    BatchJobRunner(transport, str(tmp_path / "batches"), poll_interval=0)._submit(bodies)  # the run stops after submitting
+    restarted = BatchJobRunner(transport, str(tmp_path / "batches"), poll_interval=0)
+    assert restarted.run(bodies) == ["A", "B"]
+    assert transport.submitted == 1
+    assert restarted.run([body("c")]) == ["C"] and transport.submitted == 2  # other requests are a new batch
+
+
+def test_batch_query_sends_the_failed_requests_again(tmp_path, monkeypatch):
+    set_batch_job_runner(BatchJobRunner(LocalBatchTransport(str(tmp_path / "api"), respond=echo), str(tmp_path / "batches"), poll_interval=0))
+    backend = OpenAIChat(model="gpt-4o-mini", max_tokens=10)
+    sent = []
+
+    def get_response(messages, max_tokens=None):
+        sent.append(messages[-1]["content"])
+        return f"regular {messages[-1]['content']}"
+
+    monkeypatch.setattr(backend, "_get_response", get_response)
+    try:
+        responses = OpenAIChat.batch_get_responses([(backend, [{"role": "user", "content": text}], None) for text in ("a", "fail b", "c")])
+    finally:
+        set_batch_job_runner(None)
+    assert responses == ["A", "regular fail b", "C"]
+    assert sent == ["fail b"]
@@ -0,0 +1,122 @@
+import random
+import re
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from data_utils import sample_user_preferences, simulate_user_preference
+
+FASHION_SCENE = {
+    "a": {"assetType": "shirt", "customerReview": 4.0, "availableSizes": ["S", "M"], "color": "red", "pattern": "plain",
+          "brand": "Acme", "sleeveLength": "long", "type": "shirt", "price": 20},
+    "b": {"assetType": "jacket", "customerReview": 3.0, "availableSizes": ["L"], "color": "blue", "pattern": "NULL",
+          "brand": "Acme", "sleeveLength": "short", "type": "jacket", "price": 50.5},
+    "c": {"assetType": "jacket", "customerReview": 5.0, "availableSizes": ["M"], "color": "red", "pattern": "striped",
+          "brand": "Zeta", "sleeveLength": "long", "type": "coat", "price": 99},
+}
+FURNITURE_SCENE = {
+    "x": {"brand": "Home", "color": "white", "customerRating": 4.5, "materials": "wood", "price": "$120", "type": "Chair"},
+    "y": {"brand": "Casa", "color": "black", "customerRating": 3.5, "materials": "metal", "price": "$80", "type": "Table"},
+}
+
+
+def parse_preferences(text):
+    """label -> {value: choice} for the choice sections, label -> text for the others"""
+    sections = {}
+    for line in text.splitlines():
+        label, body = line.rstrip(";").split(": ", 1)
+        choices = re.findall(r"(\S+)\((favor|aversion|neutral)\)", body)
+        sections[label] = dict(choices) if choices else body
+    return sections
+
+
+def test_sections_medians_and_null_values():
+    preferences = parse_preferences(simulate_user_preference(FASHION_SCENE, "fashion"))
+    assert list(preferences) == ["Assert Type Preference", "Review Preference", "Size Preference", "Color Preference", "Pattern Preference",
+                                 "Brand Preference", "Sleeve Length Preference", "Type Preference", "Price Preference"]
+    assert set(preferences["Assert Type Preference"]) == {"shirt", "jacket"}
+    assert preferences["Review Preference"] == "greater than 4.0"
+    assert preferences["Size Preference"] in ("S", "M", "L")
+    assert set(preferences["Pattern Preference"]) == {"plain", "striped"}  # without NULL
+    assert preferences["Price Preference"] == "less than 50.5"
+
+    preferences = parse_preferences(simulate_user_preference(FURNITURE_SCENE, "furniture"))
+    assert list(preferences) == ["Brand Preference", "Color Preference", "Review Preference", "Materials Preference", "Price Preference", "Type Preference"]
+    assert preferences["Review Preference"] == "greater than 4.0"
+    assert preferences["Price Preference"] == "less than 100.0"
+    assert simulate_user_preference(FURNITURE_SCENE, "toys") is None
+
+
+def test_strict_preference_is_never_an_aversion():
+    random.seed(0)
+    strict, other = set(), set()
+    for _ in range(300):
+        types = parse_preferences(simulate_user_preference(FASHION_SCENE, "fashion", strict_preference="coat"))["Type Preference"]
+        strict.add(types["coat"])
+        other.add(types["jacket"])
+    assert strict == {"favor", "neutral"}
+    assert other == {"favor", "aversion", "neutral"}
+
+
+def test_without_strict_preference_every_type_can_be_disliked():
+    random.seed(0)
+    choices = {parse_preferences(simulate_user_preference(FURNITURE_SCENE, "furniture"))["Type Preference"]["Chair"] for _ in range(100)}
+    assert choices == {"favor", "aversion", "neutral"}
+
+
+def test_same_random_state_same_preferences():
+    random.seed(7)
+    first = simulate_user_preference(FASHION_SCENE, "fashion", strict_preference="shirt")
+    random.seed(7)
+    assert simulate_user_preference(FASHION_SCENE, "fashion", strict_preference="shirt") == first
+
+
+def choice_frequencies(preferences_list):
+    """(label, value or None, choice) -> frequency over the users"""
+    counts = Counter()
+    for preferences in preferences_list:
+        for label, section in parse_preferences(preferences).items():
+            if isinstance(section, dict):
+                counts.update((label, value, choice) for value, choice in section.items())
+            else:
+                counts[(label, None, section)] += 1
+    return {key: count / len(preferences_list) for key, count in counts.items()}
+
+
+@pytest.mark.parametrize("scene, domain, strict_preference", [(FASHION_SCENE, "fashion", "coat"), (FASHION_SCENE, "fashion", None), (FURNITURE_SCENE, "furniture", "Table")])
+def test_batch_sampler_matches_the_single_sampler(scene, domain, strict_preference):
+    random.seed(0)
+    num_users = 4000
+    single = [simulate_user_preference(scene, domain, strict_preference=strict_preference) for _ in range(num_users)]
+    batch = sample_user_preferences([(scene, domain, strict_preference)] * num_users, rng=np.random.default_rng(0))
+    single_frequencies, batch_frequencies = choice_frequencies(single), choice_frequencies(batch)
+    assert set(batch_frequencies) == set(single_frequencies)
+    for key, frequency in single_frequencies.items():
+        assert abs(batch_frequencies[key] - frequency) < 0.04, key
+    # the same sections in the same order, with the same medians
+    assert [line.split(": ")[0] for line in batch[0].splitlines()] == [line.split(": ")[0] for line in single[0].splitlines()]
+
+
+def test_batch_sampler_draws_once_for_every_scene():
+    class CountingGenerator:
+        def __init__(self):
+            self.rng, self.calls = np.random.default_rng(0), 0
+
+        def integers(self, low, high):
+            self.calls += 1
+            return self.rng.integers(low, high)
+
+    rng = CountingGenerator()
+    preferences = sample_user_preferences([(FASHION_SCENE, "fashion", "coat"), (FURNITURE_SCENE, "furniture", None), (FURNITURE_SCENE, "toys", None)] * 500, rng=rng)
+    assert rng.calls == 1
+    assert len(preferences) == 1500 and preferences[2] is None
+    assert parse_preferences(preferences[0])["Type Preference"]["coat"] != "aversion"
+    assert parse_preferences(preferences[1])["Price Preference"] == "less than 100.0"
+
+
+def test_batch_sampler_follows_the_random_seed():
+    random.seed(3)
+    first = sample_user_preferences([(FASHION_SCENE, "fashion", None)] * 10)
+    random.seed(3)
+    assert sample_user_preferences([(FASHION_SCENE, "fashion", None)] * 10) == first
@@ -0,0 +1,84 @@
+import json
+import os
+import random
+
+import pytest
+
+from data_utils import summarize_preferences
+from product_catalog import CATALOG_MAGIC, ProductCatalog, load_product_catalog
+
+METADATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scene_info_pool", "original_data")
+
+
+def save_and_load(catalog, path):
+    catalog.save(str(path))
+    return ProductCatalog.load(str(path))
+
+
+@pytest.mark.parametrize("domain", ["fashion", "furniture"])
+def test_round_trip_matches_the_metadata_json(tmp_path, domain):
+    metadata_path = os.path.join(METADATA_DIR, f"{domain}_prefab_metadata_all.json")
+    with open(metadata_path, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    catalog = save_and_load(ProductCatalog.from_json(metadata_path), tmp_path / "metadata.catalog")
+    assert list(catalog) == list(metadata)
+    for name, attributes in metadata.items():
+        entry = catalog[name]
+        assert entry == attributes
+        assert list(entry) == list(attributes)  # the attributes in the same order
+        assert [type(v) for v in entry.values()] == [type(v) for v in attributes.values()]
+
+
+def test_mixed_columns_missing_and_null_attributes(tmp_path):
+    metadata = {
+        "a": {"price": 25, "color": "red", "sizes": ["S", "M"], "extra": {"k": 1}},
+        "b": {"price": 30.5, "color": None, "sizes": None},
+        "c": {"price": None, "sizes": []},
+    }
+    catalog = save_and_load(ProductCatalog.from_metadata(metadata), tmp_path / "mixed.catalog")
+    assert {name: catalog[name] for name in catalog} == metadata
+    assert str(catalog["a"]["price"]) == "25"  # not 25.0 in the prompts
+    assert "d" not in catalog and len(catalog) == 3
+
+
+def test_the_strings_are_not_in_the_json_header(tmp_path):
+    path = tmp_path / "strings.catalog"
+    ProductCatalog.from_metadata({"prefab/ünïcode": {"brand": "Ünïque"}}).save(str(path))
+    data = path.read_bytes()
+    assert data.startswith(CATALOG_MAGIC)
+    header_length = int.from_bytes(data[len(CATALOG_MAGIC):len(CATALOG_MAGIC) + 8], "little")
+    header = json.loads(data[len(CATALOG_MAGIC) + 8:len(CATALOG_MAGIC) + 8 + header_length])
+    assert "strings" not in header and "Ünïque" not in json.dumps(header, ensure_ascii=False)
+    assert ProductCatalog.load(str(path))["prefab/ünïcode"] == {"brand": "Ünïque"}
+
+
+def test_the_catalog_is_rebuilt_when_the_metadata_change(tmp_path):
+    metadata_path = tmp_path / "shop.json"
+    metadata_path.write_text(json.dumps({"a": {"price": 1}}), encoding="utf-8")
+    assert dict(load_product_catalog(str(metadata_path), str(tmp_path / "catalogs"))) == {"a": {"price": 1}}
+    metadata_path.write_text(json.dumps({"a": {"price": 2}, "b": {"price": 3}}), encoding="utf-8")
+    assert dict(load_product_catalog(str(metadata_path), str(tmp_path / "catalogs"))) == {"a": {"price": 2}, "b": {"price": 3}}
+
+
+def test_prices_with_a_currency_sign_are_numbers(tmp_path):
+    metadata = {"a": {"price": "$199"}, "b": {"price": "$19.50"}, "c": {"price": None}, "d": {}}
+    catalog = save_and_load(ProductCatalog.from_metadata(metadata), tmp_path / "prices.catalog")
+    assert catalog.header["columns"]["price"]["kind"] == "currency"
+    assert {name: catalog[name] for name in catalog} == metadata
+    assert catalog.numeric_values("price", ["a", "b", "c", "d"]) == [199.0, 19.5]
+    # a text that would not be written back the same stays a string
+    catalog = ProductCatalog.from_metadata({"a": {"price": "$0199"}, "b": {"price": "$5"}})
+    assert catalog.header["columns"]["price"]["kind"] == "str" and catalog.numeric_values("price", ["a"]) is None
+
+
+@pytest.mark.parametrize("domain", ["fashion", "furniture"])
+def test_preference_medians_from_the_columns_match_the_metadata_json(tmp_path, domain):
+    metadata_path = os.path.join(METADATA_DIR, f"{domain}_prefab_metadata_all.json")
+    with open(metadata_path, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    catalog = save_and_load(ProductCatalog.from_json(metadata_path), tmp_path / "metadata.catalog")
+    rng = random.Random(0)
+    for _ in range(50):
+        names = rng.sample(list(metadata), min(len(metadata), rng.randint(1, 12)))
+        expected = summarize_preferences({name: metadata[name] for name in names}, domain)
+        assert summarize_preferences({name: catalog[name] for name in names}, domain, metadata=catalog) == expected
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from chatarena.backends.rate_limit import RateLimiter, estimate_request_tokens
+
+
+def test_estimate_request_tokens():
+    messages = [{"role": "system", "content": "x" * 400},
+                {"role": "user", "content": [{"type": "text", "text": "y" * 40}, {"type": "image_url", "image_url": {"url": "data:"}}]}]
+    assert estimate_request_tokens(messages, max_tokens=100) == 100 + 4 + 100 + 4 + 10 + 255
+
+
+def test_requests_wait_once_the_burst_is_spent():
+    limiter = RateLimiter(rpm=60, burst_seconds=10)  # one request per second, up to 10 at once
+    waits = [limiter._reserve(0) for _ in range(12)]
+    assert waits[:10] == [0.0] * 10
+    assert waits[10] == pytest.approx(1.0, abs=0.05)
+    assert waits[11] == pytest.approx(2.0, abs=0.05)
+
+
+def test_the_wait_covers_the_tokens_too():
+    limiter = RateLimiter(rpm=600, tpm=6000, burst_seconds=1)  # a bucket of 100 tokens, 100 tokens per second
+    assert limiter._reserve(100) == 0.0
+    assert limiter._reserve(50) == pytest.approx(0.5, abs=0.05)
+
+
+def test_limiters_with_the_same_state_file_share_the_budget(tmp_path):
+    state_path = str(tmp_path / "rate_limit.json")
+    first, second = RateLimiter(rpm=60, burst_seconds=2, state_path=state_path), RateLimiter(rpm=60, burst_seconds=2, state_path=state_path)
+    assert first._reserve(0) == 0.0
+    assert second._reserve(0) == 0.0
+    assert first._reserve(0) == pytest.approx(1.0, abs=0.05)
+
+
+def test_a_cancelled_waiter_gives_its_reservation_back():
+    limiter = RateLimiter(rpm=60, burst_seconds=1)
+
+    async def run():
+        await limiter.async_acquire(0)
+        waiter = asyncio.ensure_future(limiter.async_acquire(0))
+        await asyncio.sleep(0.1)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        while limiter._refunds:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    # without the refund, the next request would wait for the one that was cancelled too
+    assert limiter._reserve(0) == pytest.approx(0.9, abs=0.05)
+    assert limiter.stats.stats()["requests"] == 1
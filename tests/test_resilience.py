@@ -0,0 +1,189 @@
+import time
+import types
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from chatarena.backends.rate_limit import estimate_request_tokens
+from chatarena.backends.resilience import CircuitBreaker, CircuitOpenError, ResiliencePolicy
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def status_error(error_type, status_code):
+    return error_type("error", response=httpx.Response(status_code, request=REQUEST), body=None)
+
+
+def fail_with(error):
+    def make_call():
+        raise error
+    return make_call
+
+
+def open_circuit(policy, failures):
+    for _ in range(failures):
+        with pytest.raises(openai.RateLimitError):
+            policy.call(fail_with(status_error(openai.RateLimitError, 429)))
+
+
+def test_circuit_opens_after_failures_in_a_row_and_rejects():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    policy = ResiliencePolicy(circuit_breaker=breaker)
+    open_circuit(policy, 2)
+    assert policy.call(lambda: "ok") == "ok"  # a success resets the count
+    open_circuit(policy, 3)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        policy.call(lambda: "ok")
+    assert policy.stats.stats()["rejected"] == 1
+
+
+def test_request_errors_do_not_open_the_circuit():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    policy = ResiliencePolicy(circuit_breaker=breaker)
+    with pytest.raises(openai.BadRequestError):
+        policy.call(fail_with(status_error(openai.BadRequestError, 400)))
+    assert breaker.state == "closed"
+
+
+@pytest.mark.parametrize("trial_error, state", [(None, "closed"), (status_error(openai.RateLimitError, 429), "open")])
+def test_trial_call_closes_or_reopens_the_circuit(trial_error, state):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    policy = ResiliencePolicy(circuit_breaker=breaker)
+    open_circuit(policy, 1)
+    time.sleep(0.06)
+
+    def trial():
+        assert breaker.state == "half-open"
+        with pytest.raises(CircuitOpenError):  # only one trial at a time
+            policy.call(lambda: "ok")
+        if trial_error is not None:
+            raise trial_error
+        return "ok"
+
+    if trial_error is None:
+        assert policy.call(trial) == "ok"
+    else:
+        with pytest.raises(type(trial_error)):
+            policy.call(trial)
+    assert breaker.state == state
+
+
+def test_trial_with_a_request_error_is_released():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    policy = ResiliencePolicy(circuit_breaker=breaker)
+    open_circuit(policy, 1)
+    time.sleep(0.06)
+    with pytest.raises(openai.BadRequestError):
+        policy.call(fail_with(status_error(openai.BadRequestError, 400)))
+    assert breaker.state == "open"
+    assert policy.call(lambda: "ok") == "ok"  # the next call is the trial
+    assert breaker.state == "closed"
+
+
+def test_cancelled_trial_is_released():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    policy = ResiliencePolicy(timeout=5, circuit_breaker=breaker)
+    open_circuit(policy, 1)
+    time.sleep(0.06)
+
+    async def run():
+        async def hang():
+            await asyncio.sleep(10)
+
+        async def answer():
+            return "ok"
+
+        trial = asyncio.ensure_future(policy.async_call(hang))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half-open"
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        return await policy.async_call(answer)
+
+    assert asyncio.run(run()) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_client_timeouts_are_counted():
+    policy = ResiliencePolicy(timeout=1)
+    with pytest.raises(openai.APITimeoutError):
+        policy.call(fail_with(openai.APITimeoutError(request=REQUEST)))
+
+    async def slow():
+        await asyncio.sleep(1)
+
+    policy.timeout = 0.01
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(policy.async_call(slow))
+    assert policy.stats.stats()["timeouts"] == 2
+
+
+class SlowFirstClient:
+    """A stand-in OpenAI client whose first request is slow, so that the policy sends a hedge."""
+
+    def __init__(self, is_async):
+        self.is_async = is_async
+        self.requests = 0
+        self.chat = self.completions = self
+
+    def with_options(self, **options):
+        return self
+
+    def create(self, **kwargs):
+        self.requests += 1
+        delay = 0.5 if self.requests == 1 else 0.0
+        answer = types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=f"answer {self.requests}"))])
+        if not self.is_async:
+            time.sleep(delay)
+            return answer
+
+        async def create():
+            await asyncio.sleep(delay)
+            return answer
+        return create()
+
+
+@pytest.fixture
+def hedging_backend(monkeypatch):
+    from chatarena.backends import openai as openai_backend
+    from chatarena.backends.concurrency import AdaptiveConcurrencyLimiter, set_concurrency_limiter
+    from chatarena.backends.rate_limit import RateLimiter, set_rate_limiter
+    from chatarena.backends.resilience import set_resilience_policy
+
+    policy = ResiliencePolicy(hedge_percentile=50, hedge_min_samples=1)
+    policy.request_latencies.add(0.01)  # the hedge goes after 10 ms
+    rate_limiter, concurrency_limiter = RateLimiter(rpm=6000, tpm=10 ** 6), AdaptiveConcurrencyLimiter(initial_limit=4)
+    set_resilience_policy(policy)
+    set_rate_limiter(rate_limiter)
+    set_concurrency_limiter(concurrency_limiter)
+    clients = {"sync": SlowFirstClient(is_async=False), "async": SlowFirstClient(is_async=True)}
+    monkeypatch.setattr(openai_backend, "get_openai_client", lambda: clients["sync"])
+    monkeypatch.setattr(openai_backend, "get_async_openai_client", lambda: clients["async"])
+    yield openai_backend.OpenAIChat(max_tokens=10), policy, rate_limiter, concurrency_limiter
+    set_resilience_policy(None)
+    set_rate_limiter(None)
+    set_concurrency_limiter(None)
+
+
+MESSAGES = [{"role": "system", "content": "You are a salesperson."}, {"role": "user", "content": "Hi!"}]
+
+
+def test_a_hedge_pays_for_its_budget(hedging_backend):
+    backend, policy, rate_limiter, _ = hedging_backend
+    assert backend._get_response(MESSAGES) == "answer 2"
+    assert policy.stats.stats()["hedges"] == 1
+    assert rate_limiter.stats.stats()["requests"] == 2
+    assert rate_limiter.stats.stats()["tokens"] == 2 * estimate_request_tokens(MESSAGES, 10)
+
+
+def test_an_async_hedge_pays_for_its_budget_and_holds_a_slot(hedging_backend):
+    backend, policy, rate_limiter, concurrency_limiter = hedging_backend
+    assert asyncio.run(backend._async_get_response(MESSAGES)) == "answer 2"
+    assert policy.stats.stats()["hedges"] == 1
+    assert rate_limiter.stats.stats()["requests"] == 2
+    assert concurrency_limiter.requests == 2  # the call and its hedge
+    assert concurrency_limiter.in_flight == 0
@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from chatarena.backends.openai import OpenAIChat
+from chatarena.backends.response_cache import ResponseCache, set_response_cache
+
+MESSAGES = [{"role": "system", "content": "You are a salesperson."}, {"role": "user", "content": "Hi!"}]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / "responses.db"))
+    yield cache
+    cache.close()
+
+
+def test_hit_and_miss(cache):
+    key = ResponseCache.make_key("gpt-4o-mini", MESSAGES, 0.7, 100)
+    assert cache.get(key) is None
+    cache.put(key, "Hello!")
+    assert cache.get(key) == "Hello!"
+    assert cache.get(ResponseCache.make_key("gpt-4o-mini", MESSAGES, 0.5, 100)) is None  # another temperature
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 1)
+
+
+def test_the_key_holds_the_digest_of_the_inline_images():
+    def messages(data):
+        return [{"role": "user", "content": [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{data}"}}]}]
+    assert ResponseCache.make_key("m", messages("AAAA"), 0.7, 10) == ResponseCache.make_key("m", messages("AAAA"), 0.7, 10)
+    assert ResponseCache.make_key("m", messages("AAAA"), 0.7, 10) != ResponseCache.make_key("m", messages("BBBB"), 0.7, 10)
+
+
+def test_the_responses_persist_and_are_evicted(tmp_path):
+    path = str(tmp_path / "responses.db")
+    cache = ResponseCache(path)
+    for i in range(3):
+        cache.put(f"key-{i}", f"response-{i}")
+        time.sleep(0.01)
+    cache.get("key-0")  # the least recently used is now key-1
+    cache.close()
+
+    cache = ResponseCache(path, max_entries=2)
+    assert [cache.get(f"key-{i}") for i in range(3)] == ["response-0", None, "response-2"]
+    cache.close()
+
+    cache = ResponseCache(path, max_age_seconds=0.0)
+    assert cache.get("key-0") is None
+    cache.close()
+
+
+def test_a_cached_response_skips_the_request(cache, monkeypatch):
+    requests = []
+
+    def get_response(self, messages, *args, **kwargs):
+        requests.append(messages)
+        return "Hello there!"
+
+    monkeypatch.setattr(OpenAIChat, "_get_response", get_response)
+    set_response_cache(cache)
+    try:
+        backend = OpenAIChat(model="gpt-4o-mini")
+        assert backend._cached_get_response(MESSAGES) == "Hello there!"
+        assert backend._cached_get_response(MESSAGES) == "Hello there!"
+        assert OpenAIChat(model="gpt-4o-mini", temperature=0.1)._cached_get_response(MESSAGES) == "Hello there!"
+    finally:
+        set_response_cache(None)
+    assert len(requests) == 2
@@ -0,0 +1,77 @@
+import json
+import random
+
+import pytest
+
+from run_manifest import MANIFEST_FILE_NAME, RunManifest
+
+CONFIG = {"model_name": "gpt-4o-mini", "max_generated_dialogs": 10, "random_seed": 42}
+
+
+def test_resume_restores_the_finished_dialogs(tmp_path):
+    run_dir = str(tmp_path / "run")
+    manifest = RunManifest.create(run_dir, CONFIG, "simulated_dialogs.json", random_seed=42)
+    manifest.mark_completed(3, output_bytes=120, rejected_bytes=0)
+    manifest.mark_completed(0, output_bytes=250, rejected_bytes=40)
+
+    resumed = RunManifest.load(run_dir)
+    resumed.check_config(dict(CONFIG))
+    assert resumed.completed == {0, 3}
+    assert [i for i in range(5) if not resumed.is_completed(i)] == [1, 2, 4]
+    assert (resumed.output_bytes, resumed.rejected_bytes) == (250, 40)
+    assert resumed.output_path == manifest.output_path
+    assert resumed.rng_state is None  # seeded runs derive the seed of every dialog from its index
+
+
+def test_resume_with_another_config_is_refused(tmp_path):
+    manifest = RunManifest.create(str(tmp_path), CONFIG, "simulated_dialogs.json", random_seed=42)
+    with pytest.raises(ValueError, match="model_name"):
+        manifest.check_config(dict(CONFIG, model_name="gpt-4o"))
+
+
+def test_a_tampered_manifest_is_refused(tmp_path):
+    RunManifest.create(str(tmp_path), CONFIG, "simulated_dialogs.json", random_seed=42)
+    path = tmp_path / MANIFEST_FILE_NAME
+    data = json.loads(path.read_text(encoding="utf-8"))
+    data["config"]["max_generated_dialogs"] = 20
+    path.write_text(json.dumps(data), encoding="utf-8")
+    with pytest.raises(ValueError, match="corrupted"):
+        RunManifest.load(str(tmp_path))
+    with pytest.raises(ValueError, match="No run manifest"):
+        RunManifest.load(str(tmp_path / "missing"))
+
+
+def test_an_unseeded_run_resumes_its_random_stream(tmp_path):
+    random.seed(1)
+    manifest = RunManifest.create(str(tmp_path), CONFIG, "simulated_dialogs.json")
+    manifest.mark_completed(0)
+    expected = [random.random() for _ in range(3)]
+
+    random.seed(2)
+    RunManifest.load(str(tmp_path)).restore_rng_state()
+    assert [random.random() for _ in range(3)] == expected
+
+
+def test_a_shard_line_cut_off_by_a_crash_is_dropped(tmp_path):
+    from dialog_simulation import read_shard
+
+    shard_path = tmp_path / "shard_0.jsonl"
+    complete = json.dumps({"dialog_idx": 0, "record": {}, "reject_reason": None}) + "\n"
+    shard_path.write_text(complete + '{"dialog_idx": 1, "rec', encoding="utf-8")
+    assert [item["dialog_idx"] for item in read_shard(str(shard_path))] == [0]
+    assert shard_path.read_text(encoding="utf-8") == complete
+
+
+def test_the_dialog_ids_are_unique_and_survive_a_resume(tmp_path):
+    from dialog_simulation import make_dialog_id
+
+    run_dir = str(tmp_path / "run_20260101120000")
+    manifest = RunManifest.create(run_dir, CONFIG, "simulated_dialogs_20260101120000.json", random_seed=42)
+    assert manifest.run_id == "20260101120000"
+    # the dialogs finished within the same second get different ids
+    ids = [make_dialog_id(manifest.run_id, i) for i in range(CONFIG["max_generated_dialogs"])]
+    assert len(set(ids)) == len(ids)
+    assert ids[3] == "20260101120000_000003"
+
+    resumed = RunManifest.load(run_dir + "/")
+    assert [make_dialog_id(resumed.run_id, i) for i in range(CONFIG["max_generated_dialogs"])] == ids
@@ -0,0 +1,134 @@
+import json
+import random
+from collections import Counter
+
+import pytest
+
+from data_utils import collect_type_info, extract_object_info, resolve_scene_paths
+from scene_index import SceneIndex
+
+FASHION_METADATA = {
+    "shirt_1": {"type": "shirt"},
+    "shirt_2": {"type": "shirt"},
+    "jacket_1": {"type": "jacket"},
+    "skirt_1": {"type": "skirt"},
+    "hat_1": {"type": "hat"},
+}
+FURNITURE_METADATA = {
+    "sofa_1": {"type": "sofa"},
+    "table_1": {"type": "table"},
+}
+# scene name -> objects of its first scene
+SCENES = {
+    "f_shirts": ["shirt_1", "shirt_2"],
+    "f_shirt_jacket": ["shirt_1", "jacket_1"],
+    "f_skirt_hat": ["skirt_1", "hat_1"],
+    "f_all": ["shirt_1", "jacket_1", "skirt_1", "hat_1"],
+    "h_sofa": ["sofa_1"],
+    "h_sofa_table": ["sofa_1", "table_1"],
+}
+
+
+@pytest.fixture
+def pools(tmp_path):
+    image_pool = tmp_path / "images"
+    info_pool = tmp_path / "infos"
+    image_pool.mkdir()
+    info_pool.mkdir()
+    for name, objects in SCENES.items():
+        (image_pool / f"{name}.png").write_bytes(b"")
+        with open(info_pool / f"{name}_scene.json", "w", encoding="utf-8") as f:
+            json.dump({"scenes": [{"objects": [{"prefab_path": obj} for obj in objects]}]}, f)
+    seed_dialog_data = [
+        {"domain": "fashion", "scene_ids": {"0": "f_shirts"}},
+        {"domain": "fashion", "scene_ids": {"0": "m_f_shirt_jacket", "4": "f_skirt_hat"}},
+        {"domain": "fashion", "scene_ids": {"0": "f_skirt_hat"}},
+        {"domain": "fashion", "scene_ids": {"0": "f_all"}},
+        {"domain": "fashion", "scene_ids": {"0": "f_shirts"}},  # the same first scene as dialog 0
+        {"domain": "fashion", "scene_ids": {"0": "missing_scene"}},
+        {"domain": "furniture", "scene_ids": {"0": "h_sofa"}},
+        {"domain": "furniture", "scene_ids": {"0": "h_sofa_table"}},
+    ]
+    return str(image_pool), str(info_pool), seed_dialog_data
+
+
+def build(pools):
+    image_pool, info_pool, seed_dialog_data = pools
+    return SceneIndex.build(image_pool, info_pool, seed_dialog_data, FASHION_METADATA, FURNITURE_METADATA)
+
+
+def accepted_by_rejection_sampling(pools, dialog_idx, partner_idx):
+    """The rule of the rejection sampling loop of `random_select_scene` without an index, and the type it returns."""
+    image_pool, info_pool, seed_dialog_data = pools
+    metadata = {"fashion": FASHION_METADATA, "furniture": FURNITURE_METADATA}[seed_dialog_data[dialog_idx]["domain"]]
+    _, info_paths = resolve_scene_paths(seed_dialog_data[dialog_idx], image_pool, info_pool)
+    _, partner_info_paths = resolve_scene_paths(seed_dialog_data[partner_idx], image_pool, info_pool)
+    if seed_dialog_data[partner_idx]["domain"] != seed_dialog_data[dialog_idx]["domain"] or not partner_info_paths:
+        return None
+    if partner_info_paths[0] == info_paths[0]:
+        return None
+    types = collect_type_info(extract_object_info(info_paths[0], metadata))
+    for type_info in collect_type_info(extract_object_info(partner_info_paths[0], metadata)):
+        if type_info not in types:
+            return type_info
+    return None
+
+
+def test_sample_partner_matches_the_rejection_sampling_rule(pools):
+    index = build(pools)
+    random.seed(0)
+    for dialog_idx in index.valid_dialog_ids:
+        expected = {partner_idx: accepted_by_rejection_sampling(pools, dialog_idx, partner_idx) for partner_idx in range(len(pools[2]))}
+        expected = {partner_idx: type_name for partner_idx, type_name in expected.items() if type_name is not None}
+        if not expected:
+            with pytest.raises(ValueError):
+                index.sample_partner(dialog_idx)
+            continue
+        draws = Counter()
+        for _ in range(3000):
+            partner_idx, type_name = index.sample_partner(dialog_idx)
+            assert expected.get(partner_idx) == type_name
+            draws[partner_idx] += 1
+        # uniform over the accepted dialogs, as the rejection sampling is
+        assert set(draws) == set(expected)
+        for count in draws.values():
+            assert abs(count - 3000 / len(expected)) < 0.2 * 3000 / len(expected)
+
+
+def test_scenes_missing_from_the_pools_are_skipped(pools):
+    index = build(pools)
+    assert 5 not in index.valid_dialog_ids and len(index) == 7
+    image_paths, info_paths = index.get_scene_paths(1)
+    assert [path.rsplit("/", 1)[-1] for path in info_paths] == ["f_shirt_jacket_scene.json", "f_skirt_hat_scene.json"]
+    assert (image_paths, info_paths) == resolve_scene_paths(pools[2][1], pools[0], pools[1])
+    assert index.get_scene_paths(5) == ([], [])
+
+
+def test_save_load_round_trip(pools, tmp_path):
+    index = build(pools)
+    path = str(tmp_path / "index" / "scene_index.json")
+    index.save(path)
+    loaded = SceneIndex.load(path)
+    assert loaded.fingerprint == index.fingerprint
+    assert loaded.scene_paths == {idx: (list(images), list(infos)) for idx, (images, infos) in index.scene_paths.items()}
+    assert loaded.type_masks == index.type_masks
+    assert loaded.type_vocab == index.type_vocab
+
+
+def test_load_or_build_rebuilds_when_the_inputs_change(pools, tmp_path):
+    image_pool, info_pool, seed_dialog_data = pools
+    path = str(tmp_path / "scene_index.json")
+    index = SceneIndex.load_or_build(path, image_pool, info_pool, seed_dialog_data, FASHION_METADATA, FURNITURE_METADATA)
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    data["scenes"]["0"]["types"] = ["stale"]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    # the saved index matches the inputs, it is loaded as it is
+    loaded = SceneIndex.load_or_build(path, image_pool, info_pool, seed_dialog_data, FASHION_METADATA, FURNITURE_METADATA)
+    assert loaded.scene_types[0] == ["stale"]
+
+    seed_dialog_data = seed_dialog_data[:-1]
+    rebuilt = SceneIndex.load_or_build(path, image_pool, info_pool, seed_dialog_data, FASHION_METADATA, FURNITURE_METADATA)
+    assert rebuilt.scene_types[0] == index.scene_types[0] and len(rebuilt) == len(index) - 1
+    assert SceneIndex.load(path).fingerprint == rebuilt.fingerprint
@@ -0,0 +1,130 @@
+import json
+import os
+import random
+from collections import defaultdict
+
+import pytest
+from PIL import Image
+
+from dialog_simulation import derive_seed, load_generation_resources, load_scene_index, merge_shards, read_shard, sample_seeded_dialog_spec
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METADATA_DIR = os.path.join(ROOT, "scene_info_pool", "original_data")
+PROFILE_SLOTS_PATH = os.path.join(ROOT, "seed_dataset", "caches", "db_slot", "slot_profiles_filtered.json")
+SEED = 1234
+NUM_DIALOGS = 12
+
+
+@pytest.fixture
+def generation_setup(tmp_path):
+    """Scene pools of a few scenes per domain built from the real product metadata, and seed dialogs pointing to them."""
+    image_pool = tmp_path / "images"
+    info_pool = tmp_path / "infos"
+    image_pool.mkdir()
+    info_pool.mkdir()
+    (tmp_path / "small_images").mkdir()
+    with open(os.path.join(METADATA_DIR, "dev_data.json"), "r", encoding="utf-8") as f:
+        dialogues = [item["dialogue"] for item in json.load(f)[:8]]
+
+    seed_dialog_data = []
+    for domain in ("fashion", "furniture"):
+        with open(os.path.join(METADATA_DIR, f"{domain}_prefab_metadata_all.json"), "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        by_type = defaultdict(list)
+        for prefab_path, info in metadata.items():
+            by_type[info["type"]].append(prefab_path)
+        types = sorted(by_type)[:4]
+        # every scene holds two types, so that each scene has a partner with a type it lacks
+        for i, type_name in enumerate(types):
+            name = f"{domain}_{i}"
+            objects = by_type[type_name][:2] + by_type[types[(i + 1) % len(types)]][:1]
+            Image.new("RGB", (64, 48), (40 * i, 100, 200)).save(image_pool / f"{name}.png")
+            with open(info_pool / f"{name}_scene.json", "w", encoding="utf-8") as f:
+                json.dump({"scenes": [{"objects": [{"prefab_path": obj} for obj in objects]}]}, f)
+            seed_dialog_data.append({"domain": domain, "scene_ids": {"0": name}, "dialogue": dialogues[len(seed_dialog_data)]})
+
+    seed_data_path = tmp_path / "seed_dialogs.json"
+    seed_data_path.write_text(json.dumps(seed_dialog_data), encoding="utf-8")
+    resource_paths = {
+        "seed_data_path": str(seed_data_path),
+        "user_profiles_path": PROFILE_SLOTS_PATH,
+        "fashion_metadata_path": os.path.join(METADATA_DIR, "fashion_prefab_metadata_all.json"),
+        "furniture_metadata_path": os.path.join(METADATA_DIR, "furniture_prefab_metadata_all.json"),
+    }
+    spec_kwargs = {
+        "scenes_images_pool_path": str(image_pool),
+        "scenes_images_info_pool_path": str(info_pool),
+        "small_image_cache_dir": str(tmp_path / "small_images"),
+    }
+    return resource_paths, spec_kwargs
+
+
+def sample_sharded_specs(resource_paths, spec_kwargs, num_shards):
+    """Sample the specs of the dialogs the way the shards of `generate_shard` do, keyed by dialog index."""
+    specs = {}
+    dialog_ids = list(range(NUM_DIALOGS))
+    for shard_idx in range(num_shards):
+        random.seed(derive_seed(SEED, "shard", shard_idx))
+        resources = load_generation_resources(**resource_paths)
+        load_scene_index(resources, spec_kwargs)
+        for dialog_idx in dialog_ids[shard_idx::num_shards]:
+            specs[dialog_idx] = sample_seeded_dialog_spec(resources, dialog_idx, random_seed=SEED, **spec_kwargs)
+    return specs
+
+
+def write_shards(tmp_path, specs, num_shards):
+    """Write every `num_shards`-th spec to a shard file, as `generate_shard` writes the finished dialogs."""
+    shard_paths = []
+    for shard_idx in range(num_shards):
+        shard_path = tmp_path / f"{num_shards}_shard_{shard_idx}.jsonl"
+        with open(shard_path, "w", encoding="utf-8") as fw:
+            for dialog_idx in sorted(specs)[shard_idx::num_shards]:
+                reject_reason = "too short" if dialog_idx % 5 == 0 else None
+                item = {"dialog_idx": dialog_idx, "record": {"user_profile": specs[dialog_idx]["user_profile"]}, "reject_reason": reject_reason}
+                fw.write(json.dumps(item, ensure_ascii=False) + "\n")
+        shard_paths.append(str(shard_path))
+    return shard_paths
+
+
+def test_the_specs_do_not_depend_on_the_number_of_shards(generation_setup):
+    resource_paths, spec_kwargs = generation_setup
+    single = sample_sharded_specs(resource_paths, spec_kwargs, num_shards=1)
+    sharded = sample_sharded_specs(resource_paths, spec_kwargs, num_shards=3)
+    assert sorted(single) == sorted(sharded) == list(range(NUM_DIALOGS))
+    for dialog_idx in range(NUM_DIALOGS):
+        assert sharded[dialog_idx] == single[dialog_idx]
+    # the dialogs do not all get the same spec
+    assert len({json.dumps(spec["user_profile"], sort_keys=True) for spec in single.values()}) > 1
+
+
+def test_the_merged_output_does_not_depend_on_the_number_of_shards(tmp_path, generation_setup):
+    resource_paths, spec_kwargs = generation_setup
+    specs = sample_sharded_specs(resource_paths, spec_kwargs, num_shards=1)
+    outputs = []
+    for num_shards in (1, 3):
+        output_path = tmp_path / f"output_{num_shards}.json"
+        rejected_path = tmp_path / f"rejected_{num_shards}.json"
+        ids, _, _ = merge_shards(write_shards(tmp_path, specs, num_shards), str(output_path), str(rejected_path))
+        assert ids == list(range(NUM_DIALOGS))
+        outputs.append((output_path.read_bytes(), rejected_path.read_bytes()))
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize("partial", [
+    b'{"dialog_idx": 2, "rec',
+    # a complete object whose newline was never written
+    b'{"dialog_idx": 2, "record": {}, "reject_reason": null}',
+    # cut inside a multi-byte character
+    '{"dialog_idx": 2, "record": {"name": "Zoë"}}'.encode("utf-8")[:-4],
+])
+def test_read_shard_truncates_a_partial_last_record(tmp_path, partial):
+    shard_path = tmp_path / "shard_0.jsonl"
+    complete = "".join(json.dumps({"dialog_idx": i, "record": {}, "reject_reason": None}) + "\n" for i in range(2)).encode("utf-8")
+    shard_path.write_bytes(complete + partial)
+    assert [item["dialog_idx"] for item in read_shard(str(shard_path))] == [0, 1]
+    assert shard_path.read_bytes() == complete
+
+    # the resumed shard appends after the last complete record
+    with open(shard_path, "a", encoding="utf-8") as fw:
+        fw.write(json.dumps({"dialog_idx": 2, "record": {}, "reject_reason": None}) + "\n")
+    assert [item["dialog_idx"] for item in read_shard(str(shard_path))] == [0, 1, 2]
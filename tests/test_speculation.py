@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from chatarena.agent import Moderator, Player
+from chatarena.arena import Arena
+from chatarena.backends.base import IntelligenceBackend
+from chatarena.environments.conversation import ModeratedConversation
+
+
+class SleepyBackend(IntelligenceBackend):
+    """Answers `reply` after `delay` seconds, and counts its queries."""
+    stateful = False
+    type_name = "sleepy"
+
+    def __init__(self, reply, delay=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.reply = reply
+        self.delay = delay
+        self.queries = 0
+
+    def query(self, **kwargs):
+        raise NotImplementedError
+
+    async def async_query(self, agent_name, history_messages, **kwargs):
+        self.queries += 1
+        await asyncio.sleep(self.delay)
+        return self.reply if agent_name == "Moderator" else f"{self.reply} {self.queries}"
+
+
+def make_arena(decision, assistant_delay, moderator_delay=0.05):
+    roles = dict(role_desc="role", role_desc_in_transition_turn="role", role_desc_after_transition_turn="role", transition_turn=100)
+    user, assistant = SleepyBackend("Hi, I need a shirt."), SleepyBackend("Here is a red shirt.", delay=assistant_delay)
+    players = [Player(name="User", backend=user, **roles), Player(name="Assistant", backend=assistant, **roles)]
+    moderator = Moderator(backend=SleepyBackend(decision, delay=moderator_delay), terminal_condition="Is the conversation over?", **roles)
+    return Arena(players, ModeratedConversation(player_names=["User", "Assistant"], moderator=moderator)), assistant
+
+
+@pytest.mark.parametrize("assistant_delay, wasted", [(0.0, "discarded"), (1.0, "cancelled")])
+def test_a_speculative_turn_is_dropped_when_the_moderator_ends_the_conversation(assistant_delay, wasted):
+    arena, assistant = make_arena("yes", assistant_delay)
+
+    timestep = asyncio.run(arena.async_step(speculate=True))
+    assert timestep.terminal
+    assert arena._speculative_turn is None
+    assert [message.agent_name for message in arena.environment.message_pool.get_all_messages()] == ["User"]
+    stats = arena.speculation_stats.stats()
+    assert stats["checks"] == 1 and stats["used"] == 0 and stats[wasted] == 1
+    assert stats["wasted_tokens"] > 0 and stats["wasted_tokens"] == stats["speculative_tokens"]
+
+
+def test_the_speculative_reply_is_recorded_when_the_conversation_goes_on():
+    arena, assistant = make_arena("no", assistant_delay=0.0)
+
+    async def run():
+        first = await arena.async_step(speculate=True)
+        second = await arena.async_step()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert not first.terminal and not second.terminal
+    messages = arena.environment.message_pool.get_all_messages()
+    assert [(message.agent_name, message.content) for message in messages] == [("User", "Hi, I need a shirt. 1"), ("Assistant", "Here is a red shirt. 1")]
+    assert assistant.queries == 1  # the turn was not asked again
+    stats = arena.speculation_stats.stats()
+    assert stats["checks"] == 1 and stats["used"] == 1 and stats["discarded"] == stats["cancelled"] == 0
+    assert stats["wasted_tokens"] == 0 and stats["saved_seconds"] >= 0
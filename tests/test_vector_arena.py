@@ -0,0 +1,87 @@
+from chatarena.agent import Moderator, Player
+from chatarena.arena import Arena
+from chatarena.backends.base import IntelligenceBackend
+from chatarena.environments.conversation import ModeratedConversation
+from chatarena.vector_arena import VectorArena
+
+
+class StubBackend(IntelligenceBackend):
+    """Answers at once; the players fail at their `fail_at`-th query, the moderator ends a dialog of `end_after` messages."""
+    stateful = False
+    type_name = "stub"
+    batch_sizes = []
+
+    def __init__(self, end_after=None, fail_at=None, **kwargs):
+        super().__init__(**kwargs)
+        self.end_after = end_after
+        self.fail_at = fail_at
+        self.queries = 0
+
+    def query(self, agent_name, history_messages, request_msg=None, **kwargs):
+        self.queries += 1
+        if agent_name == "Moderator":
+            return "yes" if self.end_after is not None and len(history_messages) >= self.end_after else "no"
+        if self.queries == self.fail_at:
+            raise RuntimeError(f"{agent_name} failed")
+        return f"{agent_name} speaks after {len(history_messages)} messages"
+
+    @classmethod
+    def batch_query(cls, queries):
+        cls.batch_sizes.append(len(queries))
+        return super().batch_query(queries)
+
+
+def make_arena(end_after=None, fail_at=None):
+    roles = dict(role_desc="role", role_desc_in_transition_turn="role", role_desc_after_transition_turn="role", transition_turn=100)
+    players = [Player(name=name, backend=StubBackend(fail_at=fail_at), **roles) for name in ("User", "Assistant")]
+    moderator = Moderator(backend=StubBackend(end_after=end_after), terminal_condition="Is the conversation over?", **roles)
+    return Arena(players, ModeratedConversation(player_names=["User", "Assistant"], moderator=moderator))
+
+
+def factory(arenas):
+    arenas = iter(enumerate(arenas))
+    return lambda: next(arenas, None)
+
+
+def test_one_player_batch_and_one_moderator_batch_per_step():
+    StubBackend.batch_sizes = []
+    engine = VectorArena(factory([make_arena(end_after=3) for _ in range(3)]), num_envs=3, max_steps=10)
+    engine.step()
+    assert StubBackend.batch_sizes == [3, 3]
+    engine.run()
+    assert StubBackend.batch_sizes == [3, 3] * 3
+    assert engine.stats()["steps"] == 3 and engine.stats()["player_queries_per_step"] == 3
+
+
+def test_a_finished_dialog_is_replaced_by_the_next_one():
+    finished = []
+    arenas = [make_arena(end_after=end_after) for end_after in (1, 3, 2, 1, 4)]
+    engine = VectorArena(factory(arenas), num_envs=2, max_steps=10, on_finished=lambda key, arena: finished.append(key))
+    assert [slot.key for slot in engine.slots] == [0, 1]
+    engine.step()  # dialog 0 ends after one message
+    assert finished == [0] and [slot.key for slot in engine.slots] == [1, 2]
+    engine.run()
+    assert sorted(finished) == [0, 1, 2, 3, 4]
+    for key, end_after in enumerate((1, 3, 2, 1, 4)):
+        assert len(arenas[key].environment.message_pool.get_all_messages()) == end_after
+        assert arenas[key].current_timestep.terminal
+
+
+def test_max_steps_ends_the_dialogs_the_moderator_does_not():
+    finished = []
+    arenas = [make_arena() for _ in range(2)]
+    VectorArena(factory(arenas), num_envs=2, max_steps=4, on_finished=lambda key, arena: finished.append(key)).run()
+    assert sorted(finished) == [0, 1]
+    assert [len(arena.environment.message_pool.get_all_messages()) for arena in arenas] == [4, 4]
+    assert not any(arena.current_timestep.terminal for arena in arenas)
+
+
+def test_a_failed_query_is_handed_to_on_failed():
+    finished, failed = [], []
+    arenas = [make_arena(end_after=4), make_arena(end_after=4, fail_at=2)]
+    VectorArena(factory(arenas), num_envs=2, max_steps=10, on_finished=lambda key, arena: finished.append(key),
+                on_failed=lambda key, arena, error: failed.append((key, arena, error))).run()
+    assert finished == [0]
+    [(key, arena, error)] = failed
+    assert key == 1 and arena is arenas[1]
+    assert isinstance(error, RuntimeError) and str(error) == "User failed"
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import random
+import argparse
+
+from run_manifest import RunManifest
+from chatarena.backends.local_moderator import TerminalClassifier, round_features
+from colorama import Fore, Back, Style, init
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train the classifier of the local moderator on generated dialogs.")
+    parser.add_argument("--run_dirs", type=str, nargs="+", required=True, help="The run directories of dialog_simulation.py to train on.")
+    parser.add_argument("--output_path", type=str, default="./cache/moderator_classifier.json", help="Where to save the classifier.")
+    parser.add_argument("--threshold", type=float, default=0.95, help="The threshold to report the held-out coverage and accuracy at.")
+    parser.add_argument("--holdout", type=float, default=0.1, help="The fraction of the dialogs held out for the evaluation.")
+    parser.add_argument("--random_seed", type=int, default=1135)
+    return parser.parse_args()
+
+
+def read_dialog_records(path):
+    """The records of an output file of dialog_simulation.py, which are indented JSON objects one after another."""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    decoder = json.JSONDecoder()
+    records, idx = [], 0
+    while True:
+        while idx < len(text) and text[idx].isspace():
+            idx += 1
+        if idx == len(text):
+            return records
+        record, idx = decoder.raw_decode(text, idx)
+        records.append(record)
+
+
+def dialog_examples(conversation, max_interaction_step):
+    """
+    The (features, label) of every round of a dialog, the label tells whether the moderator ended the dialog after
+    the round. The last round of a dialog that reached `max_interaction_step` is left out, the moderator may or may
+    not have ended it.
+    """
+    contents = [next(iter(utt.values())) for utt in conversation]
+    num_rounds = len(contents) // 2
+    ended_by_moderator = len(contents) < max_interaction_step
+    examples = []
+    for round_idx in range(1, num_rounds + 1):
+        is_last = round_idx == num_rounds
+        if is_last and not ended_by_moderator:
+            break
+        examples.append((round_features(contents[2 * round_idx - 2], contents[2 * round_idx - 1], round_idx), is_last))
+    return examples
+
+
+def load_dialogs(run_dirs):
+    dialogs = []
+    for run_dir in run_dirs:
+        manifest = RunManifest.load(run_dir)
+        if manifest.config.get("moderator_backend", "llm") != "llm":
+            print (Fore.YELLOW + f"Skipping {run_dir}, its dialogs were not ended by the LLM moderator" + Style.RESET_ALL, flush=True)
+            continue
+        for record in read_dialog_records(manifest.output_path):
+            dialogs.append(dialog_examples(record["conversation"], manifest.config["max_interaction_step"]))
+    return dialogs
+
+
+if __name__ == '__main__':
+    init(autoreset=True)
+    args = parse_args()
+    dialogs = load_dialogs(args.run_dirs)
+    random.seed(args.random_seed)
+    random.shuffle(dialogs)
+    num_holdout = int(len(dialogs) * args.holdout)
+    train = [example for dialog in dialogs[num_holdout:] for example in dialog]
+    heldout = [example for dialog in dialogs[:num_holdout] for example in dialog]
+
+    classifier = TerminalClassifier().fit([features for features, _ in train], [label for _, label in train])
+    print (Fore.GREEN + f"Trained on {len(train)} rounds of {len(dialogs) - num_holdout} dialogs ({sum(label for _, label in train)} ending rounds)" + Style.RESET_ALL, flush=True)
+    if heldout:
+        decided = correct = 0
+        for features, label in heldout:
+            probability = classifier.predict_proba(features)
+            if probability >= args.threshold or probability <= 1 - args.threshold:
+                decided += 1
+                correct += (probability >= args.threshold) == label
+        print (Fore.GREEN + f"Held-out rounds: {len(heldout)}, decided at threshold {args.threshold}: {decided / len(heldout):.1%}, "
+               f"accuracy on the decided rounds: {correct / decided if decided else 0.0:.1%}" + Style.RESET_ALL, flush=True)
+
+    os.makedirs(os.path.dirname(args.output_path) or ".", exist_ok=True)
+    classifier.save(args.output_path)
+    print (Fore.GREEN + f"Saved the classifier to {args.output_path}" + Style.RESET_ALL, flush=True)